@@ -62,6 +62,9 @@ class CrazyFlies(ControlAffineSystemNew):
     F_3 = 2
     F_4 = 3
 
+    # Rows of g that depend on the control inputs
+    G_ROWS = (W, R, Q, P)
+
     def __init__(
             self,
             x: torch.Tensor,
@@ -276,15 +279,20 @@ class CrazyFlies(ControlAffineSystemNew):
         returns:
             xdot: bs x self.n_dims tensor of time derivatives of x
         """
-        # Get the control-affine dynamics
-        # print(x.ndim)
-        f, g = self.control_affine_dynamics(x, params=params)
-        # print(f)
+        # Sanity check on input
+        assert x.ndim == 2
+        assert x.shape[1] == self.n_dims
+
+        # If no params required, use nominal params
+        if params is None:
+            params = self.nominal_params
+
+        # Only the G_ROWS rows of g are nonzero, so g u is added to them without
+        # forming the bs x n_dims x n_controls g
+        _, rows, g_rows = self.g_entry(params, x.device, x.dtype)
+        xdot = self._f(x, params).reshape(x.shape)
 
-        # print(g)
-        # Compute state derivatives using control-affine form
-        xdot = f + torch.bmm(g, u.unsqueeze(-1))
-        return xdot.view(x.shape)
+        return xdot.index_add_(1, rows, torch.mm(u.reshape(-1, self.n_controls), g_rows))
 
     # @property
     def state_limits(self) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -420,116 +428,150 @@ class CrazyFlies(ControlAffineSystemNew):
 
         return goal_mask
 
-    def _f(self, x: torch.Tensor, params):
+    @staticmethod
+    def f_terms(x: torch.Tensor, Ixx: float, Iyy: float, Izz: float):
+        """
+        Return the control-independent dynamics as a bs x self.n_dims tensor, stacking
+        the derivatives of all the states at once. This is a pure function of x, so it
+        can be handed to torch.compile, see compile_dynamics.
+        args:
+            x: bs x self.n_dims tensor of state
+            Ixx, Iyy, Izz: moments of inertia
+        returns:
+            f: bs x self.n_dims tensor, possibly a transposed view
+        """
+        # Work on the transposed state so that every state variable is contiguous
+        x_t = x.t()[CrazyFlies.PSI:].contiguous()
+        angles = x_t[:CrazyFlies.PHI - CrazyFlies.PSI + 1]
+        psi, theta, phi, u, v, w, r, q, p = torch.unbind(x_t, dim=0)
+
+        s_psi, s_the, s_phi = torch.unbind(torch.sin(angles), dim=0)
+        c_psi, c_the, c_phi = torch.unbind(torch.cos(angles), dim=0)
+        t_the = torch.tan(theta)
+
+        return torch.stack([
+            # Derivatives of positions
+            w * (s_psi * s_phi + c_psi * c_phi * s_the) - v * (s_psi * c_phi - c_psi * s_phi * s_the)
+            + u * c_psi * c_the,
+            v * (c_psi * c_phi + s_psi * s_phi * s_the) - w * (c_psi * s_phi - s_psi * c_phi * s_the)
+            + u * s_psi * c_the,
+            w * c_psi * c_phi - u * s_the + v * s_phi * c_the,
+            # Derivatives of angles
+            p + r * c_phi * t_the + q * s_phi * t_the,
+            q * c_phi - r * s_phi,
+            r * c_phi / c_the + q * s_phi / c_the,
+            # Derivatives of linear velocities
+            r * v - q * w + 9.81 * s_the,
+            p * w - r * u - 9.81 * s_phi * c_the,
+            q * u - p * v - 9.81 * c_phi * c_the,
+            # Derivatives of angular velocities
+            (Ixx - Iyy) / Izz * p * q,
+            (Izz - Ixx) / Iyy * p * r,
+            (Izz - Iyy) / Ixx * p * q,
+        ], dim=0).t()
+
+    def compile_dynamics(self, enable: bool = True, **kwargs):
+        """
+        Evaluate f_terms through torch.compile, which fuses it into a few kernels.
+        args:
+            enable: False goes back to the eager f_terms
+            kwargs: passed to torch.compile
+        """
+        if enable:
+            kwargs.setdefault("dynamic", True)
+            self.f_fn = torch.compile(CrazyFlies.f_terms, **kwargs)
+        else:
+            self.f_fn = CrazyFlies.f_terms
+
+    def _f(self, x: torch.Tensor, params, out: Optional[torch.Tensor] = None):
         """
         Return the control-independent part of the control-affine dynamics.
         args:
             x: bs x self.n_dims tensor of state
             params: a dictionary giving the parameter values for the system. If None,
                     default to the nominal parameters used at initialization
+            out: optional bs x self.n_dims x 1 tensor to write the result to
         returns:
             f: bs x self.n_dims x 1 tensor
         """
-        # Extract batch size and set up a tensor for holding the result
+        if params is None:
+            params = self.nominal_params
         batch_size = x.shape[0]
-        f = torch.zeros((batch_size, self.n_dims, 1)).type_as(x).to(x.device)
-        
 
-        # Extract the needed parameters
-        m, Ixx, Iyy, Izz, CT, CD, d = params["m"], params["Ixx"], params["Iyy"], params["Izz"], params["CT"], params[
-            "CD"], params["d"]
+        if out is None:
+            out = torch.empty((batch_size, self.n_dims, 1), dtype=x.dtype, device=x.device)
 
-        # Extract state variables
-        psi = x[:, CrazyFlies.PSI].reshape(batch_size, 1)
-        theta = x[:, CrazyFlies.THETA].reshape(batch_size, 1)
-        phi = x[:, CrazyFlies.PHI].reshape(batch_size, 1)
-
-        u = x[:, CrazyFlies.U].reshape(batch_size, 1)
-        v = x[:, CrazyFlies.V].reshape(batch_size, 1)
-        w = x[:, CrazyFlies.W].reshape(batch_size, 1)
-
-        r = x[:, CrazyFlies.R].reshape(batch_size, 1)
-        q = x[:, CrazyFlies.Q].reshape(batch_size, 1)
-        p = x[:, CrazyFlies.P].reshape(batch_size, 1)
-
-        s_psi = torch.sin(psi).reshape(batch_size, 1)
-        s_phi = torch.sin(phi).reshape(batch_size, 1)
-        s_the = torch.sin(theta).reshape(batch_size, 1)
-
-        c_psi = torch.cos(psi).reshape(batch_size, 1)
-        c_phi = torch.cos(phi).reshape(batch_size, 1)
-        c_the = torch.cos(theta).reshape(batch_size, 1)
-
-        t_psi = torch.tan(psi).reshape(batch_size, 1)
-        t_phi = torch.tan(phi).reshape(batch_size, 1)
-        t_the = torch.tan(theta).reshape(batch_size, 1)
-
-        # Derivatives of positions
-        f[:, CrazyFlies.X] = w * (s_psi * s_phi + c_psi * c_phi * s_the) \
-                             - v * (s_psi * c_phi - c_psi * s_phi * s_the) \
-                             + u * c_psi * c_the
-        f[:, CrazyFlies.Y] = v * (c_psi * c_phi + s_psi * s_phi * s_the) \
-                             - w * (c_psi * s_phi - s_psi * c_phi * s_the) \
-                             + u * s_psi * c_the
-        f[:, CrazyFlies.Z] = w * c_psi * c_phi - u * s_the + v * s_phi * c_the
-
-        # Derivatives of angles
-        f[:, CrazyFlies.PSI] = p + r * c_phi * t_the + q * s_phi * t_the
-        f[:, CrazyFlies.THETA] = q * c_phi - r * s_phi
-        f[:, CrazyFlies.PHI] = r * c_phi / c_the + q * s_phi / c_the
-
-        # Derivatives of linear velocities
-        f[:, CrazyFlies.U] = r * v - q * w + 9.81 * s_the
-        f[:, CrazyFlies.V] = p * w - r * u - 9.81 * s_phi * c_the
-        f[:, CrazyFlies.W] = q * u - p * v - 9.81 * c_phi * c_the
-
-        # Derivatives of angular velocities
-        f[:, CrazyFlies.R] = (Ixx - Iyy) / Izz * p * q
-        f[:, CrazyFlies.Q] = (Izz - Ixx) / Iyy * p * r
-        f[:, CrazyFlies.P] = (Izz - Iyy) / Ixx * p * q
-
-        return f
+        f_fn = self.__dict__.get("f_fn", CrazyFlies.f_terms)
+        out.view(batch_size, self.n_dims).copy_(f_fn(x, params["Ixx"], params["Iyy"], params["Izz"]))
 
-    def _g(self, x: torch.Tensor, params):
+        return out
+
+    def g_entry(self, params, device=None, dtype=None):
         """
-        Return the control-independent part of the control-affine dynamics.
-        args:
-            x: bs x self.n_dims tensor of state
-            params: a dictionary giving the parameter values for the system. If None,
-                    default to the nominal parameters used at initialization
+        Return the state-independent control matrix, computed once per parameter values,
+        device and dtype. Do not modify the returned tensors in place.
         returns:
-            g: bs x self.n_dims x self.n_controls tensor
+            g: 1 x self.n_dims x self.n_controls tensor
+            rows: the indices G_ROWS of the nonzero rows of g
+            g_rows: self.n_controls x len(G_ROWS) tensor, the transpose of these rows
         """
-        # Extract batch size and set up a tensor for holding the result
-        batch_size = x.shape[0]
-        g = torch.zeros((batch_size, self.n_dims, self.n_controls)).type_as(x).to(x.device)
+        if params is None:
+            params = self.nominal_params
+        device = torch.device("cpu") if device is None else torch.device(device)
+        dtype = torch.get_default_dtype() if dtype is None else dtype
 
         # Extract the needed parameters
         m, Ixx, Iyy, Izz, CT, CD, d = params["m"], params["Ixx"], params["Iyy"], params["Izz"], params["CT"], params[
             "CD"], params["d"]
 
-        # Derivatives of vz and vphi, vtheta, vpsi depend on control inputs
-        g[:, CrazyFlies.W, CrazyFlies.F_1] = 1 / m
-        g[:, CrazyFlies.W, CrazyFlies.F_2] = 1 / m
-        g[:, CrazyFlies.W, CrazyFlies.F_3] = 1 / m
-        g[:, CrazyFlies.W, CrazyFlies.F_4] = 1 / m
+        cache = self.__dict__.setdefault("g_cache", {})
+        key = (m, Ixx, Iyy, Izz, CT, CD, d, device, dtype)
+        if key not in cache:
+            g = torch.zeros((1, self.n_dims, self.n_controls), dtype=dtype)
+
+            # Derivatives of vz and vphi, vtheta, vpsi depend on control inputs
+            g[:, CrazyFlies.W, CrazyFlies.F_1] = 1 / m
+            g[:, CrazyFlies.W, CrazyFlies.F_2] = 1 / m
+            g[:, CrazyFlies.W, CrazyFlies.F_3] = 1 / m
+            g[:, CrazyFlies.W, CrazyFlies.F_4] = 1 / m
+
+            g[:, CrazyFlies.R, CrazyFlies.F_1] = (1 / Izz) * (-np.sqrt(2) * d)
+            g[:, CrazyFlies.R, CrazyFlies.F_2] = (1 / Izz) * (-np.sqrt(2) * d)
+            g[:, CrazyFlies.R, CrazyFlies.F_3] = (1 / Izz) * (np.sqrt(2) * d)
+            g[:, CrazyFlies.R, CrazyFlies.F_4] = (1 / Izz) * (np.sqrt(2) * d)
 
-        g[:, CrazyFlies.R, CrazyFlies.F_1] = (1 / Izz) * (-np.sqrt(2) * d)
-        g[:, CrazyFlies.R, CrazyFlies.F_2] = (1 / Izz) * (-np.sqrt(2) * d)
-        g[:, CrazyFlies.R, CrazyFlies.F_3] = (1 / Izz) * (np.sqrt(2) * d)
-        g[:, CrazyFlies.R, CrazyFlies.F_4] = (1 / Izz) * (np.sqrt(2) * d)
+            g[:, CrazyFlies.Q, CrazyFlies.F_1] = (1 / Iyy) * (-np.sqrt(2) * d)
+            g[:, CrazyFlies.Q, CrazyFlies.F_2] = (1 / Iyy) * (np.sqrt(2) * d)
+            g[:, CrazyFlies.Q, CrazyFlies.F_3] = (1 / Iyy) * (np.sqrt(2) * d)
+            g[:, CrazyFlies.Q, CrazyFlies.F_4] = (1 / Iyy) * (-np.sqrt(2) * d)
 
-        g[:, CrazyFlies.Q, CrazyFlies.F_1] = (1 / Iyy) * (-np.sqrt(2) * d)
-        g[:, CrazyFlies.Q, CrazyFlies.F_2] = (1 / Iyy) * (np.sqrt(2) * d)
-        g[:, CrazyFlies.Q, CrazyFlies.F_3] = (1 / Iyy) * (np.sqrt(2) * d)
-        g[:, CrazyFlies.Q, CrazyFlies.F_4] = (1 / Iyy) * (-np.sqrt(2) * d)
+            g[:, CrazyFlies.P, CrazyFlies.F_1] = (1 / Ixx) * (-CD / CT)
+            g[:, CrazyFlies.P, CrazyFlies.F_2] = (1 / Ixx) * (CD / CT)
+            g[:, CrazyFlies.P, CrazyFlies.F_3] = (1 / Ixx) * (-CD / CT)
+            g[:, CrazyFlies.P, CrazyFlies.F_4] = (1 / Ixx) * (CD / CT)
 
-        g[:, CrazyFlies.P, CrazyFlies.F_1] = (1 / Ixx) * (-CD / CT)
-        g[:, CrazyFlies.P, CrazyFlies.F_2] = (1 / Ixx) * (CD / CT)
-        g[:, CrazyFlies.P, CrazyFlies.F_3] = (1 / Ixx) * (-CD / CT)
-        g[:, CrazyFlies.P, CrazyFlies.F_4] = (1 / Ixx) * (CD / CT)
+            # Only these rows are nonzero, gu is computed from them in closed_loop_dynamics
+            rows = torch.tensor(CrazyFlies.G_ROWS)
+            cache[key] = (g.to(device), rows.to(device), g[0, rows].t().contiguous().to(device))
 
-        return g
+        return cache[key]
+
+    def g_matrix(self, params, device=None, dtype=None) -> torch.Tensor:
+        """Return the 1 x self.n_dims x self.n_controls control matrix, see g_entry"""
+        return self.g_entry(params, device, dtype)[0]
+
+    def _g(self, x: torch.Tensor, params):
+        """
+        Return the control-independent part of the control-affine dynamics.
+        args:
+            x: bs x self.n_dims tensor of state
+            params: a dictionary giving the parameter values for the system. If None,
+                    default to the nominal parameters used at initialization
+        returns:
+            g: bs x self.n_dims x self.n_controls tensor. g does not depend on the state,
+               so this is a broadcast view of g_matrix and must not be modified in place
+        """
+        return self.g_matrix(params, x.device, x.dtype).expand(x.shape[0], self.n_dims, self.n_controls)
 
     # @property
     def u_eq(self):
@@ -565,15 +607,8 @@ class CrazyFlies(ControlAffineSystemNew):
         u = u_nominal + self.u_eq().type_as(x).to(x.device)
 
         # Clamp given the control limits
-        upper_u_lim, lower_u_lim = self.control_limits()
-        upper_u_lim = upper_u_lim.type_as(x).to(x.device)
-        lower_u_lim = lower_u_lim.type_as(x).to(x.device)
-        for dim_idx in range(self.n_controls):
-            u[:, dim_idx] = torch.clamp(
-                u[:, dim_idx],
-                min=lower_u_lim[dim_idx].item(),
-                max=upper_u_lim[dim_idx].item(),
-            )
+        upper_u_lim, lower_u_lim = self.cached_limits("control", x.device, x.dtype)
+        u = torch.clamp(u, min=lower_u_lim.reshape(1, -1), max=upper_u_lim.reshape(1, -1))
 
         return u
 
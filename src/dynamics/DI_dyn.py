@@ -592,12 +592,7 @@ class DI(ControlAffineSystemNew):
         u = u_nominal + self.u_eq().type_as(x)
 
         # Clamp given the control limits
-        upper_u_lim, lower_u_lim = self.control_limits()
-        for dim_idx in range(self.n_controls):
-            u[:, dim_idx] = torch.clamp(
-                u[:, dim_idx],
-                min=lower_u_lim[dim_idx].item(),
-                max=upper_u_lim[dim_idx].item(),
-            )
+        upper_u_lim, lower_u_lim = self.cached_limits("control", x.device, x.dtype)
+        u = torch.clamp(u, min=lower_u_lim.reshape(1, -1), max=upper_u_lim.reshape(1, -1))
 
         return u
\ No newline at end of file
@@ -4,6 +4,7 @@ from abc import (
     abstractmethod,
     abstractproperty,
 )
+import warnings
 from typing import Callable, Tuple, Optional, List
 
 from matplotlib.axes import Axes
@@ -31,6 +32,25 @@ class ControlAffineSystemNew(ABC):
     useful properties when it comes to designing controllers.
     """
 
+    # Attributes the limits may depend on, see cached_limits
+    LIMITS_ATTRIBUTES = ("nominal_params", "params", "fault")
+
+    # Integrators accepted by step and zero_order_hold
+    INTEGRATORS = ("euler", "rk4", "rk45")
+
+    # Dormand-Prince 5(4) tableau: stage coefficients, 5th order weights, and the
+    # difference between the 5th and 4th order weights
+    DOPRI_A = (
+        (1 / 5,),
+        (3 / 40, 9 / 40),
+        (44 / 45, -56 / 15, 32 / 9),
+        (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+        (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+        (35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84),
+    )
+    DOPRI_B = (35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0.0)
+    DOPRI_E = (71 / 57600, 0.0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
     def __init__(
         self,
         x: torch.Tensor,
@@ -77,6 +97,61 @@ class ControlAffineSystemNew(ABC):
         if use_linearized_controller:
             self.compute_linearized_controller(scenarios)
 
+    def __setattr__(self, name, value):
+        # The limits may depend on the parameters and on the fault flag, so changing
+        # them drops the cached tensors
+        if name in ControlAffineSystemNew.LIMITS_ATTRIBUTES:
+            self.invalidate_limits()
+        super().__setattr__(name, value)
+
+    def invalidate_limits(self):
+        """Drop the tensors cached by cached_limits. Call this after mutating the
+        parameter dictionary in place."""
+        self.__dict__["limits_cache"] = {}
+
+    def cached_limits(self, kind: str, device=None, dtype=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Return the (upper, lower) limits of the given kind, computed once per device and
+        dtype instead of being rebuilt and copied at every call
+
+        args:
+            kind: "state", "safe" or "control"
+            device: the device of the returned tensors, defaults to the cpu
+            dtype: the dtype of the returned tensors, defaults to the one of the limits
+        returns:
+            upper, lower: tensors shaped as returned by the corresponding *_limits method.
+                          Do not modify them in place.
+        """
+        device = torch.device("cpu") if device is None else torch.device(device)
+        cache = self.__dict__.setdefault("limits_cache", {})
+        key = (kind, device, dtype)
+        if key not in cache:
+            if kind == "state":
+                upper, lower = self.state_limits()
+            elif kind == "safe":
+                upper, lower = self.safe_limits(*self.state_limits())
+            elif kind == "control":
+                upper, lower = self.control_limits()
+            else:
+                raise ValueError(f"Unknown limits: {kind}")
+            dtype_limits = upper.dtype if dtype is None else dtype
+            cache[key] = (upper.to(device=device, dtype=dtype_limits), lower.to(device=device, dtype=dtype_limits))
+
+        return cache[key]
+
+    def clamp_state(self, x: torch.Tensor, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """Clamp x to the state limits in a single kernel
+
+        args:
+            x: a tensor of (..., self.n_dims) points in the state space
+            out: optional tensor to write the result to, may be x itself
+        returns:
+            a tensor of the same shape with every dimension inside its limits
+        """
+        upper_lim, lower_lim = self.cached_limits("state", x.device, x.dtype)
+
+        return torch.clamp(x, min=lower_lim.reshape(self.n_dims), max=upper_lim.reshape(self.n_dims), out=out)
+
     @torch.enable_grad()
     def compute_A_matrix(self, scenario) -> np.ndarray:
         """Compute the linearized continuous-time state-state derivative transfer matrix
@@ -414,6 +489,8 @@ class ControlAffineSystemNew(ABC):
         u: torch.Tensor,
         controller_dt: float,
         params,
+        method: str = "euler",
+        dt: Optional[float] = None,
     ) -> torch.Tensor:
         """
         Simulate dynamics forward for controller_dt, simulating at self.dt, with control
@@ -425,20 +502,134 @@ class ControlAffineSystemNew(ABC):
             controller_dt: the amount of time to hold for
             params: a dictionary giving the parameter values for the system. If None,
                     default to the nominal parameters used at initialization
+            method: the integrator, one of INTEGRATORS. "rk45" ignores dt and adapts
+                    its own steps
+            dt: the simulation timestep, defaults to self.dt
         returns:
             x_next: bs x self.n_dims tensor of next states
         """
-        num_steps = int(controller_dt / self.dt)
-        for tstep in range(0, num_steps):
-            # Get the derivatives for this control input
-            xdot = self.closed_loop_dynamics(x, u, params)
+        if method == "rk45":
+            return self.step(x, u, controller_dt, params, method=method)
 
+        if dt is None:
+            dt = self.dt
+        num_steps = int(controller_dt / dt)
+        for tstep in range(0, num_steps):
             # Simulate forward
-            x = x + self.dt * xdot
+            x = self.step(x, u, dt, params, method=method)
 
         # Return the simulated state
         return x
 
+    def step(
+        self,
+        x: torch.Tensor,
+        u: torch.Tensor,
+        dt: float,
+        params=None,
+        method: str = "euler",
+        rtol: float = 1e-6,
+        atol: float = 1e-8,
+    ) -> torch.Tensor:
+        """
+        Integrate the dynamics over dt with the control held constant at u
+
+        args:
+            x: bs x self.n_dims tensor of state
+            u: bs x self.n_controls tensor of controls
+            dt: the amount of time to integrate for
+            params: a dictionary giving the parameter values for the system. If None,
+                    default to the nominal parameters used at initialization
+            method: "euler" and "rk4" take a single step of length dt, "rk45" takes as
+                    many Dormand-Prince steps as each sample needs to meet rtol and atol
+            rtol, atol: the relative and absolute tolerances of "rk45"
+        returns:
+            x_next: bs x self.n_dims tensor of states after dt
+        """
+        xdot = lambda x: self.closed_loop_dynamics(x, u, params)
+
+        if method == "euler":
+            return x + dt * xdot(x)
+        elif method == "rk4":
+            k1 = xdot(x)
+            k2 = xdot(x + 0.5 * dt * k1)
+            k3 = xdot(x + 0.5 * dt * k2)
+            k4 = xdot(x + dt * k3)
+            return x + dt / 6.0 * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+        elif method == "rk45":
+            return self.rk45(xdot, x, dt, rtol, atol)
+        else:
+            raise ValueError(f"Unknown integrator: {method}, expected one of {self.INTEGRATORS}")
+
+    @staticmethod
+    def rk45(
+        xdot: Callable[[torch.Tensor], torch.Tensor],
+        x: torch.Tensor,
+        duration: float,
+        rtol: float = 1e-6,
+        atol: float = 1e-8,
+        max_steps: int = 10000,
+    ) -> torch.Tensor:
+        """
+        Integrate the autonomous system dx/dt = xdot(x) over duration with the
+        Dormand-Prince 5(4) pair. Every sample keeps its own time and step size, and a
+        step is accepted or rejected per sample from its own error estimate, so stiff
+        samples do not shrink the steps of the whole batch.
+
+        args:
+            xdot: the batched right-hand side, bs x n_dims -> bs x n_dims
+            x: bs x n_dims tensor of initial states
+            duration: the amount of time to integrate for
+            rtol, atol: the relative and absolute tolerances on the local error
+            max_steps: the maximum number of attempted steps
+        returns:
+            x_next: bs x n_dims tensor of states after duration. If max_steps runs
+                    out first, the samples that did not reach duration are left at
+                    their last accepted state, with a warning
+        """
+        a = ControlAffineSystemNew.DOPRI_A
+        b = ControlAffineSystemNew.DOPRI_B
+        e = ControlAffineSystemNew.DOPRI_E
+
+        bs = x.shape[0]
+        t = torch.zeros(bs, 1, dtype=x.dtype, device=x.device)
+        h = torch.full_like(t, duration)
+        k1 = xdot(x)
+
+        for _ in range(max_steps):
+            remaining = duration - t
+            active = remaining > 1e-12 * duration
+            if not bool(active.any()):
+                break
+            h = torch.minimum(h, remaining)
+
+            k = [k1]
+            for a_i in a:
+                k.append(xdot(x + h * sum(a_ij * k_j for a_ij, k_j in zip(a_i, k))))
+
+            x_new = x + h * sum(b_i * k_i for b_i, k_i in zip(b, k) if b_i != 0.0)
+            err = h * sum(e_i * k_i for e_i, k_i in zip(e, k) if e_i != 0.0)
+
+            scale = atol + rtol * torch.maximum(x.abs(), x_new.abs())
+            err_norm = (err / scale).pow(2).mean(dim=1, keepdim=True).sqrt()
+            err_norm = torch.nan_to_num(err_norm, nan=float("inf"))
+
+            accept = active & (err_norm <= 1.0)
+            x = torch.where(accept, x_new, x)
+            t = torch.where(accept, t + h, t)
+            # The last stage is evaluated at x_new, so it is the first stage of the next step
+            k1 = torch.where(accept, k[-1], k1)
+
+            factor = torch.clamp(0.9 * err_norm.clamp(min=1e-10).pow(-0.2), 0.2, 5.0)
+            h = torch.where(active, h * factor, h)
+
+        unfinished = int(((duration - t) > 1e-12 * duration).sum())
+        if unfinished > 0:
+            warnings.warn(f"rk45 hit max_steps={max_steps}: {unfinished} of {bs} samples did not reach "
+                          f"duration={duration} and are returned early")
+
+        return x
+
     @abstractmethod
     def _f(self, x: torch.Tensor, params) -> torch.Tensor:
         """
@@ -486,13 +677,8 @@ class ControlAffineSystemNew(ABC):
         u = u_nominal + self.u_eq().type_as(x)
 
         # Clamp given the control limits
-        upper_u_lim, lower_u_lim = self.control_limits()
-        for dim_idx in range(self.n_controls):
-            u[:, dim_idx] = torch.clamp(
-                u[:, dim_idx],
-                min=lower_u_lim[dim_idx].item(),
-                max=upper_u_lim[dim_idx].item(),
-            )
+        upper_u_lim, lower_u_lim = self.cached_limits("control", x.device, x.dtype)
+        u = torch.clamp(u, min=lower_u_lim.reshape(1, -1), max=upper_u_lim.reshape(1, -1))
 
         return u
 
@@ -0,0 +1,269 @@
+"""Batched fault-injection rollouts of a control-affine system"""
+import inspect
+import warnings
+from typing import Callable, Optional
+
+import torch
+
+from .control_affine_system_new import ControlAffineSystemNew
+
+
+class Rollout(object):
+    """
+    Rollout of a batch of trajectories of a control-affine system, with explicit Euler
+
+        x_{k+1} = clamp(x_k + dt * (f(x_k) + g(x_k) * gain * u_k))
+
+    or any other integrator of ControlAffineSystemNew.step, the control being held
+    constant over each step
+
+    where u_k is given by a controller callback and gain is an actuator fault applied
+    during a window of steps. Alongside the faulty trajectory, the one-step no-fault
+    twin x_k + dt * (f(x_k) + g(x_k) u_k) is recorded, which is what the gamma
+    training data is built from.
+
+    All trajectory tensors, and f(x_k) for dynamics whose _f takes an out buffer, are
+    preallocated once per batch shape, device and dtype and written in place, so a
+    rollout does not allocate per step beyond what the controller, g and the rest of
+    the dynamics allocate.
+    """
+
+    def __init__(self, dynamics: ControlAffineSystemNew, horizon: int, dt: float, params=None,
+                 method: str = "euler"):
+        """
+        args:
+            dynamics: the system to simulate
+            horizon: number of control steps of each rollout
+            dt: the control timestep
+            params: the parameters passed to _f and _g, None for the nominal ones
+            method: the integrator, one of ControlAffineSystemNew.INTEGRATORS
+        """
+        if method not in ControlAffineSystemNew.INTEGRATORS:
+            raise ValueError(f"Unknown integrator: {method}")
+
+        self.dynamics = dynamics
+        self.horizon = horizon
+        self.dt = dt
+        self.params = params
+        self.method = method
+
+        # Dynamics whose _f can write to a preallocated buffer, e.g. CrazyFlies
+        self.f_out = "out" in inspect.signature(dynamics._f).parameters
+
+        self.key = None
+
+    def allocate(self, x0: torch.Tensor):
+        """Allocate the trajectory buffers for a batch shaped like x0, if needed"""
+        bs, n_dims = x0.shape
+        key = (bs, x0.device, x0.dtype)
+        if key == self.key:
+            return
+
+        n_controls = self.dynamics.n_controls
+        self.state_traj = torch.zeros(bs, self.horizon + 1, n_dims, device=x0.device, dtype=x0.dtype)
+        self.state_traj_no_fault = torch.zeros_like(self.state_traj)
+        self.u_traj = torch.zeros(bs, self.horizon, n_controls, device=x0.device, dtype=x0.dtype)
+        self.u_fault = torch.zeros(bs, n_controls, device=x0.device, dtype=x0.dtype)
+        self.fx = torch.zeros(bs, n_dims, 1, device=x0.device, dtype=x0.dtype)
+        self.xdot = torch.zeros(bs, n_dims, 1, device=x0.device, dtype=x0.dtype)
+        self.key = key
+
+    @staticmethod
+    def actuator_gain(bs: int, n_controls: int, fault_index, gain, device="cpu") -> torch.Tensor:
+        """
+        Build the fault gain of run() for one faulty actuator per sample
+
+        args:
+            bs: number of samples
+            n_controls: number of actuators
+            fault_index: int or (bs,) tensor of the faulty actuator, -1 for none
+            gain: float or (bs,) tensor multiplying the faulty actuator
+        returns:
+            fault_gain: (bs, n_controls) tensor, ones except at the faulty actuators
+        """
+        fault_index = torch.as_tensor(fault_index, device=device).reshape(-1).expand(bs)
+        gain = torch.as_tensor(gain, dtype=torch.get_default_dtype(), device=device).reshape(-1).expand(bs)
+
+        fault_gain = torch.ones(bs, n_controls, device=device)
+        faulty = fault_index >= 0
+        fault_gain[faulty, fault_index[faulty]] = gain[faulty]
+
+        return fault_gain
+
+    @torch.no_grad()
+    def run(
+        self,
+        x0: torch.Tensor,
+        controller: Callable[[torch.Tensor, int], torch.Tensor],
+        fault_gain: Optional[torch.Tensor] = None,
+        fault_start: int = 0,
+        fault_end: Optional[int] = None,
+    ):
+        """
+        Simulate horizon steps from x0
+
+        args:
+            x0: bs x n_dims initial states
+            controller: callback (x, k) -> u giving the bs x n_controls control at step k
+            fault_gain: bs x n_controls gain multiplying u while the fault is active, see
+                        actuator_gain. None for a fault-free rollout
+            fault_start: first step at which the fault is active
+            fault_end: first step at which the fault is no longer active, None for never
+        returns:
+            state_traj: bs x (horizon + 1) x n_dims faulty states x_0 ... x_horizon
+            state_traj_no_fault: bs x (horizon + 1) x n_dims one-step no-fault twins,
+                                 entry k + 1 integrates x_k with the healthy control and
+                                 entry 0 is x_0
+            u_traj: bs x horizon x n_controls healthy controls
+        The returned tensors are overwritten by the next run with the same batch shape,
+        clone them to keep them.
+        """
+        self.allocate(x0)
+
+        bs, n_dims = x0.shape
+
+        self.state_traj[:, 0, :] = x0
+        self.state_traj_no_fault[:, 0, :] = x0
+
+        for k in range(self.horizon):
+            state = self.state_traj[:, k, :]
+            u = self.u_traj[:, k, :]
+            u.copy_(controller(state, k))
+
+            faulty = fault_gain is not None and k >= fault_start and (fault_end is None or k < fault_end)
+            if faulty:
+                torch.mul(u, fault_gain, out=self.u_fault)
+
+            state_next = self.state_traj[:, k + 1, :]
+
+            if self.method == "euler":
+                if self.f_out:
+                    fx = self.dynamics._f(state, self.params, out=self.fx)
+                else:
+                    fx = self.dynamics._f(state, self.params)
+                gx = self.dynamics._g(state, self.params)
+
+                torch.baddbmm(fx, gx, u.unsqueeze(2), out=self.xdot)
+                torch.add(state, self.xdot.reshape(bs, n_dims), alpha=self.dt,
+                          out=self.state_traj_no_fault[:, k + 1, :])
+
+                if faulty:
+                    torch.baddbmm(fx, gx, self.u_fault.unsqueeze(2), out=self.xdot)
+
+                torch.add(state, self.xdot.reshape(bs, n_dims), alpha=self.dt, out=state_next)
+            else:
+                self.state_traj_no_fault[:, k + 1, :] = self.dynamics.step(state, u, self.dt, self.params,
+                                                                           method=self.method)
+                state_next.copy_(self.dynamics.step(state, self.u_fault if faulty else u, self.dt, self.params,
+                                                    method=self.method))
+
+            self.dynamics.clamp_state(state_next, out=state_next)
+
+        return self.state_traj, self.state_traj_no_fault, self.u_traj
+
+
+class ClosedLoopStep(object):
+    """
+    One step of the closed loop used by the evaluation scripts
+
+        u = u_nominal(x), x_next = clamp(x + dt * (f(x) + g(x) * gain * u))
+
+    followed by an optional forward pass of a gamma network on the last window.
+
+    Each of these is a chain of small ops, so at small batch sizes the step is
+    dominated by the Python dispatch overhead. mode selects how it is evaluated:
+        "eager": plain PyTorch
+        "compile": the whole step goes through torch.compile
+        "script": the gamma network is compiled with torch.jit.script, the dynamics stay
+                  eager since they are not scriptable
+    If compiling fails, or the compiled step fails where the eager one does not, the
+    step falls back to eager with a warning.
+    """
+
+    MODES = ("eager", "compile", "script")
+
+    def __init__(self, dynamics: ControlAffineSystemNew, dt: float, params=None, gamma=None,
+                 mode: str = "eager", **compile_kwargs):
+        """
+        args:
+            dynamics: the system to simulate
+            dt: the timestep
+            params: the parameters passed to the dynamics, None for the nominal ones
+            gamma: optional gamma network called on the window given to __call__
+            mode: one of MODES
+            compile_kwargs: passed to torch.compile
+        """
+        if mode not in ClosedLoopStep.MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+
+        self.dynamics = dynamics
+        self.dt = dt
+        self.params = params
+        self.gamma = gamma
+        self.mode = mode
+
+        self.gamma_fn = gamma
+        self.step_fn = self.step_eager
+
+        try:
+            if mode == "compile":
+                compile_kwargs.setdefault("dynamic", True)
+                self.step_fn = torch.compile(self.step_eager, **compile_kwargs)
+            elif mode == "script" and gamma is not None:
+                self.gamma_fn = torch.jit.script(gamma)
+        except Exception as e:
+            self.fallback(e)
+
+    def fallback(self, e: Exception):
+        warnings.warn(f"Compiling the closed-loop step failed ({e!r}), falling back to eager")
+        self.gamma_fn = self.gamma
+        self.step_fn = self.step_eager
+        self.mode = "eager"
+
+    def step_eager(self, x, goal, fault_gain, gamma_inputs):
+        u = self.dynamics.u_nominal(x, op_point=goal)
+        u_applied = u if fault_gain is None else u * fault_gain
+
+        xdot = self.dynamics.closed_loop_dynamics(x, u_applied, self.params)
+        x_next = self.dynamics.clamp_state(x + self.dt * xdot)
+
+        gamma = None if gamma_inputs is None else self.gamma_fn(*gamma_inputs)
+
+        return x_next, u, gamma
+
+    @torch.no_grad()
+    def __call__(self, x: torch.Tensor, goal: Optional[torch.Tensor] = None,
+                 fault_gain: Optional[torch.Tensor] = None, gamma_inputs=None):
+        """
+        args:
+            x: bs x n_dims states
+            goal: the operating point of u_nominal, None for the goal of the system
+            fault_gain: bs x n_controls gain multiplying the control, see
+                        Rollout.actuator_gain. None for no fault
+            gamma_inputs: tuple of the arguments of the gamma network, e.g. the
+                          (bs, traj_len, y_state) outputs and (bs, traj_len, n_controls)
+                          controls of the last window. None to skip gamma
+        returns:
+            x_next: bs x n_dims next states
+            u: bs x n_controls nominal controls, before the fault
+            gamma: the output of the gamma network, None if gamma_inputs is None
+        """
+        if self.mode == "eager":
+            return self.step_eager(x, goal, fault_gain, gamma_inputs)
+
+        try:
+            return self.step_fn(x, goal, fault_gain, gamma_inputs)
+        except Exception as e:
+            error = e
+
+        # Only fall back if the eager step works, errors of the dynamics or of gamma
+        # themselves are raised as they are
+        gamma_fn, self.gamma_fn = self.gamma_fn, self.gamma
+        try:
+            out = self.step_eager(x, goal, fault_gain, gamma_inputs)
+        except Exception:
+            self.gamma_fn = gamma_fn
+            raise
+        self.fallback(error)
+
+        return out
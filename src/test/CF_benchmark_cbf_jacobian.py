@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import torch
+from torch import nn
+
+sys.path.insert(1, os.path.abspath('..'))
+sys.path.insert(1, os.path.abspath('.'))
+
+from trainer.NNfuncgrad_CF import CBF
+from dynamics.Crazyflie import CrazyFlies
+from trainer import config
+
+# Compares CBF.V_with_jacobian against the previous implementation, which propagated
+# diag_embed(1 - V ** 2) through batched matmuls, and against the jacrev + vmap path.
+
+n_state = 12
+m_control = 4
+
+n_repeat = 20
+
+nominal_params = config.CRAZYFLIE_PARAMS
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+x0 = torch.zeros(1, n_state)
+
+dynamics = CrazyFlies(x=x0, goal=x0, nominal_params=nominal_params, dt=0.01)
+
+cbf = CBF(dynamics, n_state=n_state, m_control=m_control).to(device)
+cbf.eval()
+
+
+def V_with_jacobian_diag_embed(cbf, x):
+    bs = x.shape[0]
+    x_norm = x.reshape(bs, cbf.n_state)
+    su, sl = cbf.dynamics.state_limits()
+    safe_m, safe_l = cbf.dynamics.safe_limits(su, sl)
+    safe_m = safe_m.to(x.device)
+    safe_l = safe_l.to(x.device)
+
+    x_norm, x_range = cbf.normalize(x_norm, safe_m, safe_l)
+    x_range = x_range.reshape(cbf.dynamics.n_dims)
+    x_norm = x_norm.reshape(bs, cbf.n_state)
+
+    JV = torch.zeros((bs, cbf.dynamics.n_dims, cbf.dynamics.n_dims)).type_as(x)
+
+    for dim in range(cbf.dynamics.n_dims):
+        JV[:, dim, dim] = 1.0 / x_range[dim].type_as(x)
+
+    V = x_norm
+    for layer in cbf.V_nn:
+        V = layer(V)
+
+        if isinstance(layer, nn.Linear):
+            JV = torch.matmul(layer.weight, JV)
+        elif isinstance(layer, nn.Tanh):
+            JV = torch.matmul(torch.diag_embed(1 - V ** 2), JV)
+        elif isinstance(layer, nn.ReLU):
+            JV = torch.matmul(torch.diag_embed(torch.sign(V)), JV)
+
+    return V, JV
+
+
+def timeit(func, x):
+    func(x)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(n_repeat):
+        func(x)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_repeat
+
+
+sm, sl = dynamics.state_limits()
+
+with torch.no_grad():
+    for bs in [1, 1000, 10000]:
+        x = (sl + (sm - sl) * torch.rand(bs, n_state)).to(device)
+
+        V_ref, JV_ref = V_with_jacobian_diag_embed(cbf, x)
+        V, JV = cbf.V_with_jacobian(x)
+        V_rev, JV_rev = cbf.V_with_jacobian(x, use_jacrev=True)
+
+        print("bs", bs)
+        print("  fused  : bit-identical V", torch.equal(V, V_ref), "JV", torch.equal(JV, JV_ref))
+        print("  jacrev : max |dJV|", (JV_rev - JV_ref).abs().max().item())
+
+        t_ref = timeit(lambda x: V_with_jacobian_diag_embed(cbf, x), x)
+        t_fused = timeit(cbf.V_with_jacobian, x)
+        t_rev = timeit(lambda x: cbf.V_with_jacobian(x, use_jacrev=True), x)
+
+        print("  diag_embed {:.3f} ms, fused {:.3f} ms, jacrev {:.3f} ms".format(1e3 * t_ref, 1e3 * t_fused,
+                                                                               1e3 * t_rev))
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(1, os.path.abspath('..'))
+sys.path.insert(1, os.path.abspath('.'))
+
+from dynamics.Crazyflie import CrazyFlies
+from dynamics.rollout import ClosedLoopStep, Rollout
+from trainer import config
+from trainer.NNfuncgrad_CF import Gamma_linear_deep_nonconv_output
+
+# CPU latency of one closed-loop step (u_nominal, dynamics, Euler, clamp and the gamma
+# forward on the last window) in the eager, compiled and scripted modes of
+# ClosedLoopStep, and the deviation of the compiled steps from the eager one.
+
+n_state = 12
+m_control = 4
+y_state = 6
+
+traj_len = config.TRAJ_LEN
+
+dt = 0.001
+
+n_repeat = 50
+
+nominal_params = config.CRAZYFLIE_PARAMS
+
+ind_y = torch.tensor([1, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 1]).bool()
+
+xg = torch.tensor([[0.0, 0.0, 3.5, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]])
+
+dynamics = CrazyFlies(x=xg, goal=xg, nominal_params=nominal_params, dt=dt)
+
+gamma = Gamma_linear_deep_nonconv_output(y_state=y_state, m_control=m_control, traj_len=traj_len, model_factor=1)
+gamma.eval()
+
+steps = {mode: ClosedLoopStep(dynamics, dt, nominal_params, gamma, mode=mode) for mode in ClosedLoopStep.MODES}
+
+
+def timeit(step, *args):
+    for _ in range(3):
+        step(*args)
+    start = time.time()
+    for _ in range(n_repeat):
+        step(*args)
+    return (time.time() - start) / n_repeat
+
+
+for bs in [1, 1000, 10000]:
+    x = dynamics.sample_safe(bs)
+    fault_gain = Rollout.actuator_gain(bs, m_control, 0, 0.5)
+    y = torch.randn(bs, traj_len, 2 * y_state)
+    u = torch.randn(bs, traj_len, m_control)
+
+    x_ref, u_ref, gamma_ref = steps["eager"](x, xg, fault_gain, (y, u))
+
+    print("bs", bs)
+    for mode, step in steps.items():
+        x_next, u_next, gamma_next = step(x, xg, fault_gain, (y, u))
+        elapsed = timeit(step, x, xg, fault_gain, (y, u))
+        print("  {:7s} {:8.3f} ms, max |dx| {:.1e}, max |dgamma| {:.1e}{}".format(
+            mode, 1e3 * elapsed, (x_next - x_ref).abs().max().item(), (gamma_next - gamma_ref).abs().max().item(),
+            "" if step.mode == mode else " (fell back to eager)"))
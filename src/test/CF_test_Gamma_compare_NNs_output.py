@@ -11,9 +11,10 @@ sys.path.insert(1, os.path.abspath('.'))
 
 from pytictoc import TicToc
 from dynamics.Crazyflie import CrazyFlies
-from trainer import config
+from trainer import checkpoints, config
 from trainer.utils import Utils
-from trainer.NNfuncgrad_CF import CBF, Gamma_linear_deep_nonconv_output, Gamma_linear_LSTM_output
+from trainer.NNfuncgrad_CF import CBF, GammaEnsemble, Gamma_linear_deep_nonconv_output, Gamma_linear_LSTM_output, \
+    Gamma_TCN_output
 
 xg = torch.tensor([[0.0,
                     0.0,
@@ -104,22 +105,7 @@ def main(args):
                 fault_control_index=fault_control_index)
     cbf = CBF(dynamics=dynamics, n_state=n_state, m_control=m_control, fault=fault,
             fault_control_index=fault_control_index)
-    try:
-        if gpu_id >= 0:
-            cbf.load_state_dict(torch.load('./supercloud_data/CF_cbf_NN_weightsCBF_with_u.pth'))
-        else:
-            cbf.load_state_dict(torch.load('./supercloud_data/CF_cbf_NN_weightsCBF_with_u.pth', map_location=torch.device('cpu')))
-    except:
-        try:
-            if gpu_id >= 0:
-                cbf.load_state_dict(torch.load('./good_data/data/CF_cbf_NN_weightsCBF_with_u.pth'))
-            else:
-                cbf.load_state_dict(torch.load('./good_data/data/CF_cbf_NN_weightsCBF_with_u.pth', map_location=torch.device('cpu')))
-        except:
-            if gpu_id >= 0:
-                cbf.load_state_dict(torch.load('./data/CF_cbf_NN_weightsCBF_with_u.pth'))
-            else:
-                cbf.load_state_dict(torch.load('./data/CF_cbf_NN_weightsCBF_with_u.pth', map_location=torch.device('cpu')))
+    checkpoints.load(cbf, 'CF_cbf_NN_weightsCBF_with_u.pth', 'cpu')
     
     cbf.eval()
 
@@ -140,153 +126,127 @@ def main(args):
     if use_saved_data == 0:
         print('Generating new accuracy data')
 
+        # All the networks are evaluated on the same rollouts, simulated once
+        gammas = []
+        gamma_iters = []
         for gamma_iter in range(3):
             if gamma_iter == 0:
                 gamma_type = 'LSTM'
             elif gamma_iter == 1:
                 gamma_type = 'deep'
             else:
-                NotImplementedError
-            if rates == 0:
-                if gamma_type == 'LSTM':
-                    str_data = './data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                    str_good_data = './good_data/data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                    str_supercloud_data = './supercloud_data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                elif gamma_type == 'deep':
-                    str_data = './data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                    str_good_data = './good_data/data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                    str_supercloud_data = './supercloud_data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                else:
-                    NotImplementedError
-            else:
-                if gamma_type == 'LSTM':
-                    str_data = './data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
-                    str_good_data = './good_data/data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
-                elif gamma_type == 'deep':
-                    str_data = './data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
-                    str_good_data = './good_data/data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
-                else:
-                    NotImplementedError
+                gamma_type = 'TCN'
             
             if gamma_type == 'deep':
                 gamma = Gamma_linear_deep_nonconv_output(y_state=y_state, m_control=m_control, traj_len=traj_len, model_factor=model_factor)
             elif gamma_type == 'LSTM':
                 gamma = Gamma_linear_LSTM_output(y_state=y_state, m_control=m_control, model_factor=model_factor)
             else:
-                NotImplementedError
+                gamma = Gamma_TCN_output(y_state=y_state, m_control=m_control, model_factor=model_factor)
             
-            if use_good == 1:
-                try:
-                    if gpu_id == -1:
-                        gamma.load_state_dict(torch.load(str_supercloud_data, map_location=torch.device('cpu')))
-                    else:
-                        gamma.load_state_dict(torch.load(str_supercloud_data))
-                except:
-                    try:
-                        if gpu_id == -1:
-                            gamma.load_state_dict(torch.load(str_good_data, map_location=torch.device('cpu')))
-                        else:
-                            gamma.load_state_dict(torch.load(str_good_data))
-                    except:
-                        if gpu_id == -1:
-                            gamma.load_state_dict(torch.load(str_data, map_location=torch.device('cpu')))
-                        else:
-                            gamma.load_state_dict(torch.load(str_data))
-                        print("No good data available")
-            else:
-                gamma.load_state_dict(torch.load(str_data))
+            try:
+                if use_good == 1:
+                    checkpoints.load_gamma(gamma, y_state, model_factor, rates, device=device)
+                else:
+                    checkpoints.load_gamma(gamma, y_state, model_factor, rates, device=device, dirs=('./data',))
+            except FileNotFoundError:
+                if gamma_type != 'TCN':
+                    raise
+                # The TCN is optional, its row of acc_final stays empty
+                print("No trained TCN available")
+                continue
             
             gamma.eval()
 
-            gamma_actual_bs = torch.ones(n_sample_iter, m_control)
+            gammas.append(gamma)
+            gamma_iters.append(gamma_iter)
 
-            for j in range(n_sample_iter):
-                temp_var = np.mod(j, 5)
-                if temp_var < 4:
-                    gamma_actual_bs[j, temp_var] = 0.0
+        gamma_ensemble = GammaEnsemble(gammas, vectorize=use_cuda)
 
-            
-            rand_ind = torch.randperm(n_sample_iter)
+        gamma_actual_bs = torch.ones(n_sample_iter, m_control)
 
-            gamma_actual_bs = gamma_actual_bs[rand_ind, :]
+        for j in range(n_sample_iter):
+            temp_var = np.mod(j, 5)
+            if temp_var < 4:
+                gamma_actual_bs[j, temp_var] = 0.0
 
-            state0 = dynamics.sample_safe(n_sample_iter)
+        
+        rand_ind = torch.randperm(n_sample_iter)
 
-            state_traj = torch.zeros(n_sample_iter, Eval_steps, n_state) 
+        gamma_actual_bs = gamma_actual_bs[rand_ind, :]
 
-            state_traj_diff = state_traj.clone()   
+        state0 = dynamics.sample_safe(n_sample_iter)
 
-            u_traj = torch.zeros(n_sample_iter, Eval_steps, m_control)
-            
-            state = state0.clone()
+        state_traj = torch.zeros(n_sample_iter, Eval_steps, n_state) 
 
-            state_no_fault = state.clone()
+        state_traj_diff = state_traj.clone()   
 
-            for k in range(n_state):
-                if k > 5:
-                    state[:, k] = torch.clamp(state[:, k], sm[k] / 10, sl[k] / 10)
-            
-            u_nominal = dynamics.u_nominal(state)
-            
-            t.tic()
+        u_traj = torch.zeros(n_sample_iter, Eval_steps, m_control)
+        
+        state = state0.clone()
 
-            # print('length of failure, acc fail , acc no fail')
+        state_no_fault = state.clone()
 
-            new_goal = dynamics.sample_safe(1)
+        for k in range(n_state):
+            if k > 5:
+                state[:, k] = torch.clamp(state[:, k], sm[k] / 10, sl[k] / 10)
+        
+        u_nominal = dynamics.u_nominal(state)
+        
+        t.tic()
 
-            new_goal = new_goal.reshape(n_state, 1)
+        # print('length of failure, acc fail , acc no fail')
 
-            for k in range(Eval_steps):
+        new_goal = dynamics.sample_safe(1)
 
-                u_nominal = dynamics.u_nominal(state, op_point=new_goal)
+        new_goal = new_goal.reshape(n_state, 1)
 
-                fx = dynamics._f(state, params=nominal_params)
-                gx = dynamics._g(state, params=nominal_params)
+        for k in range(Eval_steps):
 
-                if use_nom == 0:
-                    h, grad_h = cbf.V_with_jacobian(state.reshape(n_sample_iter, n_state, 1))
-                    u = util.fault_controller(u_nominal, fx, gx, h, grad_h)
-                else:
-                    u = u_nominal.clone()
+            u_nominal = dynamics.u_nominal(state, op_point=new_goal)
 
-                state_traj[:, k, :] = state.clone()
+            fx = dynamics._f(state, params=nominal_params)
+            gx = dynamics._g(state, params=nominal_params)
 
-                state_traj_diff[:, k, :] = state_no_fault.clone() - state.clone()
-                        
-                u_traj[:, k, :] = u.clone()
+            if use_nom == 0:
+                h, grad_h = cbf.V_with_jacobian(state.reshape(n_sample_iter, n_state, 1))
+                u = util.fault_controller(u_nominal, fx, gx, h, grad_h)
+            else:
+                u = u_nominal.clone()
 
-                gxu_no_fault = torch.matmul(gx, u.reshape(n_sample, m_control, 1))
-                
-                if k >= traj_len - 1:
-                    u = u * gamma_actual_bs
-                
-                gxu = torch.matmul(gx, u.reshape(n_sample_iter, m_control, 1))
+            state_traj[:, k, :] = state.clone()
 
-                dx = fx.reshape(n_sample_iter, n_state) + gxu.reshape(n_sample_iter, n_state)
+            state_traj_diff[:, k, :] = state_no_fault.clone() - state.clone()
+                    
+            u_traj[:, k, :] = u.clone()
 
-                dx_no_fault = fx.reshape(n_sample, n_state) + gxu_no_fault.reshape(n_sample, n_state)
+            gxu_no_fault = torch.matmul(gx, u.reshape(n_sample, m_control, 1))
             
-                state_no_fault = state.clone() + dx_no_fault * dt
-
-                state = state.clone() + dx * dt
+            if k >= traj_len - 1:
+                u = u * gamma_actual_bs
             
-                for j2 in range(n_state):
-                    ind_sm = state[:, j2] > sm[j2]
-                    if torch.sum(ind_sm) > 0:
-                        state[ind_sm, j2] = sm[j2].repeat(torch.sum(ind_sm),)
-                    ind_sl = state[:, j2] < sl[j2]
-                    if torch.sum(ind_sl) > 0:
-                        state[ind_sl, j2] = sl[j2].repeat(torch.sum(ind_sl),)
-
-                if k >= traj_len - 1:
+            gxu = torch.matmul(gx, u.reshape(n_sample_iter, m_control, 1))
+
+            dx = fx.reshape(n_sample_iter, n_state) + gxu.reshape(n_sample_iter, n_state)
+
+            dx_no_fault = fx.reshape(n_sample, n_state) + gxu_no_fault.reshape(n_sample, n_state)
+        
+            state_no_fault = state.clone() + dx_no_fault * dt
+
+            state = state.clone() + dx * dt
+        
+            state = dynamics.clamp_state(state)
+
+            if k >= traj_len - 1:
+                with torch.no_grad():
                     if model_factor == 0:
-                        gamma_NN = gamma(state_traj[:, k - traj_len + 1:k + 1, ind_y].to(device), u_traj[:, k - traj_len + 1:k + 1, :].to(device))
+                        gamma_NN = gamma_ensemble(state_traj[:, k - traj_len + 1:k + 1, ind_y].to(device), u_traj[:, k - traj_len + 1:k + 1, :].to(device))
                     else:
                         state_data = torch.cat((state_traj[:, k - traj_len + 1:k + 1, ind_y], state_traj_diff[:, k-traj_len + 1:k+1, ind_y]), dim=-1)
-                        gamma_NN = gamma(state_data.to(device), u_traj[:, k - traj_len + 1:k + 1, :].to(device))
-
-                    gamma_pred = gamma_NN.reshape(n_sample_iter, m_control).clone().detach()
+                        gamma_NN = gamma_ensemble(state_data.to(device), u_traj[:, k - traj_len + 1:k + 1, :].to(device))
 
+                for gamma_iter, gamma_pred in zip(gamma_iters, gamma_NN.cpu()):
+                    gamma_pred = gamma_pred.reshape(n_sample_iter, m_control)
 
                     acc_ind = torch.zeros(1, m_control * 2)
 
@@ -330,11 +290,15 @@ def main(args):
 
     colors = ['b', 'g', 'r', 'c', 'm', 'y', 'k', 'w']
 
-    for gamma_iter in range(2):
+    for gamma_iter in range(3):
         if gamma_iter == 0:
             gamma_type = 'LSTM'
         elif gamma_iter == 1:
             gamma_type = 'Linear MLP'
+        else:
+            gamma_type = 'TCN'
+            if not acc_final[gamma_iter].any():
+                continue
 
 
         acc_fail = acc_final[gamma_iter, 0, :]
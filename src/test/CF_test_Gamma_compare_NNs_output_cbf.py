@@ -11,7 +11,7 @@ sys.path.insert(1, os.path.abspath('.'))
 
 from pytictoc import TicToc
 from dynamics.Crazyflie import CrazyFlies
-from trainer import config
+from trainer import checkpoints, config
 from trainer.utils import Utils
 from trainer.NNfuncgrad_CF import CBF, Gamma_linear_deep_nonconv_output, Gamma_linear_LSTM_output
 
@@ -113,22 +113,7 @@ def main(args):
                     fault_control_index=fault_control_index)
         cbf = CBF(dynamics=dynamics, n_state=n_state, m_control=m_control, fault=fault,
                 fault_control_index=fault_control_index)
-        try:
-            if gpu_id >= 0:
-                cbf.load_state_dict(torch.load('./supercloud_data/CF_cbf_NN_weightsCBF_with_u.pth'))
-            else:
-                cbf.load_state_dict(torch.load('./supercloud_data/CF_cbf_NN_weightsCBF_with_u.pth', map_location=torch.device('cpu')))
-        except:
-            try:
-                if gpu_id >= 0:
-                    cbf.load_state_dict(torch.load('./good_data/data/CF_cbf_NN_weightsCBF_with_u.pth'))
-                else:
-                    cbf.load_state_dict(torch.load('./good_data/data/CF_cbf_NN_weightsCBF_with_u.pth', map_location=torch.device('cpu')))
-            except:
-                if gpu_id >= 0:
-                    cbf.load_state_dict(torch.load('./data/CF_cbf_NN_weightsCBF_with_u.pth'))
-                else:
-                    cbf.load_state_dict(torch.load('./data/CF_cbf_NN_weightsCBF_with_u.pth', map_location=torch.device('cpu')))
+        checkpoints.load(cbf, 'CF_cbf_NN_weightsCBF_with_u.pth', 'cpu')
         
         cbf.eval()
 
@@ -138,26 +123,6 @@ def main(args):
         for gamma_iter in tqdm.trange(2):
             for i in range(2):
                 model_factor = i
-                if rates == 0:
-                    if gamma_type == 'LSTM':
-                        str_data = './data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                        str_good_data = './good_data/data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                        str_supercloud_data = './supercloud_data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                    elif gamma_type == 'deep':
-                        str_data = './data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                        str_good_data = './good_data/data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                        str_supercloud_data = './supercloud_data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_sigmoid.pth'
-                    else:
-                        NotImplementedError
-                else:
-                    if gamma_type == 'LSTM':
-                        str_data = './data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
-                        str_good_data = './good_data/data/CF_gamma_LSTM_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
-                    elif gamma_type == 'deep':
-                        str_data = './data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
-                        str_good_data = './good_data/data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
-                    else:
-                        NotImplementedError
                 if i == 0:
                     if gamma_type == 'deep':
                         gamma1 = Gamma_linear_deep_nonconv_output(y_state=y_state, m_control=m_control, traj_len=traj_len, model_factor=i)
@@ -167,25 +132,9 @@ def main(args):
                         NotImplementedError
                 
                     if use_good == 1:
-                        try:
-                            if gpu_id == -1:
-                                gamma1.load_state_dict(torch.load(str_supercloud_data, map_location=torch.device('cpu')))
-                            else:
-                                gamma1.load_state_dict(torch.load(str_supercloud_data))
-                        except:
-                            try:
-                                if gpu_id == -1:
-                                    gamma1.load_state_dict(torch.load(str_good_data, map_location=torch.device('cpu')))
-                                else:
-                                    gamma1.load_state_dict(torch.load(str_good_data))
-                            except:
-                                if gpu_id == -1:
-                                    gamma1.load_state_dict(torch.load(str_data, map_location=torch.device('cpu')))
-                                else:
-                                    gamma1.load_state_dict(torch.load(str_data))
-                                print("No good data available")
+                        checkpoints.load_gamma(gamma1, y_state, model_factor, rates, device=device)
                     else:
-                        gamma1.load_state_dict(torch.load(str_data))
+                        checkpoints.load_gamma(gamma1, y_state, model_factor, rates, device=device, dirs=('./data',))
                     
                     gamma1.eval().to(device)
                 else:
@@ -197,25 +146,9 @@ def main(args):
                         NotImplementedError
                 
                     if use_good == 1:
-                        try:
-                            if gpu_id == -1:
-                                gamma2.load_state_dict(torch.load(str_supercloud_data, map_location=torch.device('cpu')))
-                            else:
-                                gamma2.load_state_dict(torch.load(str_supercloud_data))
-                        except:
-                            try:
-                                if gpu_id == -1:
-                                    gamma2.load_state_dict(torch.load(str_good_data, map_location=torch.device('cpu')))
-                                else:
-                                    gamma2.load_state_dict(torch.load(str_good_data))
-                            except:
-                                if gpu_id == -1:
-                                    gamma2.load_state_dict(torch.load(str_data, map_location=torch.device('cpu')))
-                                else:
-                                    gamma2.load_state_dict(torch.load(str_data))
-                                print("No good data available")
+                        checkpoints.load_gamma(gamma2, y_state, model_factor, rates, device=device)
                     else:
-                        gamma2.load_state_dict(torch.load(str_data))
+                        checkpoints.load_gamma(gamma2, y_state, model_factor, rates, device=device, dirs=('./data',))
                     
                     gamma2.eval().to(device)
             # if gamma_iter == 0 or gamma_iter == 2:
@@ -320,13 +253,7 @@ def main(args):
 
                 state = state.clone() + dx * dt
             
-                for j2 in range(n_state):
-                    ind_sm = state[:, j2] > sm[j2]
-                    if torch.sum(ind_sm) > 0:
-                        state[ind_sm, j2] = sm[j2].repeat(torch.sum(ind_sm),)
-                    ind_sl = state[:, j2] < sl[j2]
-                    if torch.sum(ind_sl) > 0:
-                        state[ind_sl, j2] = sl[j2].repeat(torch.sum(ind_sl),)
+                state = dynamics.clamp_state(state)
 
                 if k >= traj_len - 1:
                     for model_iter in range(2):
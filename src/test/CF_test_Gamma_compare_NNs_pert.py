@@ -11,7 +11,7 @@ sys.path.insert(1, os.path.abspath('.'))
 
 from pytictoc import TicToc
 from dynamics.Crazyflie import CrazyFlies
-from trainer import config
+from trainer import checkpoints, config
 from trainer.utils import Utils
 from trainer.NNfuncgrad_CF import Gamma, CBF, Gamma_linear_LSTM, Gamma_linear_conv, Gamma_linear_deep_nonconv, Gamma_linear_nonconv, Gamma_linear_LSTM_old, Gamma_linear_LSTM_small
 
@@ -115,7 +115,7 @@ def main(args):
         cbf = CBF(dynamics=dynamics, n_state=n_state, m_control=m_control, fault=fault,
                 fault_control_index=fault_control_index)
 
-        cbf.load_state_dict(torch.load('./supercloud_data/CF_cbf_NN_weightsCBF_with_u.pth'))
+        checkpoints.load(cbf, 'CF_cbf_NN_weightsCBF_with_u.pth', 'cpu', dirs=('./supercloud_data',))
         cbf.eval()
         # if gamma_iter == 0:
         #     gamma_type = 'LSTM'
@@ -126,34 +126,6 @@ def main(args):
         # else:
         #     gamma_type = 'old'
 
-        if gamma_type == 'LSTM':
-            str_data = './data/CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM_new.pth'
-            str_good_data = './good_data/data/CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM_new.pth'
-            str_supercloud_data = './supercloud_data/CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM_new.pth'
-        elif gamma_type == 'LSTM old':
-            str_data = './data/CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM.pth'
-            str_good_data = './good_data/data/CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM.pth'
-            str_supercloud_data = './supercloud_data/CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM.pth'
-        elif gamma_type == 'LSTM small':
-            str_data = './data/CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM_small.pth'
-            str_good_data = './good_data/data/CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM_small.pth'
-            str_supercloud_data = './supercloud_data/CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM_small.pth'
-        elif gamma_type == 'linear nonconv':
-            str_data = './data/CF_gamma_NN_class_linear_ALL_faults_no_res.pth'
-            str_good_data = './good_data/data/CF_gamma_NN_class_linear_ALL_faults_no_res.pth'
-            str_supercloud_data = './supercloud_data/CF_gamma_NN_class_linear_ALL_faults_no_res.pth'
-        elif gamma_type == 'deep':
-            str_data = './data/CF_gamma_NN_class_linear_ALL_faults_no_res_non_conv_deep.pth'
-            str_good_data = './good_data/data/CF_gamma_NN_class_linear_ALL_faults_no_res_non_conv_deep.pth'
-            str_supercloud_data = './supercloud_data/CF_gamma_NN_class_linear_ALL_faults_no_res_non_conv_deep.pth'
-        elif gamma_type == 'linear conv':
-            str_data = './data/CF_gamma_NN_class_linear_ALL_faults.pth'
-            str_good_data = './good_data/data/CF_gamma_NN_class_linear_ALL_faults.pth'
-            str_supercloud_data = './supercloud_data/CF_gamma_NN_class_linear_ALL_faults.pth'
-        else:
-            str_data = './data/CF_gamma_NN_weightssingle1.pth'
-            str_good_data = './good_data/data/CF_gamma_NN_weightssingle1.pth'
-        
         if gamma_type == 'linear nonconv':
             gamma = Gamma_linear_nonconv(n_state=n_state, m_control=m_control, traj_len=traj_len)
         elif gamma_type == 'deep':
@@ -169,26 +141,15 @@ def main(args):
         else:
             gamma = Gamma(n_state=n_state, m_control=m_control, traj_len=traj_len)
 
+        if gamma_type == 'old':
+            gamma_file = 'CF_gamma_NN_weightssingle1.pth'
+        else:
+            gamma_file = checkpoints.CheckpointKey(type(gamma))
+
         if use_good == 1:
-            try:
-                if gpu_id == -1:
-                    gamma.load_state_dict(torch.load(str_supercloud_data, map_location=torch.device('cpu')))
-                else:
-                    gamma.load_state_dict(torch.load(str_supercloud_data))
-            except:
-                try:
-                    if gpu_id == -1:
-                        gamma.load_state_dict(torch.load(str_good_data, map_location=torch.device('cpu')))
-                    else:
-                        gamma.load_state_dict(torch.load(str_good_data))
-                except:
-                    if gpu_id == -1:
-                        gamma.load_state_dict(torch.load(str_data, map_location=torch.device('cpu')))
-                    else:
-                        gamma.load_state_dict(torch.load(str_data))
-                    print("No good data available")
+            checkpoints.load(gamma, gamma_file, 'cpu')
         else:
-            gamma.load_state_dict(torch.load(str_data))
+            checkpoints.load(gamma, gamma_file, 'cpu', dirs=('./data',))
         
         gamma.eval()
             
@@ -269,13 +230,7 @@ def main(args):
 
             state_no_fault = state.clone() + dx_no_fault * dt 
         
-            for j2 in range(n_state):
-                ind_sm = state[:, j2] > sm[j2]
-                if torch.sum(ind_sm) > 0:
-                    state[ind_sm, j2] = sm[j2].repeat(torch.sum(ind_sm),)
-                ind_sl = state[:, j2] < sl[j2]
-                if torch.sum(ind_sl) > 0:
-                    state[ind_sl, j2] = sl[j2].repeat(torch.sum(ind_sl),)
+            state = dynamics.clamp_state(state)
 
             if k >= traj_len - 1:
                 
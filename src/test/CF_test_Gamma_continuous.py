@@ -153,13 +153,7 @@ def main(args):
 
         state = state.clone() + dx * dt + torch.randn(n_sample, n_state) * dt
 
-        for j2 in range(n_state):
-            ind_sm = state[:, j2] > sm[j2]
-            if torch.sum(ind_sm) > 0:
-                state[ind_sm, j2] = sm[j2].repeat(torch.sum(ind_sm),)
-            ind_sl = state[:, j2] < sl[j2]
-            if torch.sum(ind_sl) > 0:
-                state[ind_sl, j2] = sl[j2].repeat(torch.sum(ind_sl),)
+        state = dynamics.clamp_state(state)
         
         if k >= traj_len - 1:
             # if np.mod(k + 1, traj_len) > 0:
@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import torch
+import argparse
+
+sys.path.insert(1, os.path.abspath('..'))
+sys.path.insert(1, os.path.abspath('.'))
+
+from dynamics.Crazyflie import CrazyFlies
+from dynamics.rollout import Rollout
+from trainer import checkpoints, config
+from trainer.NNfuncgrad_CF import Gamma_linear_LSTM_output, Gamma_linear_GRU_output, Gamma_linear_LSTM_output_single, \
+    Gamma_linear_deep_nonconv_output, Gamma_linear_deep_nonconv_output_single, Gamma_TCN_output
+
+# Compares the streaming evaluation of the gamma networks, step() fed one control step at
+# a time, and stream() over whole trajectories, with the windowed evaluation of the test
+# scripts, which re-runs the network on the last traj_len steps at every step. Both see
+# the same inputs up to step traj_len - 1 and must agree there. Afterwards the recurrent
+# networks also remember the steps before the window, while the deep networks
+# (WindowedGamma) and the TCN, whose receptive field is shorter than the window, must
+# keep agreeing up to float rounding. The deviation and the fraction
+# of fault decisions (gamma < 0.5) that differ are reported along with the cost per step.
+
+xg = torch.tensor([[0.0, 0.0, 5.5, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]])
+
+x0 = torch.tensor([[2.0, 2.0, 3.1, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]])
+
+y_state = 6
+
+m_control = 4
+
+nominal_params = config.CRAZYFLIE_PARAMS
+
+traj_len = 100
+
+ind_y = torch.tensor([1, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 1]).bool()
+
+
+def rollout_outputs(dynamics, n_sample, dt, fault_index):
+    """Outputs and controls of rollouts with a fault on fault_index after traj_len steps"""
+    rollout = Rollout(dynamics, 3 * traj_len, dt, nominal_params)
+    x_init = dynamics.sample_safe(n_sample)
+    goal = dynamics.sample_safe(1)
+    fault_gain = Rollout.actuator_gain(n_sample, m_control, fault_index, torch.rand(n_sample))
+
+    state_traj, _, u_traj = rollout.run(x_init, lambda x, k: dynamics.u_nominal(x, op_point=goal),
+                                        fault_gain, fault_start=traj_len)
+
+    return state_traj[:, :-1, ind_y].clone(), u_traj.clone()
+
+
+@torch.no_grad()
+def compare(gamma, y, u):
+    T = y.shape[1]
+
+    start = time.time()
+    gamma_window = torch.stack([gamma(y[:, k - traj_len + 1:k + 1], u[:, k - traj_len + 1:k + 1])
+                                for k in range(traj_len - 1, T)], dim=1)
+    time_window = (time.time() - start) / (T - traj_len + 1)
+
+    hidden = None
+    gamma_stream = []
+    start = time.time()
+    for k in range(T):
+        gamma_k, hidden = gamma.step(y[:, k], u[:, k], hidden)
+        gamma_stream.append(gamma_k)
+    time_stream = (time.time() - start) / T
+    gamma_stream = torch.stack(gamma_stream[traj_len - 1:], dim=1)
+
+    start = time.time()
+    gamma_traj = gamma.stream(y, u)
+    time_traj = (time.time() - start) / T
+    if isinstance(gamma_traj, tuple):
+        gamma_traj = gamma_traj[0]
+    gamma_traj = gamma_traj[:, traj_len - 1:]
+
+    deviation = (gamma_stream - gamma_window).abs()
+    decisions = ((gamma_stream < 0.5) != (gamma_window < 0.5)).float()
+
+    print(type(gamma).__name__)
+    print('  step {}: max deviation {:.1e}'.format(traj_len - 1, deviation[:, 0].max().item()))
+    print('  later steps: mean deviation {:.1e}, max {:.1e}, differing fault decisions {:.2%}'.format(
+        deviation[:, 1:].mean().item(), deviation[:, 1:].max().item(), decisions[:, 1:].mean().item()))
+    print('  stream(): max deviation from step() {:.1e}'.format((gamma_traj - gamma_stream).abs().max().item()))
+    print('  per step: windowed {:.2f} ms, step() {:.2f} ms, stream() {:.3f} ms'.format(
+        1e3 * time_window, 1e3 * time_stream, 1e3 * time_traj))
+
+
+def main(args):
+    dynamics = CrazyFlies(x=x0, goal=xg, nominal_params=nominal_params, dt=args.dt)
+    y, u = rollout_outputs(dynamics, args.n_sample, args.dt, args.fault_index)
+
+    for gamma in [Gamma_linear_LSTM_output(y_state=y_state, m_control=m_control, model_factor=0),
+                  Gamma_linear_GRU_output(y_state=y_state, m_control=m_control, model_factor=0),
+                  Gamma_linear_LSTM_output_single(y_state=y_state, m_control=m_control, model_factor=0),
+                  Gamma_linear_deep_nonconv_output(y_state=y_state, m_control=m_control, traj_len=traj_len,
+                                                   model_factor=0),
+                  Gamma_linear_deep_nonconv_output_single(y_state=y_state, m_control=m_control, traj_len=traj_len,
+                                                          model_factor=0),
+                  Gamma_TCN_output(y_state=y_state, m_control=m_control, model_factor=0)]:
+        try:
+            checkpoints.load_gamma(gamma, y_state, model_factor=0, rates=1)
+        except FileNotFoundError as e:
+            print(f'{e}, using untrained weights')
+        gamma.eval()
+
+        compare(gamma, y, u)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-fault_index', type=int, default=1)
+    parser.add_argument('-n_sample', type=int, default=100)
+    parser.add_argument('--dt', type=float, default=0.002)
+    args = parser.parse_args()
+    main(args)
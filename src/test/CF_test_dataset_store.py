@@ -0,0 +1,101 @@
+import os
+import sys
+import tempfile
+import torch
+
+sys.path.insert(1, os.path.abspath('..'))
+sys.path.insert(1, os.path.abspath('.'))
+
+from trainer.datagen import Dataset_with_Grad, Dataset_windowed
+
+# Reloads the memory-mapped gamma datasets after an add that was interrupted between
+# the appends of its buffers, as by a pre-empted job. The reloaded dataset must drop the
+# rows of the interrupted add from every buffer and sample exactly what the dataset
+# held before it, also when the buffer is full and only the newest rows are sampled.
+# A store whose buffers hold fewer rows than its header records must be rejected.
+
+y_state = 6
+
+m_control = 4
+
+traj_len = 5
+
+n_sample = 4
+
+
+def windows(n):
+    return torch.randn(n, traj_len, y_state), torch.randn(n, traj_len, y_state), \
+        torch.randn(n, traj_len, m_control), torch.rand(n, m_control)
+
+
+def rollouts(n, T=3 * traj_len):
+    return torch.randn(n, T, y_state), torch.randn(n, T, y_state), torch.randn(n, T, m_control), \
+        torch.rand(n, T, m_control)
+
+
+def samples(dataset):
+    dataset.permute_pending = False
+    dataset.permuted_indices = torch.arange(dataset.n_pts)
+    return dataset.sample_data_all(dataset.n_pts, 0)
+
+
+def interrupt(dataset, data, n_buffers, last=False):
+    """Append data to the first n_buffers buffers, or only to the last one, without committing"""
+    buffers = [dataset.buffer_data_s, dataset.buffer_data_s_diff, dataset.buffer_data_u_NN, dataset.buffer_data_u]
+    if isinstance(dataset, Dataset_windowed):
+        # add_traj stores the labels of the windows only
+        data = data[:-1] + (data[-1][:, traj_len - 1:],)
+    if last:
+        buffers[-1].add(data[-1])
+    else:
+        for buffer, x in zip(buffers[:n_buffers], data):
+            buffer.add(x)
+
+
+def check(make, add, make_data, n_add, **kwargs):
+    for n_buffers, last in [(1, False), (3, False), (0, True)]:
+        with tempfile.TemporaryDirectory() as path:
+            dataset = make(path)
+            for _ in range(n_add):
+                add(dataset, *make_data(n_sample))
+            before = samples(dataset)
+
+            interrupt(dataset, make_data(n_sample), n_buffers, last)
+            dataset = make(path)
+            after = samples(dataset)
+
+            assert all(torch.equal(x, y) for x, y in zip(before, after))
+
+            # The reloaded dataset keeps growing consistently
+            add(dataset, *make_data(n_sample))
+            assert make(path).n_pts == dataset.n_pts
+    print(kwargs['name'], 'ok')
+
+
+def make_flat(path):
+    return Dataset_with_Grad(y_state, 2 * y_state, m_control, 0, buffer_size=12, traj_len=traj_len, path=path)
+
+
+def make_windowed(path):
+    return Dataset_windowed(y_state, 2 * y_state, m_control, 0, buffer_size=2 * (2 * traj_len + 1),
+                            traj_len=traj_len, path=path)
+
+
+# Not full, then full with capacity 12 so that only the newest rows are sampled
+check(make_flat, Dataset_with_Grad.add_data, windows, 2, name='Dataset_with_Grad')
+check(make_flat, Dataset_with_Grad.add_data, windows, 5, name='Dataset_with_Grad, full')
+check(make_windowed, Dataset_windowed.add_traj, rollouts, 1, name='Dataset_windowed')
+check(make_windowed, Dataset_windowed.add_traj, rollouts, 3, name='Dataset_windowed, full')
+
+# A buffer that lost recorded rows cannot be repaired
+with tempfile.TemporaryDirectory() as path:
+    dataset = make_flat(path)
+    dataset.add_data(*windows(n_sample))
+    with open(os.path.join(path, 'gamma.bin'), 'r+b') as f:
+        f.truncate(1)
+    try:
+        make_flat(path)
+    except RuntimeError as e:
+        print('truncated buffer rejected:', e)
+    else:
+        raise AssertionError('truncated buffer was not rejected')
@@ -18,7 +18,7 @@ sys.path.insert(1, os.path.abspath("."))
 # from dynamics.fixed_wing_dyn import fw_dyn_ext, fw_dyn
 from dynamics.Crazyflie import CrazyFlies
 from trainer import config
-from trainer.utils import Utils
+from trainer.utils import Utils, QPWorkspace
 from trainer.NNfuncgrad_CF import CBF
 
 xg = torch.tensor([0.0, 0.0, 5.5, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
@@ -127,17 +127,16 @@ def main():
 
     previous_state = state.clone()
 
+    # One warm-started QP workspace per simulated trajectory
+    qp = [QPWorkspace(m_control + 1) for k in range(4)]
+
     for i in tqdm.trange(config.EVAL_STEPS):
         u_temp = torch.zeros(4, m_control)
         h_temp = torch.zeros(4, 1)
         for k in range(4):
             u_nominal = dynamics.u_nominal(state[k, :].reshape(1, n_state), op_point=xg)
 
-            for j in range(n_state):
-                if state[k, j] < sl[j]:
-                    state[k, j] = sl[j].clone()
-                if state[k, j] > sm[j]:
-                    state[k, j] = sm[j].clone()
+            state[k, :] = dynamics.clamp_state(state[k, :])
 
             fx = dynamics._f(state[k, :].reshape(1, n_state), params=nominal_params)
             gx = dynamics._g(state[k, :].reshape(1, n_state), params=nominal_params)
@@ -161,7 +160,7 @@ def main():
                 else:
                     h, grad_h = FT_cbf.V_with_jacobian(state[k, :].reshape(1, n_state, 1))
 
-                u = util.neural_controller(u_nominal, fx, gx, h, grad_h, fault_start)
+                u = util.neural_controller(u_nominal, fx, gx, h, grad_h, fault_start, qp=qp[k])
                 
                 u = u.reshape(1, m_control)
 
@@ -190,7 +189,7 @@ def main():
             else:
                 h, grad_h = NN_cbf.V_with_jacobian(state.reshape(1, n_state, 1))
                 h_prev, _ = NN_cbf.V_with_jacobian(previous_state.reshape(1, n_state, 1))
-                u = util.neural_controller(u_nominal, fx, gx, h, grad_h, fault_start)
+                u = util.neural_controller(u_nominal, fx, gx, h, grad_h, fault_start, qp=qp[k])
 
                 u = u.reshape(1, m_control)
 
@@ -219,7 +218,7 @@ def main():
                     detect = 1
                     h, grad_h = FT_cbf.V_with_jacobian(state.reshape(1, n_state, 1))
 
-                    u = util.neural_controller(u_nominal, fx, gx, h, grad_h, fault_start)
+                    u = util.neural_controller(u_nominal, fx, gx, h, grad_h, fault_start, qp=qp[k])
 
                     u = u.reshape(1, m_control)
 
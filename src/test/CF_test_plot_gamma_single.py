@@ -165,11 +165,7 @@ def main():
 
         u_command = u_nominal.clone()
 
-        for j in range(n_state):
-            if state[0, j] < sl[j]:
-                state[0, j] = sl[j].clone()
-            if state[0, j] > sm[j]:
-                state[0, j] = sm[j].clone()
+        state[0, :] = dynamics.clamp_state(state[0, :])
 
         fx = dynamics._f(state, params=nominal_params)
         gx = dynamics._g(state, params=nominal_params)
@@ -120,11 +120,7 @@ def main():
             #     u_nominal = u_eq.clone() * (1 - torch.linalg.norm(state[0, 2] - goal[0, 2]) / 1000)
             u_nominal = dynamics.u_nominal(state)
 
-            for j in range(n_state):
-                if state[0, j] < sl[j]:
-                    state[0, j] = sl[j].clone()
-                if state[0, j] > sm[j]:
-                    state[0, j] = sm[j].clone()
+            state[0, :] = dynamics.clamp_state(state[0, :])
 
             fx = dynamics._f(state, params=nominal_params)
             gx = dynamics._g(state, params=nominal_params)
@@ -137,11 +137,7 @@ def main():
         for k in range(4):
             u_nominal = dynamics.u_nominal(state[k, :].reshape(1, n_state))
 
-            for j in range(n_state):
-                if state[k, j] < sl[j]:
-                    state[k, j] = sl[j].clone()
-                if state[k, j] > sm[j]:
-                    state[k, j] = sm[j].clone()
+            state[k, :] = dynamics.clamp_state(state[k, :])
 
             fx = dynamics._f(state[k, :].reshape(1, n_state), params=nominal_params)
             gx = dynamics._g(state[k, :].reshape(1, n_state), params=nominal_params)
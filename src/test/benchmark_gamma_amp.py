@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import torch
+from torch import nn
+
+sys.path.insert(1, os.path.abspath('..'))
+sys.path.insert(1, os.path.abspath('.'))
+
+from dynamics.DI_dyn import DI
+from trainer.trainer import Trainer
+from trainer.NNfuncgrad_CF import Gamma_linear_deep_nonconv_output_single, Gamma_linear_LSTM_output_single, Gamma_TCN_output
+
+# Wall-clock and memory of one gamma training step of Trainer in fp32 and in its amp
+# modes: CPU bf16, and GPU bf16 / fp16 when a GPU is available. The step is the one of
+# Trainer.train_gamma_single: forward under Trainer.autocast, fp32 loss, backward and
+# optimizer step through Trainer.gamma_step. The peak memory is only reported on GPU.
+# The last column is the largest deviation of the amp gamma from the fp32 one.
+
+y_state = 6
+
+m_control = 4
+
+traj_len = 100
+
+n_repeat = 5
+
+# (name, constructor, batch size on cpu, batch size on gpu)
+models = [
+    ("deep", lambda: Gamma_linear_deep_nonconv_output_single(y_state=y_state, m_control=m_control,
+                                                             traj_len=traj_len, model_factor=0), 20000, 1000000),
+    ("LSTM", lambda: Gamma_linear_LSTM_output_single(y_state=y_state, m_control=m_control, model_factor=0),
+     2000, 50000),
+    ("TCN", lambda: Gamma_TCN_output(y_state=y_state, m_control=m_control, model_factor=0), 2000, 50000),
+]
+
+
+def make_trainer(gamma, device, amp):
+    x = torch.zeros(1, 2 * m_control)
+    dyn = DI(x=x, goal=x, dt=0.01, dim=m_control, nominal_parameters=[])
+    return Trainer(None, None, None, gamma=gamma, n_state=2 * m_control, m_control=m_control, dyn=dyn, params=None,
+                   traj_len=traj_len, device=device, amp=amp)
+
+
+def train_step(trainer, y, u, gamma_actual, eps=0.01):
+    with trainer.autocast():
+        gamma_data = trainer.gamma_gen(y, u)
+    gamma_data = gamma_data.float()
+
+    loss = 10 * torch.mean(nn.ReLU()(torch.abs(gamma_data - gamma_actual) - eps))
+
+    trainer.gamma_optimizer.zero_grad(set_to_none=True)
+    trainer.gamma_step(loss)
+
+    return gamma_data.detach()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def benchmark(make_gamma, bs, device, amp):
+    torch.manual_seed(0)
+    gamma = make_gamma().to(device)
+    trainer = make_trainer(gamma, device, amp)
+
+    y = torch.randn(bs, traj_len, y_state, device=device)
+    u = torch.randn(bs, traj_len, m_control, device=device)
+    gamma_actual = torch.rand(bs, m_control, device=device)
+
+    # Output of the untrained network, to compare the modes
+    with torch.no_grad(), trainer.autocast():
+        gamma_0 = trainer.gamma_gen(y, u).float()
+
+    train_step(trainer, y, u, gamma_actual)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    synchronize(device)
+    start = time.time()
+    for _ in range(n_repeat):
+        train_step(trainer, y, u, gamma_actual)
+    synchronize(device)
+    elapsed = (time.time() - start) / n_repeat
+
+    memory = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+
+    return gamma_0, elapsed, memory
+
+
+configs = [(torch.device('cpu'), [None, "bf16"])]
+if torch.cuda.is_available():
+    configs.append((torch.device('cuda'), [None, "bf16", "fp16"]))
+
+for device, amps in configs:
+    for name, make_gamma, bs_cpu, bs_gpu in models:
+        bs = bs_cpu if device.type == 'cpu' else bs_gpu
+        print(name, device.type, "bs", bs, "traj_len", traj_len)
+        for amp in amps:
+            gamma_0, elapsed, memory = benchmark(make_gamma, bs, device, amp)
+            if amp is None:
+                gamma_ref = gamma_0
+            print("  {:4s}: {:8.1f} ms/step, peak {:8.1f} MiB, max |gamma - gamma fp32| {:.1e}".format(
+                amp or "fp32", 1e3 * elapsed, memory, (gamma_0 - gamma_ref).abs().max().item()))
@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(1, os.path.abspath('..'))
+sys.path.insert(1, os.path.abspath('.'))
+
+from dynamics.Crazyflie import CrazyFlies
+from dynamics.DI_dyn import DI
+from trainer import config
+
+# Accuracy vs wall-clock of the ControlAffineSystemNew integrators on closed-loop
+# rollouts: the nominal controller runs every controller_dt and its control is held
+# while the dynamics are integrated with steps of size dt. The error of a sample is the
+# maximum deviation of its final state from a tight rk45 reference, relative to the
+# largest reference state, and the median and worst errors over the batch are printed. As in the training
+# scripts, the states are clamped to the state limits after every control step.
+
+torch.set_default_dtype(torch.float64)
+
+n_sample = 100
+
+controller_dt = 0.01
+
+sim_time = 1.0
+
+steps = [0.01, 0.005, 0.002, 0.001]
+
+tolerances = [1e-3, 1e-5, 1e-7]
+
+
+def make_crazyflie():
+    x0 = torch.tensor([[2.0, 2.0, 3.1, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]])
+    xg = torch.tensor([[0.0, 0.0, 3.5, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]])
+    dynamics = CrazyFlies(x=x0, goal=xg, nominal_params=config.CRAZYFLIE_PARAMS, dt=controller_dt)
+    return dynamics, xg, config.CRAZYFLIE_PARAMS
+
+
+def make_di():
+    m_control = 3
+    x0 = torch.zeros(1, 2 * m_control)
+    xg = torch.zeros(1, 2 * m_control)
+    dynamics = DI(x=x0, goal=xg, dt=controller_dt, dim=m_control, nominal_parameters=[])
+    return dynamics, xg, None
+
+
+def rollout(dynamics, xg, params, x, method, dt=None, rtol=1e-6, atol=1e-8):
+    for _ in range(int(round(sim_time / controller_dt))):
+        u = dynamics.u_nominal(x, op_point=xg)
+        if method == "rk45":
+            x = dynamics.step(x, u, controller_dt, params, method=method, rtol=rtol, atol=atol)
+        else:
+            x = dynamics.zero_order_hold(x, u, controller_dt, params, method=method, dt=dt)
+        x = dynamics.clamp_state(x)
+    return x
+
+
+def rel_error(x, x_ref):
+    err = (x - x_ref).abs().max(dim=1)[0] / x_ref.abs().max()
+    return err.median().item(), err.max().item()
+
+
+def timed(func):
+    start = time.time()
+    x = func()
+    return x, time.time() - start
+
+
+with torch.no_grad():
+    for name, make in [("CrazyFlies", make_crazyflie), ("DI", make_di)]:
+        dynamics, xg, params = make()
+        x0 = dynamics.sample_safe(n_sample)
+
+        x_ref = rollout(dynamics, xg, params, x0, "rk45", rtol=1e-9, atol=1e-11)
+
+        print(name, "bs", n_sample, "simulated time", sim_time)
+        for method in ["euler", "rk4"]:
+            for dt in steps:
+                x, elapsed = timed(lambda: rollout(dynamics, xg, params, x0, method, dt=dt))
+                print("  {:5s} dt {:.3f}: rel. error median {:.2e} max {:.2e}, {:8.1f} ms".format(
+                    method, dt, *rel_error(x, x_ref), 1e3 * elapsed))
+        for tol in tolerances:
+            x, elapsed = timed(lambda: rollout(dynamics, xg, params, x0, "rk45", rtol=tol, atol=tol * 1e-2))
+            print("  rk45  tol {:.0e}: rel. error median {:.2e} max {:.2e}, {:8.1f} ms".format(
+                tol, *rel_error(x, x_ref), 1e3 * elapsed))
@@ -11,11 +11,13 @@ sys.path.insert(1, os.path.abspath('.'))
 
 from pytictoc import TicToc
 from dynamics.Crazyflie import CrazyFlies
+from dynamics.rollout import Rollout
 from trainer import config
-from trainer.datagen import Dataset_with_Grad
+from trainer.checkpoints import CheckpointWriter
+from trainer.datagen import Dataset_windowed
 from trainer.trainer import Trainer
 from trainer.utils import Utils
-from trainer.NNfuncgrad_CF import CBF, Gamma_linear_LSTM_output, Gamma_linear_deep_nonconv_output
+from trainer.NNfuncgrad_CF import CBF, Gamma_linear_LSTM_output, Gamma_linear_deep_nonconv_output, Gamma_TCN_output
 
 # import matplotlib.pyplot as plt
 
@@ -118,6 +120,9 @@ def main(args):
     elif gamma_type == 'deep':
         str_data = './data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
         str_good_data = './good_data/data/CF_gamma_deep_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
+    elif gamma_type == 'TCN':
+        str_data = './data/CF_gamma_TCN_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
+        str_good_data = './good_data/data/CF_gamma_TCN_output' + str(y_state) + '_model_' + str(model_factor) + '_rates_sigmoid.pth'
     else:
         NotImplementedError
 
@@ -132,6 +137,8 @@ def main(args):
         gamma = Gamma_linear_deep_nonconv_output(y_state=y_state, m_control=m_control, traj_len=traj_len, model_factor=model_factor)
     elif gamma_type == 'LSTM':
         gamma = Gamma_linear_LSTM_output(y_state=y_state, m_control=m_control, model_factor=model_factor)
+    elif gamma_type == 'TCN':
+        gamma = Gamma_TCN_output(y_state=y_state, m_control=m_control, model_factor=model_factor)
     else:
         NotImplementedError
 
@@ -154,11 +161,12 @@ def main(args):
     cbf.load_state_dict(torch.load('./data/CF_cbf_NN_weightsCBF.pth'))
     cbf.eval()
 
-    dataset = Dataset_with_Grad(y_state=y_state, n_state=n_state, m_control=m_control, train_u=0, buffer_size=n_sample*500, traj_len=traj_len)
+    dataset = Dataset_windowed(y_state=y_state, n_state=n_state, m_control=m_control, train_u=0, buffer_size=n_sample*500, traj_len=traj_len, path=args.dataset_dir)
     trainer = Trainer(cbf, None, dataset, gamma=gamma, n_state=n_state, m_control=m_control, j_const=2, dyn=dynamics,
                       dt=dt, action_loss_weight=0.001, params=nominal_params,
                       fault=fault, gpu_id=gpu_id, num_traj=n_sample, traj_len=traj_len,
-                      fault_control_index=fault_control_index, model_factor=model_factor, device=device)
+                      fault_control_index=fault_control_index, model_factor=model_factor, device=device, amp=args.amp)
+    checkpoint_writer = CheckpointWriter(str_data)
     loss_np = 1.0
     safety_rate = 0.0
 
@@ -166,14 +174,22 @@ def main(args):
 
     device_traj = 'cpu'
 
-    sm, sl = dynamics.state_limits()
+    sm, sl = dynamics.cached_limits("state", device_traj)
 
-    sm = sm.to(device_traj)
-    sl = sl.to(device_traj)
+    rollout = Rollout(dynamics, int(num_traj_factor * traj_len), dt, nominal_params)
 
     ind_y = torch.tensor([1, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1, 1]).bool().to(device_traj)
     
-    for i in range(1000):
+    start = 0
+    if args.resume is not None:
+        checkpoint = torch.load(args.resume, map_location='cpu', weights_only=False)
+        gamma.load_state_dict(checkpoint["model"])
+        trainer.load_state_dict(checkpoint["trainer"])
+        start = checkpoint["iteration"] + 1
+        loss_current = checkpoint["loss_current"]
+        safety_rate = checkpoint["safety_rate"]
+
+    for i in range(start, 1000):
         t.tic()
         
         new_goal = dynamics.sample_safe(1).to(device_traj)
@@ -201,99 +217,28 @@ def main(args):
             if k > 5:
                 state[:, k] = torch.clamp(state[:, k], sm[k] / 10, sl[k] / 10)
                 
-        state_no_fault = state.clone()
+        rollout_traj, rollout_traj_no_fault, u_traj = rollout.run(
+            state, lambda x, k: dynamics.u_nominal(x, op_point=new_goal),
+            fault_gain=gamma_actual_bs, fault_start=traj_len - 1)
 
-        u_nominal = dynamics.u_nominal(state)
-                
-        state_traj = torch.zeros(n_sample, int(num_traj_factor * traj_len), n_state).to(device_traj)
-
-        output_traj = torch.zeros(n_sample, int(num_traj_factor * traj_len), y_state).to(device_traj)
-
-        output_traj_diff = output_traj.clone()
-    
-        state_traj_diff = state_traj.clone()
-
-        u_traj = torch.zeros(n_sample, int(num_traj_factor * traj_len), m_control).to(device_traj)
-
-        for k in range(int(traj_len * num_traj_factor)):
-            
-            u_nominal = dynamics.u_nominal(state, op_point=new_goal)
-
-            fx = dynamics._f(state, params=nominal_params)
-            gx = dynamics._g(state, params=nominal_params)
-
-            u = u_nominal.clone()
-
-            state_traj[:, k, :] = state.clone()
+        state_traj = rollout_traj[:, :-1, :]
 
-            output_traj[:, k, :] = state[:, ind_y].clone()
-            
-            state_traj_diff[:, k, :] = state_no_fault.clone() - state.clone()
+        state_traj_diff = rollout_traj_no_fault[:, :-1, :] - state_traj
 
-            output_traj_diff[:, k, :] = state_no_fault[:, ind_y].clone() - state[:, ind_y].clone()
-            
-            u_traj[:, k, :] = u.clone()
+        output_traj = state_traj[:, :, ind_y]
 
-            gxu_no_fault = torch.matmul(gx, u.reshape(n_sample, m_control, 1))
-
-            if k >= traj_len - 1:
-                u = u * gamma_actual_bs
-            
-            gxu = torch.matmul(gx, u.reshape(n_sample, m_control, 1))
-
-            dx = fx.reshape(n_sample, n_state) + gxu.reshape(n_sample, n_state)
-
-            dx_no_fault = fx.reshape(n_sample, n_state) + gxu_no_fault.reshape(n_sample, n_state)
-            
-            state_no_fault = state.clone() + dx_no_fault * dt 
-
-            state = state.clone() + dx * dt
-            
-            for j2 in range(n_state):
-                ind_sm = state[:, j2] > sm[j2]
-                if torch.sum(ind_sm) > 0:
-                    state[ind_sm, j2] = sm[j2].repeat(torch.sum(ind_sm),)
-                ind_sl = state[:, j2] < sl[j2]
-                if torch.sum(ind_sl) > 0:
-                    state[ind_sl, j2] = sl[j2].repeat(torch.sum(ind_sl),)
-            
-            is_safe = int(torch.sum(util.is_safe(state))) / n_sample
+        output_traj_diff = state_traj_diff[:, :, ind_y]
 
+        # Running safety rate over the states reached at every step
+        safe_steps = util.is_safe(rollout_traj[:, 1:, :].reshape(-1, n_state)).reshape(n_sample, -1).float().mean(dim=0)
+        for is_safe in safe_steps.tolist():
             safety_rate = (i * safety_rate + is_safe) / (i + 1)
 
-            if k >= traj_len -1:
-                if k == traj_len - 1:
-                    dataset.add_data(output_traj[:, k-traj_len + 1:k + 1, :].cpu(), model_factor * output_traj_diff[:, k-traj_len + 1:k + 1, :].cpu(), u_traj[:, k-traj_len + 1:k + 1, :].cpu(), torch.ones(n_sample, m_control))
-                else:
-                    dataset.add_data(output_traj[:, k-traj_len + 1:k + 1, :].cpu(), model_factor * output_traj_diff[:, k-traj_len + 1:k + 1, :].cpu(), u_traj[:, k-traj_len + 1:k + 1, :].cpu(), gamma_actual_bs.cpu())
-                # if k > 1.5 * traj_len:
-                #     plt.figure()
-                #     plt.subplot(3, 4, 1)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 0].T)
-                #     plt.subplot(3, 4, 2)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 1].T)
-                #     plt.subplot(3, 4, 3)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 2].T)
-                #     plt.subplot(3, 4, 4)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 3].T)
-                #     plt.subplot(3, 4, 5)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 4].T)
-                #     plt.subplot(3, 4, 6)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 5].T)
-                #     plt.subplot(3, 4, 7)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 6].T)
-                #     plt.subplot(3, 4, 8)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 7].T)  
-                #     plt.subplot(3, 4, 9)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 8].T)
-                #     plt.subplot(3, 4, 10)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 9].T)
-                #     plt.subplot(3, 4, 11)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 10].T)
-                #     plt.subplot(3, 4, 12)
-                #     plt.plot(state_traj[:, k-traj_len + 1:k + 1, 11].T)
-                #     plt.savefig('test.png')
-                #     print(asas)
+        # Label of the window ending at each step; the fault starts after the first window
+        gamma_traj = gamma_actual_bs.reshape(n_sample, 1, m_control).repeat(1, int(num_traj_factor * traj_len), 1)
+        gamma_traj[:, :traj_len, :] = 1.0
+
+        dataset.add_traj(output_traj.cpu(), model_factor * output_traj_diff.cpu(), u_traj.cpu(), gamma_traj.cpu())
 
         loss_np, acc_np = trainer.train_gamma(gamma_type)
 
@@ -302,15 +247,22 @@ def main(args):
             'step, {}, loss, {:.3f}, acc, {}, safety rate, {:.3f}, time, {:.3f} '.format(
                 i, loss_np, acc_np, safety_rate, time_iter))
 
-        if (loss_np <= loss_current or np.sum(acc_np) / int(acc_np.size) > 0.96) and i > 5:
+        best = (loss_np <= loss_current or np.sum(acc_np) / int(acc_np.size) > 0.96) and i > 5
+        weights = []
+        if best:
             loss_current = loss_np.copy()
-            torch.save(gamma.state_dict(), str_data)
+            weights.append(str_data)
 
             if loss_np <= 0.01 or np.sum(acc_np) / int(acc_np.size) > 0.97:
-                torch.save(gamma.state_dict(), str_good_data)
-        
-            if loss_np <= 0.001 and i > 250:
-                break
+                weights.append(str_good_data)
+
+        checkpoint_writer.save(i, gamma, weights=weights, best=best, trainer=trainer.state_dict(),
+                               loss=float(loss_np), loss_current=float(loss_current), safety_rate=safety_rate)
+
+        if best and loss_np <= 0.001 and i > 250:
+            break
+
+    checkpoint_writer.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -321,6 +273,9 @@ if __name__ == '__main__':
     parser.add_argument('--gpu', type=int, default=0)
     parser.add_argument('--cpu', type=bool, default=False)
     parser.add_argument('--dt', type=float, default=0.002)
+    parser.add_argument('--dataset_dir', type=str, default=None)
+    parser.add_argument('--resume', type=str, default=None)
+    parser.add_argument('--amp', type=str, default=None, choices=['bf16', 'fp16'])
 
     args = parser.parse_args()
     main(args)
\ No newline at end of file
@@ -1,3 +1,4 @@
+import copy
 import itertools
 from typing import Tuple, List, Optional
 from collections import OrderedDict
@@ -6,6 +7,7 @@ import random
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
 import pytorch_lightning as pl
 import numpy as np
 
@@ -40,6 +42,13 @@ class CBF(nn.Module):
         self.V_layers["output_linear"] = nn.Linear(self.cbf_hidden_size, 1)
         self.V_nn = nn.Sequential(self.V_layers)
 
+        # Normalization of the state to the safe set, kept with the module so that it follows
+        # .to(device) and is not recomputed at every call. Not persistent, so checkpoints
+        # saved before these buffers existed still load.
+        safe_m, safe_l = self.dynamics.cached_limits("safe")
+        self.register_buffer("x_center", ((safe_m + safe_l) / 2).reshape(1, self.n_state), persistent=False)
+        self.register_buffer("x_range", ((safe_m - safe_l) / 2.0).reshape(1, self.n_state), persistent=False)
+
     def forward(self, state):
         """
         args:
@@ -68,62 +77,55 @@ class CBF(nn.Module):
         # dh1 = F.conv1d(h,x)
         return HJH
 
-    def V_with_jacobian(self, x: torch.Tensor):
+    def V_with_jacobian(self, x: torch.Tensor, use_jacrev=False):
         """Computes the CLBF value and its Jacobian
         args:
             x: bs x self.dynamics_model.n_dims the points at which to evaluate the CLBF
+            use_jacrev: compute the Jacobian with torch.func.jacrev and vmap instead of the
+                forward propagation below
         returns:
             V: bs tensor of CLBF values
             JV: bs x 1 x self.dynamics_model.n_dims Jacobian of each row of V wrt x
         """
-        x_norm = torch.unsqueeze(x, 2)  # (bs, n_state, 1)
-        bs = x_norm.shape[0]
-        x_norm = x_norm.reshape(bs, self.n_state)
-        su, sl = self.dynamics.state_limits()
-        safe_m, safe_l = self.dynamics.safe_limits(su, sl)
-        device_id = x.get_device()
-        if x.get_device() >= 0:
-            safe_m = safe_m.cuda(device_id)
-            safe_l = safe_l.cuda(device_id)
-
-        x_norm, x_range = self.normalize(x_norm, safe_m, safe_l)
-        x_range = x_range.reshape(self.dynamics.n_dims)
-        x_norm = x_norm.reshape(bs, self.n_state)
-
-        JV = torch.zeros(
-            (bs, self.dynamics.n_dims, self.dynamics.n_dims)).type_as(x)
+        bs = x.shape[0]
+        x_norm = (x.reshape(bs, self.n_state) - self.x_center.type_as(x)) / self.x_range.type_as(x)
 
-        for dim in range(self.dynamics.n_dims):
-            JV[:, dim, dim] = 1.0 / x_range[dim].type_as(x)
+        if use_jacrev:
+            return self.V_with_jacrev(x.reshape(bs, self.n_state))
 
+        # The Jacobian of the normalization is diagonal, so the first linear layer only
+        # scales the columns of its weight. Every activation scales the rows of JV.
+        JV = None
         V = x_norm
         for layer in self.V_nn:
             V = layer(V)
 
             if isinstance(layer, nn.Linear):
-                JV = torch.matmul(layer.weight, JV)
+                if JV is None:
+                    JV = (layer.weight * (1.0 / self.x_range.type_as(x))).expand(bs, -1, -1)
+                else:
+                    JV = torch.matmul(layer.weight, JV)
             elif isinstance(layer, nn.Tanh):
-                JV = torch.matmul(torch.diag_embed(1 - V ** 2), JV)
+                JV = (1 - V ** 2).unsqueeze(2) * JV
             elif isinstance(layer, nn.ReLU):
-                JV = torch.matmul(torch.diag_embed(torch.sign(V)), JV)
-
-        # x_er = (x.reshape(bs, self.n_state) - (safe_m + safe_l).reshape(1, self.n_state) / 2).reshape(bs, 1,
-        #                                                                                               self.n_state)
-        # x_er = x_norm.reshape(bs, 1, self.n_state)
-        # V_pre = 1 - 0.5 * torch.matmul(x_er, x_er.reshape(bs, self.n_state, 1))
-        #
-        # V_shape = V.shape
-        # V = V + V_pre.reshape(V_shape)
-        #
-        # # JV_pre = torch.zeros(JV.shape)
-        #
-        # JV_pre = -x_er.reshape(bs, 1, self.n_state) / x_range.reshape(1, 1, self.n_state)
-        #
-        # # for j in range(self.n_state):
-        # #     JV_pre[:, 0, j] = - x_er[:, 0, j].reshape(bs)
-        #
-        # # print(JV.shape)
-        # JV = JV + JV_pre
+                JV = torch.sign(V).unsqueeze(2) * JV
+
+        return V, JV
+
+    def V_with_jacrev(self, x: torch.Tensor):
+        """Same as V_with_jacobian, with the Jacobian from torch.func.jacrev over vmap
+        args:
+            x: bs x self.dynamics_model.n_dims
+        returns:
+            V: bs x 1
+            JV: bs x 1 x self.dynamics_model.n_dims
+        """
+        def V_single(x_single):
+            V = self.V_nn((x_single - self.x_center[0].type_as(x)) / self.x_range[0].type_as(x))
+            return V, V
+
+        JV, V = torch.func.vmap(torch.func.jacrev(V_single, has_aux=True))(x)
+
         return V, JV
 
     def normalize(self, x: torch.Tensor, x_max, x_min):
@@ -462,7 +464,94 @@ class Gamma_linear_nonconv(nn.Module):
 
         return x
     
-class Gamma_linear_deep_nonconv(nn.Module):
+class WindowedGamma(nn.Module):
+    """
+    Base of the MLP gamma networks whose first layer fc0 sees the flattened window of
+    the last traj_len steps, with two incremental evaluations:
+        step() keeps the window in a ring buffer stored twice back to back, so the
+               window ending at the current step is always a contiguous slice of it
+               and fc0 reads it in place, without gathering and concatenating the
+               window at every control step
+        stream() evaluates the windows ending at every step of whole trajectories as
+                 one causal convolution, since fc0 is linear in each step
+    Both match forward up to float rounding, and zero-pad the windows that would start
+    before the first step. forward applies preprocess_func to the whole flattened
+    window, which cannot be done one step at a time, so both reject networks that have
+    one. fc0 weighs each step by its position in the window, so a
+    running sum of its output would have to update traj_len partial windows per step,
+    which is more work than fc0 on one window.
+
+    Subclasses set traj_len and define fc0 to fc3, activation and output_activation.
+    """
+
+    def features(self, y, u=None):
+        """The (..., n_in) per-step inputs of fc0, in the order forward flattens them"""
+        if self.preprocess_func is not None:
+            raise ValueError(f"{type(self).__name__} applies preprocess_func to whole windows, "
+                             "step() and stream() cannot evaluate it incrementally")
+        return y if u is None else torch.cat([y, u], dim=-1)
+
+    def head(self, x):
+        """gamma from the (..., 128) outputs of fc0"""
+        x = self.activation(x)
+        x = self.activation(self.fc1(x))
+        x = self.activation(self.fc1(x))
+        x = self.activation(self.fc1(x))
+        x = self.activation(self.fc2(x))
+        return self.output_activation(self.fc3(x))
+
+    def init_hidden(self, bs, device=None):
+        """
+        returns:
+            the state of step() before the first step: the (bs, 2 * traj_len, n_in)
+            ring buffer of the inputs, created by the first step, and the step counter
+        """
+        return None, 0
+
+    def step(self, y_t, u_t=None, hidden=None):
+        """
+        Streaming evaluation, for inference. The buffer of hidden is updated in place.
+        args:
+            y_t (bs, y_state): the output at the current step
+            u_t (bs, m_control): the control at the current step, None for the
+                                 networks that only see the outputs
+            hidden: the state returned by the previous step, None to start
+        returns:
+            gamma (bs, m_control): gamma of the window ending at the current step
+            hidden: the state to pass to the next step
+        """
+        buffer, k = self.init_hidden(y_t.shape[0]) if hidden is None else hidden
+        x = self.features(y_t, u_t)
+        if buffer is None:
+            buffer = x.new_zeros(x.shape[0], 2 * self.traj_len, x.shape[1])
+
+        index = k % self.traj_len
+        buffer[:, index] = x
+        buffer[:, index + self.traj_len] = x
+
+        # The window ending at step k, oldest step first, as a view of the buffer
+        start = (k + 1) % self.traj_len
+        window = buffer[:, start:start + self.traj_len].reshape(x.shape[0], -1)
+
+        return self.head(self.fc0(window)), (buffer, k + 1)
+
+    def stream(self, y, u=None):
+        """
+        The gammas step() returns along whole trajectories, in one call
+        args:
+            y (bs, T, y_state)
+            u (bs, T, m_control)
+        returns:
+            gamma (bs, T, m_control): gamma of the window ending at each step
+        """
+        x = self.features(y, u).transpose(1, 2)
+        weight = self.fc0.weight.view(self.fc0.out_features, self.traj_len, x.shape[1]).transpose(1, 2)
+        x = F.conv1d(F.pad(x, (self.traj_len - 1, 0)), weight, self.fc0.bias)
+
+        return self.head(x.transpose(1, 2))
+
+
+class Gamma_linear_deep_nonconv(WindowedGamma):
 
     def __init__(self, n_state, m_control, traj_len, preprocess_func=None):
         super().__init__()
@@ -470,6 +559,7 @@ class Gamma_linear_deep_nonconv(nn.Module):
         # self.k_obstacle = k_obstacle
         self.m_control = m_control
         self.preprocess_func = preprocess_func
+        self.traj_len = traj_len
 
         self.fc0 = nn.Linear((n_state + m_control) * traj_len, 128)
         self.fc1 = nn.Linear(128, 128)
@@ -506,13 +596,14 @@ class Gamma_linear_deep_nonconv(nn.Module):
 
         return x
 
-class Gamma_linear_deep_nonconv_output(nn.Module):
+class Gamma_linear_deep_nonconv_output(WindowedGamma):
 
     def __init__(self, y_state, m_control, traj_len, model_factor, preprocess_func=None):
         super().__init__()
         # self.k_obstacle = k_obstacle
         self.m_control = m_control
         self.preprocess_func = preprocess_func
+        self.traj_len = traj_len
         if model_factor == 0:
             self.fc0 = nn.Linear((y_state + m_control) * traj_len, 128)
         else:
@@ -551,13 +642,14 @@ class Gamma_linear_deep_nonconv_output(nn.Module):
 
         return gamma
 
-class Gamma_linear_deep_nonconv_output_only_res(nn.Module):
+class Gamma_linear_deep_nonconv_output_only_res(WindowedGamma):
 
     def __init__(self, y_state, m_control, traj_len, preprocess_func=None):
         super().__init__()
         # self.k_obstacle = k_obstacle
         self.m_control = m_control
         self.preprocess_func = preprocess_func
+        self.traj_len = traj_len
         
         self.fc0 = nn.Linear(y_state * traj_len, 128)
         self.fc1 = nn.Linear(128, 128)
@@ -594,13 +686,14 @@ class Gamma_linear_deep_nonconv_output_only_res(nn.Module):
 
         return gamma
     
-class Gamma_linear_deep_nonconv_output_single(nn.Module):
+class Gamma_linear_deep_nonconv_output_single(WindowedGamma):
 
     def __init__(self, y_state, m_control, traj_len, model_factor, preprocess_func=None):
         super().__init__()
         # self.k_obstacle = k_obstacle
         self.m_control = m_control
         self.preprocess_func = preprocess_func
+        self.traj_len = traj_len
         if model_factor == 0:
             self.fc0 = nn.Linear((y_state + m_control) * traj_len, 128)
         else:
@@ -637,7 +730,77 @@ class Gamma_linear_deep_nonconv_output_single(nn.Module):
 
         return gamma
     
-class Gamma_linear_LSTM(nn.Module):
+class RecurrentGamma(nn.Module):
+    """
+    Base of the gamma networks built on a recurrent layer. forward() evaluates a batch
+    of windows from the given hidden state, zeros by default, and keeps no state
+    between calls. The network can also be run as a streaming detector: step() feeds
+    one time step at a time and carries the hidden state across the control steps,
+    instead of re-running the whole window.
+
+    Before forward() became stateless, every call, in training and in the test
+    scripts alike, started from the detached final hidden state of the previous call,
+    so the outputs depended on the previous batch. LSTM and GRU weights trained
+    before that change are now evaluated differently and need to be re-evaluated or
+    retrained.
+
+    Subclasses define
+        features(y, u): the (bs, T, n_in) inputs of the recurrent layer
+        head(x): gamma from the (..., hidden_size) outputs of the recurrent layer
+    and rnn_name, the attribute of the recurrent layer.
+    """
+
+    rnn_name = "LSTM"
+
+    @property
+    def rnn(self):
+        return getattr(self, self.rnn_name)
+
+    def init_hidden(self, bs, device=None):
+        """
+        returns:
+            the zero hidden state of a batch of bs trajectories, (h, c) for an LSTM
+        """
+        h = torch.zeros(self.rnn.num_layers, bs, self.rnn.hidden_size, device=device)
+        if isinstance(self.rnn, nn.LSTM):
+            return h, torch.zeros_like(h)
+        return h
+
+    def step(self, y_t, u_t=None, hidden=None):
+        """
+        Streaming evaluation, O(1) per control step
+        args:
+            y_t (bs, y_state): the output at the current step
+            u_t (bs, m_control): the control at the current step, None for the
+                                 networks that only see the outputs
+            hidden: the hidden state returned by the previous step, None for zeros
+        returns:
+            gamma (bs, m_control): gamma given all the steps fed so far
+            hidden: the hidden state to pass to the next step
+        """
+        u_t = None if u_t is None else u_t.unsqueeze(1)
+        x, hidden = self.rnn(self.features(y_t.unsqueeze(1), u_t), hidden)
+
+        return self.head(x[:, -1, :]), hidden
+
+    def stream(self, y, u=None, hidden=None):
+        """
+        The gammas step() returns along whole trajectories, in one call of the
+        recurrent layer
+        args:
+            y (bs, T, y_state)
+            u (bs, T, m_control)
+            hidden: the initial hidden state, None for zeros
+        returns:
+            gamma (bs, T, m_control): gamma after each step
+            hidden: the hidden state after the last step
+        """
+        x, hidden = self.rnn(self.features(y, u), hidden)
+
+        return self.head(x), hidden
+
+
+class Gamma_linear_LSTM(RecurrentGamma):
 
     def __init__(self, n_state, m_control, traj_len, preprocess_func=None):
         super().__init__()
@@ -653,37 +816,36 @@ class Gamma_linear_LSTM(nn.Module):
         self.fc3 = nn.Linear(64, m_control)
         self.activation = nn.ReLU()
         self.output_activation = nn.Tanh()
-        self.h = []
-        self.c = []
         
 
-    def forward(self, state, u):
+    def features(self, state, u):
+        state = torch.cat([state, u], dim=-1)
+        if self.preprocess_func is not None:
+            state = self.preprocess_func(state)
+        return state
+
+    def head(self, x):
+        x = self.activation(x)
+        x = self.activation(self.fc2(x))
+        return self.output_activation(self.fc3(x))
+
+    def forward(self, state, u, hidden=None):
         """
         args:
             state (bs, traj_len, n_state)
             u (bs, traj_len, m_control)
+            hidden: the initial hidden state, see init_hidden, None for zeros
         returns:
             gamma (bs, m_control)
         """
 
-        state = torch.cat([state, u], dim=-1)
-        
-        if self.preprocess_func is not None:
-            state = self.preprocess_func(state)
-            # state_error = self.preprocess_func(state_error)
-        
-        if len(self.h) == 0:
-            self.h = torch.zeros(1, state.shape[0], 128).to(state.device)
-            self.c = torch.zeros(1, state.shape[0], 128).to(state.device)
+        x, _ = self.rnn(self.features(state, u), hidden)
 
-        x , (self.h, self.c)= self.LSTM(state, (self.h.detach(), self.c.detach()))
-        x = self.activation(x[:, -1, :])
-        x = self.activation(self.fc2(x))
-        x = self.output_activation(self.fc3(x))
+        return self.head(x[:, -1, :])
 
-        return x
+class Gamma_linear_GRU_output(RecurrentGamma):
 
-class Gamma_linear_GRU_output(nn.Module):
+    rnn_name = "GRU"
 
     def __init__(self, y_state, m_control, model_factor, preprocess_func=None):
         super().__init__()
@@ -702,36 +864,33 @@ class Gamma_linear_GRU_output(nn.Module):
         self.fc3 = nn.Linear(64, m_control)
         self.activation = nn.ReLU()
         self.output_activation = nn.Sigmoid()
-        self.h = []
-        self.c = []
         
 
-    def forward(self, y, u):
+    def features(self, y, u):
+        state = torch.cat([y, u], dim=-1)
+        if self.preprocess_func is not None:
+            state = self.preprocess_func(state)
+        return state
+
+    def head(self, x):
+        x = self.activation(x)
+        return self.output_activation(self.fc3(x))
+
+    def forward(self, y, u, hidden=None):
         """
         args:
             state (bs, traj_len, y_state)
             u (bs, traj_len, m_control)
+            hidden: the initial hidden state, see init_hidden, None for zeros
         returns:
             gamma (bs, m_control)
         """
 
-        state = torch.cat([y, u], dim=-1)
-        
-        if self.preprocess_func is not None:
-            state = self.preprocess_func(state)
-        
-        if len(self.h) == 0:
-            self.h = torch.zeros(1, state.shape[0], 64).to(state.device)
-        #     self.c = torch.zeros(1, state.shape[0], 128).to(state.device)
+        x, _ = self.rnn(self.features(y, u), hidden)
 
-        x, self.h = self.GRU(state, self.h.detach())
-        x = self.activation(x[:, -1, :])
-        # x = self.activation(self.fc2(x))
-        gamma = self.output_activation(self.fc3(x))
-        # gamma = self.output_activation(x[:, -1, :])
-        return gamma
-    
-class Gamma_linear_LSTM_output(nn.Module):
+        return self.head(x[:, -1, :])
+
+class Gamma_linear_LSTM_output(RecurrentGamma):
 
     def __init__(self, y_state, m_control, model_factor, preprocess_func=None):
         super().__init__()
@@ -748,36 +907,34 @@ class Gamma_linear_LSTM_output(nn.Module):
         self.fc3 = nn.Linear(64, m_control)
         self.activation = nn.ReLU()
         self.output_activation = nn.Sigmoid()
-        self.h = []
-        self.c = []
         
 
-    def forward(self, y, u):
+    def features(self, y, u):
+        state = torch.cat([y, u], dim=-1)
+        if self.preprocess_func is not None:
+            state = self.preprocess_func(state)
+        return state
+
+    def head(self, x):
+        x = self.activation(x)
+        x = self.activation(self.fc2(x))
+        return self.output_activation(self.fc3(x))
+
+    def forward(self, y, u, hidden=None):
         """
         args:
             state (bs, traj_len, y_state)
             u (bs, traj_len, m_control)
+            hidden: the initial hidden state, see init_hidden, None for zeros
         returns:
             gamma (bs, m_control)
         """
 
-        state = torch.cat([y, u], dim=-1)
-        
-        if self.preprocess_func is not None:
-            state = self.preprocess_func(state)
-        
-        if len(self.h) == 0:
-            self.h = torch.zeros(1, state.shape[0], 128).to(state.device)
-            self.c = torch.zeros(1, state.shape[0], 128).to(state.device)
+        x, _ = self.rnn(self.features(y, u), hidden)
 
-        x , (self.h, self.c)= self.LSTM(state, (self.h.detach(), self.c.detach()))
-        x = self.activation(x[:, -1, :])
-        x = self.activation(self.fc2(x))
-        gamma = self.output_activation(self.fc3(x))
-
-        return gamma
+        return self.head(x[:, -1, :])
 
-class Gamma_linear_LSTM_output_only_res(nn.Module):
+class Gamma_linear_LSTM_output_only_res(RecurrentGamma):
 
     def __init__(self, y_state, m_control, preprocess_func=None):
         super().__init__()
@@ -792,36 +949,34 @@ class Gamma_linear_LSTM_output_only_res(nn.Module):
         self.fc3 = nn.Linear(64, m_control)
         self.activation = nn.ReLU()
         self.output_activation = nn.Sigmoid()
-        self.h = []
-        self.c = []
         
 
-    def forward(self, y):
+    def features(self, y, u=None):
+        state = y
+        if self.preprocess_func is not None:
+            state = self.preprocess_func(state)
+        return state
+
+    def head(self, x):
+        x = self.activation(x)
+        x = self.activation(self.fc2(x))
+        return self.output_activation(self.fc3(x))
+
+    def forward(self, y, hidden=None):
         """
         args:
             state (bs, traj_len, y_state)
             u (bs, traj_len, m_control)
+            hidden: the initial hidden state, see init_hidden, None for zeros
         returns:
             gamma (bs, m_control)
         """
 
-        state = y
-        
-        if self.preprocess_func is not None:
-            state = self.preprocess_func(state)
-        
-        if len(self.h) == 0:
-            self.h = torch.zeros(1, state.shape[0], 128).to(state.device)
-            self.c = torch.zeros(1, state.shape[0], 128).to(state.device)
+        x, _ = self.rnn(self.features(y), hidden)
 
-        x , (self.h, self.c)= self.LSTM(state, (self.h.detach(), self.c.detach()))
-        x = self.activation(x[:, -1, :])
-        x = self.activation(self.fc2(x))
-        gamma = self.output_activation(self.fc3(x))
+        return self.head(x[:, -1, :])
 
-        return gamma
-    
-class Gamma_linear_LSTM_output_single(nn.Module):
+class Gamma_linear_LSTM_output_single(RecurrentGamma):
 
     def __init__(self, y_state, m_control, model_factor, preprocess_func=None):
         super().__init__()
@@ -838,36 +993,34 @@ class Gamma_linear_LSTM_output_single(nn.Module):
         self.fc3 = nn.Linear(64, m_control)
         self.activation = nn.ReLU()
         self.output_activation = nn.Sigmoid()
-        self.h = []
-        self.c = []
         
 
-    def forward(self, y, u):
+    def features(self, y, u):
+        state = torch.cat([y, u], dim=-1)
+        if self.preprocess_func is not None:
+            state = self.preprocess_func(state)
+        return state
+
+    def head(self, x):
+        x = self.activation(x)
+        x = self.activation(self.fc2(x))
+        return self.output_activation(self.fc3(x))
+
+    def forward(self, y, u, hidden=None):
         """
         args:
             state (bs, traj_len, y_state)
             u (bs, traj_len, m_control)
+            hidden: the initial hidden state, see init_hidden, None for zeros
         returns:
             gamma (bs, m_control)
         """
 
-        state = torch.cat([y, u], dim=-1)
-        
-        if self.preprocess_func is not None:
-            state = self.preprocess_func(state)
-        
-        if len(self.h) == 0:
-            self.h = torch.zeros(1, state.shape[0], 128).to(state.device)
-            self.c = torch.zeros(1, state.shape[0], 128).to(state.device)
+        x, _ = self.rnn(self.features(y, u), hidden)
 
-        x , (self.h, self.c)= self.LSTM(state, (self.h.detach(), self.c.detach()))
-        x = self.activation(x[:, -1, :])
-        x = self.activation(self.fc2(x))
-        gamma = self.output_activation(self.fc3(x))
+        return self.head(x[:, -1, :])
 
-        return gamma
-    
-class Gamma_linear_LSTM_small(nn.Module):
+class Gamma_linear_LSTM_small(RecurrentGamma):
 
     def __init__(self, n_state, m_control, traj_len, preprocess_func=None):
         super().__init__()
@@ -882,50 +1035,31 @@ class Gamma_linear_LSTM_small(nn.Module):
         self.fc3 = nn.Linear(64, m_control)
         self.activation = nn.ReLU()
         self.output_activation = nn.Tanh()
-        self.h = []
-        self.c = []
         
 
-    def forward(self, state, u):
+    def features(self, state, u):
+        state = torch.cat([state, u], dim=-1)
+        if self.preprocess_func is not None:
+            state = self.preprocess_func(state)
+        return state
+
+    def head(self, x):
+        x = self.activation(x)
+        return self.output_activation(self.fc3(x))
+
+    def forward(self, state, u, hidden=None):
         """
         args:
             state (bs, traj_len, n_state)
             u (bs, traj_len, m_control)
+            hidden: the initial hidden state, see init_hidden, None for zeros
         returns:
             gamma (bs, m_control)
         """
 
-        state = torch.cat([state, u], dim=-1)
-
-        # state = state.reshape(state.shape[0], state.shape[1] * state.shape[2])
-        
-        # state_shape = state.shape
-        # state = state.reshape(state.shape[1], state.shape[0] * state.shape[2])
+        x, _ = self.rnn(self.features(state, u), hidden)
 
-        # state = state.reshape(state_shape[0], state_shape[1] * state_shape[2])
-        
-        if self.preprocess_func is not None:
-            state = self.preprocess_func(state)
-            # state_error = self.preprocess_func(state_error)
-        
-        if len(self.h) == 0:
-            self.h = torch.zeros(1, state.shape[0], 64).to(state.device)
-            self.c = torch.zeros(1, state.shape[0], 64).to(state.device)
-
-        # if state.device != self.h.device:
-        #     self.h = self.h.to(state.device)
-        #     self.c = self.c.to(state.device)
-        # x = self.activation(self.fc0(state))
-        # x = self.activation(self.fc1(x))
-        # try:
-        x , (self.h, self.c)= self.LSTM(state, (self.h.detach(), self.c.detach()))
-        # except:
-        # x , (self.h, self.c)= self.LSTM(state)
-        x = self.activation(x[:, -1, :])
-        # x = self.activation(self.fc2(x))
-        x = self.output_activation(self.fc3(x))
-
-        return x
+        return self.head(x[:, -1, :])
 
 class Gamma_linear_LSTM_old(nn.Module):
 
@@ -969,10 +1103,218 @@ class Gamma_linear_LSTM_old(nn.Module):
         
         # x = self.activation(self.fc0(state))
         # x = self.activation(self.fc1(x))
-        x, (self.h, self.c)= self.LSTM(state)
+        x, _ = self.LSTM(state)
         x = self.activation(x)
         # x = self.activation(x[:, -1, :])
         x = self.activation(self.fc2(x))
         x = self.output_activation(self.fc3(x))
 
-        return x
\ No newline at end of file
+        return x
+
+class Gamma_TCN_output(nn.Module):
+
+    def __init__(self, y_state, m_control, model_factor, channels=64, kernel_size=3, dilations=(1, 2, 4, 8, 16),
+                 preprocess_func=None):
+        """
+        Temporal convolutional gamma network: a stack of residual dilated causal
+        convolutions over the window, followed by an MLP on the features of its last
+        step. All the steps are processed in parallel in training, and step() runs it
+        one step at a time from a cache of the past inputs of each convolution.
+
+        The output only depends on the last receptive_field steps, 63 with the default
+        dilations, so when the windows are longer than that, step() matches forward
+        on the window ending at each step.
+
+        args:
+            channels: number of channels of the convolutions
+            kernel_size: kernel size of the convolutions
+            dilations: dilation of each convolution
+        """
+        super().__init__()
+        self.n_state = y_state
+        self.m_control = m_control
+        self.preprocess_func = preprocess_func
+        self.kernel_size = kernel_size
+        self.dilations = tuple(dilations)
+
+        if model_factor == 0:
+            self.fc0 = nn.Conv1d(y_state + m_control, channels, 1)
+        else:
+            self.fc0 = nn.Conv1d(2 * y_state + m_control, channels, 1)
+        self.convs = nn.ModuleList([nn.Conv1d(channels, channels, kernel_size, dilation=d) for d in self.dilations])
+        self.fc2 = nn.Linear(channels, 64)
+        self.fc3 = nn.Linear(64, m_control)
+        self.activation = nn.ReLU()
+        self.output_activation = nn.Sigmoid()
+
+    @property
+    def receptive_field(self):
+        return 1 + (self.kernel_size - 1) * sum(self.dilations)
+
+    def features(self, y, u):
+        state = torch.cat([y, u], dim=-1)
+        if self.preprocess_func is not None:
+            state = self.preprocess_func(state)
+        return state
+
+    def temporal(self, x):
+        """
+        args:
+            x (bs, n_in, T)
+        returns:
+            features (bs, channels, T) of the window ending at each step
+        """
+        x = self.fc0(x)
+        for conv, dilation in zip(self.convs, self.dilations):
+            x = x + self.activation(conv(F.pad(x, ((self.kernel_size - 1) * dilation, 0))))
+        return x
+
+    def head(self, x):
+        x = self.activation(self.fc2(x))
+        return self.output_activation(self.fc3(x))
+
+    def forward(self, y, u):
+        """
+        args:
+            y (bs, traj_len, y_state)
+            u (bs, traj_len, m_control)
+        returns:
+            gamma (bs, m_control)
+        """
+        x = self.features(y, u).transpose(1, 2)
+        if x.shape[2] < self.receptive_field:
+            return self.head(self.temporal(x)[:, :, -1])
+
+        # Only the last step is needed: drop the steps outside its receptive field, and
+        # let each convolution compute only the steps that the next ones read
+        x = self.fc0(x[:, :, -self.receptive_field:])
+        for conv, dilation in zip(self.convs, self.dilations):
+            x = x[:, :, (self.kernel_size - 1) * dilation:] + self.activation(conv(x))
+
+        return self.head(x[:, :, -1])
+
+    def init_hidden(self, bs, device=None):
+        """
+        returns:
+            the cache of step() before the first step: the last
+            (kernel_size - 1) * dilation inputs of each convolution, zeros
+        """
+        channels = self.fc0.out_channels
+        return [torch.zeros(bs, channels, (self.kernel_size - 1) * d, device=device) for d in self.dilations]
+
+    def step(self, y_t, u_t, hidden=None):
+        """
+        Streaming evaluation, O(1) per control step
+        args:
+            y_t (bs, y_state): the output at the current step
+            u_t (bs, m_control): the control at the current step
+            hidden: the cache returned by the previous step, None to start
+        returns:
+            gamma (bs, m_control): gamma given all the steps fed so far
+            hidden: the cache to pass to the next step
+        """
+        if hidden is None:
+            hidden = self.init_hidden(y_t.shape[0], y_t.device)
+
+        x = self.fc0(self.features(y_t, u_t).unsqueeze(-1))
+        cache = []
+        for conv, past in zip(self.convs, hidden):
+            window = torch.cat([past, x], dim=2)
+            x = x + self.activation(conv(window))
+            cache.append(window[:, :, 1:])
+
+        return self.head(x[:, :, 0]), cache
+
+    def stream(self, y, u):
+        """
+        The gammas step() returns along whole trajectories starting from an empty
+        cache, in one call
+        args:
+            y (bs, T, y_state)
+            u (bs, T, m_control)
+        returns:
+            gamma (bs, T, m_control): gamma after each step
+        """
+        x = self.temporal(self.features(y, u).transpose(1, 2))
+
+        return self.head(x.transpose(1, 2))
+
+
+class GammaEnsemble(nn.Module):
+    """
+    Several gamma networks evaluated on the same inputs, e.g. to compare them on one
+    shared rollout. The networks are grouped by class and parameter shapes, and the
+    parameters of each group of two or more are stacked with
+    torch.func.stack_module_state so that the group runs as a single vmap call. Groups
+    with a layer that vmap has no batching rule for, such as the LSTM and GRU ones,
+    fall back to calling their networks one after another from then on. Other errors
+    of the vmap call are raised and leave the group stacked.
+
+    The stacked parameters are copies made on the device of the networks: move the
+    networks or change their weights before building the ensemble, or call stack()
+    again afterwards. On the CPU, vmap turns the convolutions into grouped ones with
+    batched weights, which are slower than the separate calls, so vectorize is best
+    left off there.
+    """
+
+    def __init__(self, models, vectorize: bool = True):
+        """
+        args:
+            models: the gamma networks, all taking the same inputs
+            vectorize: whether to stack the groups of networks, False to always call
+                       them one after another
+        """
+        super().__init__()
+        self.models = nn.ModuleList(models)
+        self.vectorize = vectorize
+        self.stack()
+
+    def stack(self):
+        """Group the networks and stack the parameters of each group"""
+        groups = OrderedDict()
+        for i, model in enumerate(self.models):
+            shapes = tuple((name, tuple(p.shape)) for name, p in
+                           itertools.chain(model.named_parameters(), model.named_buffers()))
+            groups.setdefault((type(model), shapes), []).append(i)
+
+        # (indices of the networks, (meta-device copy, params, buffers) or None)
+        self.groups = []
+        for indices in groups.values():
+            stacked = None
+            if self.vectorize and len(indices) > 1:
+                models = [self.models[i] for i in indices]
+                params, buffers = stack_module_state(models)
+                stacked = (copy.deepcopy(models[0]).to('meta'), params, buffers)
+            self.groups.append((indices, stacked))
+
+    def forward(self, *inputs):
+        """
+        args:
+            inputs: the inputs of each network, e.g. y (bs, traj_len, y_state) and
+                    u (bs, traj_len, m_control)
+        returns:
+            gamma (n_models, bs, m_control): the prediction of each network
+        """
+        gamma = [None] * len(self.models)
+
+        for group, (indices, stacked) in enumerate(self.groups):
+            if stacked is not None:
+                base, params, buffers = stacked
+                call = vmap(lambda p, b, *x: functional_call(base, (p, b), x),
+                            in_dims=(0, 0) + (None,) * len(inputs))
+                try:
+                    for i, gamma_i in zip(indices, call(params, buffers, *inputs)):
+                        gamma[i] = gamma_i
+                    continue
+                except RuntimeError as e:
+                    # Only a missing batching rule is a property of the networks, that
+                    # does not go away and is worth falling back for. Anything else, e.g.
+                    # running out of memory or a wrong input, is raised as it is
+                    if "Batching rule not implemented" not in str(e):
+                        raise
+                    self.groups[group] = (indices, None)
+
+            for i in indices:
+                gamma[i] = self.models[i](*inputs)
+
+        return torch.stack(gamma)
\ No newline at end of file
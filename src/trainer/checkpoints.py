@@ -0,0 +1,294 @@
+"""Registry of the saved network weights, a cached checkpoint loader and an asynchronous
+checkpoint writer"""
+import glob
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import torch
+
+
+# Directories searched for weights, best first
+DATA_DIRS = ("./supercloud_data", "./good_data/data", "./data")
+
+# Prefix of the weight files of each gamma class, formatted with y_state
+GAMMA_PREFIXES = {
+    "Gamma_linear_LSTM_output": "CF_gamma_LSTM_output{}",
+    "Gamma_linear_deep_nonconv_output": "CF_gamma_deep_output{}",
+    "Gamma_linear_GRU_output": "CF_gamma_GRU_output{}",
+    "Gamma_TCN_output": "CF_gamma_TCN_output{}",
+    "Gamma_linear_LSTM_output_single": "CF_gamma_LSTM_output_single_{}",
+    "Gamma_linear_deep_nonconv_output_single": "CF_gamma_deep_output_single_{}",
+    "Gamma_linear_LSTM_output_only_res": "CF_gamma_LSTM_output{}",
+    "Gamma_linear_deep_nonconv_output_only_res": "CF_gamma_deep_output{}",
+}
+
+# Weight files of the gamma classes that see the full state and all the faults
+FULL_STATE_GAMMA_FILES = {
+    "Gamma_linear_LSTM": "CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM_new.pth",
+    "Gamma_linear_LSTM_old": "CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM.pth",
+    "Gamma_linear_LSTM_small": "CF_gamma_NN_class_linear_ALL_faults_no_res_LSTM_small.pth",
+    "Gamma_linear_nonconv": "CF_gamma_NN_class_linear_ALL_faults_no_res.pth",
+    "Gamma_linear_deep_nonconv": "CF_gamma_NN_class_linear_ALL_faults_no_res_non_conv_deep.pth",
+    "Gamma_linear_conv": "CF_gamma_NN_class_linear_ALL_faults.pth",
+}
+
+# State dicts loaded so far, keyed by (path, modification time, device)
+_cache = {}
+
+
+class CheckpointKey(NamedTuple):
+    """
+    Identifies the weights of a gamma network
+        model: the class or class name of the network
+        y_state: the number of observed outputs
+        model_factor: 1 if the network also sees the residuals, 0 otherwise
+        rates: 1 if the outputs include the angular rates, 0 otherwise
+    The networks that see the full state are identified by their class alone.
+        fault_index: the faulty actuator of the per-fault Gamma networks, the networks
+                     trained on all the faults ignore it
+        variant: extra tag of the file name, e.g. "complete" for complete faults
+    """
+    model: object
+    y_state: int = 6
+    model_factor: int = 0
+    rates: int = 1
+    fault_index: Optional[int] = None
+    variant: str = ""
+
+    @property
+    def model_name(self) -> str:
+        return self.model if isinstance(self.model, str) else self.model.__name__
+
+    def filename(self) -> str:
+        """Return the file name the training scripts save these weights to"""
+        name = self.model_name
+        if name == "Gamma":
+            return 'CF_gamma_NN_weights{}.pth'.format(self.fault_index)
+        if name in FULL_STATE_GAMMA_FILES:
+            return FULL_STATE_GAMMA_FILES[name]
+        if name not in GAMMA_PREFIXES:
+            raise KeyError(f"No weight files registered for {name}")
+
+        filename = GAMMA_PREFIXES[name].format(self.y_state)
+        if name.endswith("_only_res"):
+            # The residual-only networks are saved under their rates flag
+            filename += '_model_' + str(self.rates) + '_rates_only_res'
+        else:
+            filename += '_model_' + str(self.model_factor)
+            if self.rates:
+                filename += '_rates'
+        if self.variant:
+            filename += '_' + self.variant
+
+        return filename + '_sigmoid.pth'
+
+
+def find(filename: str, dirs=DATA_DIRS) -> str:
+    """
+    Return the path of filename in the first of dirs that has it
+
+    raises:
+        FileNotFoundError if none of dirs has it
+    """
+    for directory in dirs:
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f"{filename} not found in {', '.join(dirs)}")
+
+
+def load_state_dict(filename: str, device="cpu", dirs=DATA_DIRS):
+    """
+    Load the state dict saved as filename in the first of dirs that has it, mapped to
+    device. The file is memory-mapped where torch supports it and only tensors are
+    unpickled, and the result is cached, so loading the same weights again does not
+    touch the disk. Do not modify the returned tensors in place.
+
+    args:
+        filename: the file name, or a CheckpointKey
+        device: the device to map the tensors to
+        dirs: the directories to search, best first
+    returns:
+        state_dict: the loaded state dict
+    """
+    if isinstance(filename, CheckpointKey):
+        filename = filename.filename()
+    path = os.path.abspath(find(filename, dirs))
+    device = torch.device(device)
+
+    key = (path, os.path.getmtime(path), device)
+    if key not in _cache:
+        try:
+            state_dict = torch.load(path, map_location=device, mmap=True, weights_only=True)
+        except (RuntimeError, TypeError):
+            # Files in the legacy serialization format cannot be memory-mapped (RuntimeError),
+            # and torch.load only takes mmap from torch 2.1 on (TypeError)
+            state_dict = torch.load(path, map_location=device, weights_only=True)
+        _cache[key] = state_dict
+
+    return _cache[key]
+
+
+def load(module: torch.nn.Module, filename, device="cpu", dirs=DATA_DIRS, strict: bool = True):
+    """
+    Load weights into module and move it to device, see load_state_dict
+
+    args:
+        module: the network to load the weights into
+        filename: the file name, or a CheckpointKey
+        device: the device of the network
+        dirs: the directories to search, best first
+        strict: passed to module.load_state_dict
+    returns:
+        module
+    """
+    module.load_state_dict(load_state_dict(filename, device, dirs), strict=strict)
+
+    return module.to(device)
+
+
+def load_gamma(gamma: torch.nn.Module, y_state: int = 6, model_factor: int = 0, rates: int = 1,
+               fault_index: Optional[int] = None, variant: str = "", device="cpu", dirs=DATA_DIRS):
+    """
+    Load the weights registered for gamma, identified by its class and the given
+    CheckpointKey fields, into it
+
+    returns:
+        gamma
+    """
+    key = CheckpointKey(type(gamma), y_state, model_factor, rates, fault_index, variant)
+
+    return load(gamma, key, device, dirs)
+
+
+def clear_cache():
+    """Drop all the cached state dicts"""
+    _cache.clear()
+
+
+def snapshot(obj):
+    """
+    Copy all the tensors of a (nested) state dict to the CPU, so that the copy is not
+    affected by the next optimizer steps
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path: str):
+    """
+    Save obj to path through a temporary file in the same directory, so that path holds
+    either the previous or the new checkpoint even if the process dies while saving
+    """
+    tmp = path + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+class CheckpointWriter(object):
+    """
+    Writes the checkpoints of a training loop from a background thread
+
+    Each call to save snapshots the network and optimizer to the CPU and returns, the
+    files are written while training goes on. Every file goes through atomic_save. Per
+    save, the writer
+        - writes the resume checkpoint {"model", "optimizer", "iteration", ...} to
+          <stem>_iter<iteration>.pth and deletes all but the last keep_last of them
+        - copies it to <stem>_best.pth if best is set
+        - writes the plain network state dict to each of weights, which is the format
+          the test scripts and trainer.checkpoints.load expect
+    where stem is path without its extension. The resume checkpoints of earlier runs
+    with the same path count towards keep_last, so they are pruned after a resume too.
+    At most one save is in flight: save waits for the previous one, and raises if it
+    failed.
+    """
+
+    def __init__(self, path: str, keep_last: int = 3):
+        """
+        args:
+            path: the weights file of the run, e.g. './data/CF_gamma_..._sigmoid.pth'
+            keep_last: number of resume checkpoints kept
+        """
+        self.stem = os.path.splitext(path)[0]
+        self.keep_last = keep_last
+
+        # Resume checkpoints left by earlier runs, oldest first
+        pattern = re.compile(re.escape(os.path.basename(self.stem)) + r'_iter(\d+)\.pth$')
+        existing = []
+        for file in glob.glob(glob.escape(self.stem) + '_iter*.pth'):
+            match = pattern.match(os.path.basename(file))
+            if match:
+                existing.append((int(match.group(1)), file))
+        self.history = deque(file for _, file in sorted(existing))
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def iteration_path(self, iteration: int) -> str:
+        return '{}_iter{:06d}.pth'.format(self.stem, iteration)
+
+    @property
+    def best_path(self) -> str:
+        return self.stem + '_best.pth'
+
+    def save(self, iteration: int, model: torch.nn.Module, optimizer=None, weights=(), best: bool = False,
+             **extra):
+        """
+        args:
+            iteration: the iteration counter of the training loop
+            model: the network being trained
+            optimizer: its optimizer, None to leave it out
+            weights: paths to write the plain state dict of model to
+            best: whether this is the best checkpoint so far
+            extra: more entries of the resume checkpoint, e.g. the loss
+        """
+        self.flush()
+
+        state = {"model": model.state_dict(), "iteration": iteration}
+        if optimizer is not None:
+            state["optimizer"] = optimizer.state_dict()
+        state.update(extra)
+
+        self.pending = self.executor.submit(self.write, iteration, snapshot(state), tuple(weights), best)
+
+    def write(self, iteration: int, state: dict, weights, best: bool):
+        path = self.iteration_path(iteration)
+        atomic_save(state, path)
+        if path not in self.history:
+            self.history.append(path)
+        while len(self.history) > self.keep_last:
+            old = self.history.popleft()
+            if os.path.exists(old):
+                os.remove(old)
+
+        if best:
+            atomic_save(state, self.best_path)
+        for weights_path in weights:
+            atomic_save(state["model"], weights_path)
+
+    def flush(self):
+        """Wait for the pending save, re-raising its error if it failed"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        """Finish the pending save and stop the writer thread"""
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,10 +1,285 @@
+import json
+import os
+import queue
+import threading
+
 import numpy as np
 import torch
 
 
-class Dataset_with_Grad(object):
+class RingBuffer(object):
+
+    def __init__(self, capacity):
+        """
+        Fixed-capacity circular buffer over the first dimension of a tensor. Storage
+        is allocated on the first non-empty insert, using its trailing shape, dtype
+        and device.
+
+        args:
+            capacity: maximum number of samples kept; the oldest are overwritten first
+        """
+        self.capacity = capacity
+        self.data = None
+        self.head = 0
+        self.size = 0
+
+    def add(self, x):
+        """
+        Copy the samples of x into the buffer in O(x.shape[0]).
+
+        args:
+            x (bs, ...): samples to insert
+        """
+        n = x.shape[0]
+        if n == 0:
+            return
+
+        if self.data is None:
+            self.data = torch.empty((self.capacity,) + tuple(x.shape[1:]), dtype=x.dtype, device=x.device)
+
+        if n > self.capacity:
+            x = x[-self.capacity:]
+            n = self.capacity
+
+        end = self.head + n
+        if end <= self.capacity:
+            self.data[self.head:end] = x
+        else:
+            n_first = self.capacity - self.head
+            self.data[self.head:] = x[:n_first]
+            self.data[:n - n_first] = x[n_first:]
+
+        self.head = end % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, indices):
+        """
+        args:
+            indices: logical indices in [0, len(self)), 0 being the oldest sample
+        returns:
+            the samples stored at those indices
+        """
+        return self.data[self.index(indices)]
+
+    def index(self, indices):
+        """
+        Map logical indices (0 being the oldest sample) to rows of self.data.
+        """
+        start = (self.head - self.size) % self.capacity
+        return (indices + start) % self.capacity
+
+    def gather(self, rows, *index):
+        """
+        Index self.data at the given rows (see index) and optional trailing indices.
+        """
+        return self.data[(rows,) + index]
+
+
+class MemmapBuffer(object):
+
+    def __init__(self, path, capacity=None):
+        """
+        Append-only on-disk buffer over the first dimension of a tensor. Samples are
+        written raw to path + '.bin' and read back through numpy.memmap, so the
+        buffer can outgrow RAM and is kept across runs. A small JSON header in
+        path + '.json' records the dtype and the trailing shape. The number of rows
+        is recorded by the owner of the buffer, so that the buffers of a dataset share
+        one count (see Dataset_buffers): after opening the buffer, call truncate with
+        it, and after add, record the new n_rows.
+
+        args:
+            path: file prefix of this buffer
+            capacity: if given, only the newest capacity rows are sampled from
+        """
+        self.path = path
+        self.capacity = capacity
+        self.dtype = None
+        self.shape = None
+        self.n_rows = 0
+        self.mmap = None
+
+        if os.path.exists(path + '.json'):
+            with open(path + '.json') as f:
+                header = json.load(f)
+            self.dtype = np.dtype(header['dtype'])
+            self.shape = tuple(header['shape'])
+            # Buffers written before the shared count recorded their own
+            self.n_rows = header.get('n_rows', 0)
+
+    @property
+    def row_bytes(self):
+        return self.dtype.itemsize * int(np.prod(self.shape))
+
+    def rows_on_disk(self):
+        """
+        returns:
+            the number of complete rows in the file, recorded or not
+        """
+        if self.dtype is None or not os.path.exists(self.path + '.bin'):
+            return 0
+        return os.path.getsize(self.path + '.bin') // self.row_bytes
+
+    def truncate(self, n_rows):
+        """
+        Keep the first n_rows rows of the file, dropping e.g. those of an append that
+        was not recorded by the owner.
+
+        raises:
+            RuntimeError if the file holds fewer than n_rows rows
+        """
+        if n_rows > self.rows_on_disk():
+            raise RuntimeError(f"{self.path}.bin holds {self.rows_on_disk()} rows, {n_rows} expected")
+        self.n_rows = n_rows
+        self.mmap = None
+
+    def add(self, x):
+        """
+        Append the samples of x to the end of the file.
+
+        args:
+            x (bs, ...): samples to insert
+        """
+        if x.shape[0] == 0:
+            return
+
+        x = x.detach().cpu().numpy()
+        if self.dtype is None:
+            self.dtype = x.dtype
+            self.shape = tuple(x.shape[1:])
+            with open(self.path + '.json.tmp', 'w') as f:
+                json.dump({'dtype': self.dtype.str, 'shape': list(self.shape)}, f)
+            os.replace(self.path + '.json.tmp', self.path + '.json')
+        assert x.dtype == self.dtype and tuple(x.shape[1:]) == self.shape
+
+        with open(self.path + '.bin', 'ab') as f:
+            # Drop whatever an interrupted append left past the last recorded row
+            f.truncate(self.n_rows * self.row_bytes)
+            f.write(np.ascontiguousarray(x).tobytes())
+        self.n_rows += x.shape[0]
+        self.mmap = None
+
+    @property
+    def data(self):
+        if self.mmap is None and self.n_rows > 0:
+            self.mmap = np.memmap(self.path + '.bin', dtype=self.dtype, mode='r', shape=(self.n_rows,) + self.shape)
+        return self.mmap
+
+    def __len__(self):
+        if self.capacity is None:
+            return self.n_rows
+        return min(self.n_rows, self.capacity)
+
+    def __getitem__(self, indices):
+        """
+        args:
+            indices: logical indices in [0, len(self)), 0 being the oldest sample
+        returns:
+            the samples stored at those indices
+        """
+        return self.gather(self.index(indices))
+
+    def index(self, indices):
+        """
+        Map logical indices (0 being the oldest sample) to rows of the file.
+        """
+        return indices + (self.n_rows - len(self))
+
+    def gather(self, rows, *index):
+        """
+        Read the given rows (see index) and optional trailing indices from disk. Only
+        the requested samples are paged in.
+        """
+        index = (rows,) + index
+        return torch.from_numpy(self.data[tuple(np.asarray(i) for i in index)])
+
+
+class BatchLoader(object):
+
+    def __init__(self, dataset, batch_size, sample_fn='sample_data_all', device='cpu', drop=(), n_prefetch=2):
+        """
+        Iterate over one epoch of permuted batches of a Dataset_buffers. Batches are
+        sampled on a background thread, pinned when the target is a GPU, and moved
+        with non-blocking copies, so indexing overlaps with the optimizer step.
+
+        args:
+            dataset: the Dataset_with_Grad or Dataset_windowed to sample from
+            batch_size: how many points per batch
+            sample_fn: name of the dataset sampling method, called as sample_fn(batch_size, index)
+            device: the device the batches are moved to
+            drop: positions of the sampled tuple that are not needed; they are yielded
+                as None and never transferred
+            n_prefetch: how many batches may be prepared ahead of the consumer
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sample_fn = getattr(dataset, sample_fn)
+        self.device = torch.device(device)
+        self.drop = drop
+        self.n_prefetch = n_prefetch
+
+    def __len__(self):
+        return int(self.dataset.n_pts / self.batch_size)
+
+    def __iter__(self):
+        n_batches = len(self)
+        batches = queue.Queue(maxsize=self.n_prefetch)
+        stop = threading.Event()
+        pin = self.device.type == 'cuda'
+
+        # Draw the permutation here, so that the worker thread only reads it
+        self.dataset.get_permuted_indices()
+
+        def put(item):
+            # Give up once the consumer has left the loop
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def worker():
+            try:
+                for i in range(n_batches):
+                    batch = []
+                    for j, x in enumerate(self.sample_fn(self.batch_size, i)):
+                        if j in self.drop:
+                            x = None
+                        elif pin:
+                            x = x.pin_memory()
+                        batch.append(x)
+                    put(batch)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            for _ in range(n_batches):
+                batch = batches.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                yield tuple(x if x is None else x.to(self.device, non_blocking=True) for x in batch)
+        finally:
+            stop.set()
+            thread.join()
+
+
+class Dataset_buffers(object):
+
+    def __init__(self, y_state, n_state, m_control, train_u, buffer_size=200000, traj_len = 100, path=None):
+        """
+        Data buffers (state, state_diff, u, gamma) of the gamma training and their
+        permuted sampling, shared by Dataset_with_Grad and Dataset_windowed, which
+        differ in how samples are added.
 
-    def __init__(self, y_state, n_state, m_control, train_u, buffer_size=200000, traj_len = 100):
+        args:
+            path: if given, a directory in which the buffers are stored as memory-mapped
+                files (see MemmapBuffer) instead of in RAM; data already in it is reused
+        """
         self.n_state = n_state
         self.train_u = train_u
         self.m_control = m_control
@@ -12,65 +287,132 @@ class Dataset_with_Grad(object):
         self.traj_len = traj_len
         # self.ns = int(self.buffer_size / self.traj_len)
         self.ns = self.buffer_size
-        self.buffer_data_s = torch.tensor([]).reshape(0, y_state)
-        self.buffer_data_s_diff = torch.tensor([]).reshape(0, n_state)
-        self.buffer_data_u_NN = torch.tensor([]).reshape(0, m_control)
-        self.buffer_data_u = torch.tensor([]).reshape(0, 1)
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.buffer_data_s = self.make_buffer('state', self.buffer_size)
+        self.buffer_data_s_diff = self.make_buffer('state_diff', self.buffer_size)
+        self.buffer_data_u_NN = self.make_buffer('u', self.buffer_size)
+        self.buffer_data_u = self.make_buffer('gamma', self.ns)
+        self.open_store()
         self.dang_count = 0
         self.safe_count = 0
         self.mid_count = 0
 
         # Maintain a list of permuted indices so that we can scramble the data on each
-        # epoch
+        # epoch. The permutation is redrawn lazily on the first sample after new data
+        # arrives, so that repeated calls to add_data stay O(batch)
         self.permuted_indices = torch.tensor([])
+        self.permute_pending = self.n_pts > 0
 
-    def add_data(self, state, state_diff, u, u_nominal):
+    def make_buffer(self, name, capacity):
         """
-        args:
-            state (n_state,): state of the agent
-            obstacle (k_obstacle, n_state): K obstacles
-            u_nominal (m_control,): the nominal control
-            state_next (n_state,): state of the agent at the next timestep
+        Create the storage of one data buffer, in RAM or on disk depending on self.path.
         """
+        if self.path is None:
+            return RingBuffer(capacity)
+        return MemmapBuffer(os.path.join(self.path, name), capacity)
 
-        if self.buffer_data_s.shape[0] == 0:
-            self.buffer_data_s = state.clone()
-        else:
-            self.buffer_data_s = torch.vstack((self.buffer_data_s, state.clone()))
-        
-        if self.buffer_data_s_diff.shape[0] == 0:
-            self.buffer_data_s_diff = state_diff.clone()
-        else:
-            self.buffer_data_s_diff = torch.vstack((self.buffer_data_s_diff, state_diff.clone()))
-        
-        if self.buffer_data_u_NN.shape[0] == 0:
-            self.buffer_data_u_NN = u.clone()
-        else:
-            self.buffer_data_u_NN = torch.vstack((self.buffer_data_u_NN, u.clone()))
-        
-        if self.buffer_data_u.shape[0] == 0:
-            self.buffer_data_u = u_nominal.clone()
+    def stored_buffers(self):
+        """
+        Return the memory-mapped buffers that have been written to. The others stay
+        empty, e.g. the state buffer of the residual-only datasets.
+        """
+        buffers = [self.buffer_data_s, self.buffer_data_s_diff, self.buffer_data_u_NN, self.buffer_data_u]
+        return [buffer for buffer in buffers if buffer.dtype is not None]
+
+    def open_store(self):
+        """
+        Bring the memory-mapped buffers to the number of rows recorded in the header
+        path/dataset.json, dropping the rows of an add that did not complete.
+
+        raises:
+            RuntimeError if a buffer holds fewer rows than recorded
+        """
+        buffers = [] if self.path is None else self.stored_buffers()
+        if not buffers:
+            return
+
+        header = os.path.join(self.path, 'dataset.json')
+        if os.path.exists(header):
+            with open(header) as f:
+                n_rows = json.load(f)['n_rows']
         else:
-            self.buffer_data_u = torch.vstack((self.buffer_data_u, u_nominal.clone()))
+            # Buffers written before the shared count: each recorded its own rows, and
+            # the buffers were appended in lockstep, so the shortest one is consistent
+            n_rows = min(buffer.n_rows for buffer in buffers)
+
+        for buffer in buffers:
+            buffer.truncate(n_rows)
+
+    def commit(self):
+        """
+        Record the number of rows of the memory-mapped buffers in path/dataset.json.
+        Called once all the buffers have been appended to, so that a crash in between
+        leaves the previous count, see open_store.
+        """
+        if self.path is None:
+            return
 
-        self.buffer_data_s = self.buffer_data_s[-self.buffer_size:]
-        self.buffer_data_s_diff = self.buffer_data_s_diff[-self.buffer_size:]
-        self.buffer_data_u_NN = self.buffer_data_u_NN[-self.buffer_size:]
-        self.buffer_data_u = self.buffer_data_u[-self.ns:]
+        n_rows = {buffer.n_rows for buffer in self.stored_buffers()}
+        if not n_rows:
+            return
+        if len(n_rows) > 1:
+            raise RuntimeError(f"The buffers of {self.path} hold different numbers of rows: {sorted(n_rows)}")
 
-        # Get a new set of permuted indices
-        self.permuted_indices = torch.randperm(self.n_pts)
+        header = os.path.join(self.path, 'dataset.json')
+        with open(header + '.tmp', 'w') as f:
+            json.dump({'n_rows': n_rows.pop()}, f)
+        os.replace(header + '.tmp', header)
 
     @property
     def n_pts(self):
-        if self.buffer_data_s.shape[0] == 0:
-            return self.buffer_data_s_diff.shape[0]
+        if len(self.buffer_data_s) == 0:
+            return len(self.buffer_data_s_diff)
         else:
-            return self.buffer_data_s.shape[0]
+            return len(self.buffer_data_s)
 
     @property
     def n_pts_gamma(self):
-        return self.buffer_data_u.shape[0]
+        return len(self.buffer_data_u)
+
+    def get_permuted_indices(self):
+        """
+        Return the current permutation of the buffer, redrawing it if data was added
+        since the last call.
+        """
+        if self.permute_pending:
+            self.permuted_indices = torch.randperm(self.n_pts)
+            self.permute_pending = False
+
+        return self.permuted_indices
+
+    def state_dict(self):
+        """
+        returns:
+            the sampling state of the dataset: its current permutation and whether it
+            is redrawn on the next sample. The stored samples are not included, keep
+            them across runs with path.
+        """
+        return {"permuted_indices": self.permuted_indices, "permute_pending": self.permute_pending,
+                "n_pts": self.n_pts}
+
+    def load_state_dict(self, state):
+        self.permuted_indices = state["permuted_indices"]
+        # A permutation of a buffer of another size is of no use, redraw it
+        self.permute_pending = state["permute_pending"] or state["n_pts"] != self.n_pts
+
+    def take(self, buffer, indices):
+        """
+        Gather the samples of one data buffer at the given sample indices.
+        """
+        return buffer[indices]
+
+    def take_label(self, indices):
+        """
+        Gather the gamma labels at the given sample indices.
+        """
+        return self.buffer_data_u[indices]
 
     def sample_data(self, batch_size, index):
         """
@@ -99,19 +441,19 @@ class Dataset_with_Grad(object):
             indices_end -= extra_pts_needed
 
         # Get the slice of randomly permuted indices
-        indices = self.permuted_indices[indices_init:indices_end]
+        indices = self.get_permuted_indices()[indices_init:indices_end]
         # print(index)
         # print(batch_size)
         # print((indices_init, indices_end))
         # print(indices[:10])
 
         # Sample data from those indices.
-        s = self.buffer_data_s[indices, :]
+        s = self.take(self.buffer_data_s, indices)
 
         # Not sure what's happening here. Looks like we're not sampling control values?
         # Probably OK since these return values aren't being used.
         # if self.train_u > 0:
-        #     u_NN = self.buffer_data_u_NN[indices, :]
+        #     u_NN = self.take(self.buffer_data_u_NN, indices)
         #     u = self.buffer_data_u[indices, :]
         #     u = np.array(u)
         # else:
@@ -155,13 +497,13 @@ class Dataset_with_Grad(object):
                 indices_end -= extra_pts_needed
 
             # Get the slice of randomly permuted indices
-            indices = self.permuted_indices[indices_init:indices_end]
+            indices = self.get_permuted_indices()[indices_init:indices_end]
 
-            s = self.buffer_data_s[indices, :]
-            s_diff = self.buffer_data_s_diff[indices, :]
-            u = self.buffer_data_u_NN[indices, :]
+            s = self.take(self.buffer_data_s, indices)
+            s_diff = self.take(self.buffer_data_s_diff, indices)
+            u = self.take(self.buffer_data_u_NN, indices)
 
-            gamma = self.buffer_data_u[indices]
+            gamma = self.take_label(indices)
 
             return s, s_diff, u, gamma
 
@@ -188,10 +530,114 @@ class Dataset_with_Grad(object):
                 indices_end -= extra_pts_needed
 
             # Get the slice of randomly permuted indices
-            indices = self.permuted_indices[indices_init:indices_end]
+            indices = self.get_permuted_indices()[indices_init:indices_end]
+
+            s_diff = self.take(self.buffer_data_s_diff, indices)
+
+            gamma = self.take_label(indices)
+
+            return s_diff, gamma
+
+
+class Dataset_with_Grad(Dataset_buffers):
+
+    def add_data(self, state, state_diff, u, u_nominal):
+        """
+        args:
+            state (bs, ...): output trajectories of the agent
+            state_diff (bs, ...): residual trajectories w.r.t. the no-fault twin
+            u (bs, ...): the applied control trajectories
+            u_nominal (bs, m_control): the gamma label of each sample
+        """
+        self.buffer_data_s.add(state)
+        self.buffer_data_s_diff.add(state_diff)
+        self.buffer_data_u_NN.add(u)
+        self.buffer_data_u.add(u_nominal)
+        self.commit()
+
+        # Get a new set of permuted indices before the next sample
+        self.permute_pending = True
+
+
+class Dataset_windowed(Dataset_buffers):
+
+    def __init__(self, y_state, n_state, m_control, train_u, buffer_size=200000, traj_len=100, path=None):
+        """
+        Counterpart of Dataset_with_Grad that stores each rollout once, as (n_sample, T, dim),
+        instead of every (n_sample, traj_len, dim) window of it. A sample is a
+        (rollout, start step) pair and its window is gathered at sample time, which
+        cuts the memory of the buffers by a factor of about traj_len.
+
+        args:
+            buffer_size: number of windows to keep, as in Dataset_with_Grad
+            path: optional directory for memory-mapped storage, as in Dataset_with_Grad
+        """
+        self.n_windows = 0
+        super().__init__(y_state, n_state, m_control, train_u, buffer_size=buffer_size, traj_len=traj_len, path=path)
+
+        # Rollouts stored by a previous run fix the number of windows per rollout
+        if isinstance(self.buffer_data_u, MemmapBuffer) and self.buffer_data_u.shape is not None:
+            self.make_rollout_buffers(self.buffer_data_u.shape[0])
+            self.permute_pending = self.n_pts > 0
+
+    def make_rollout_buffers(self, n_windows):
+        """
+        Size the buffers in rollouts, keeping as many as needed to hold buffer_size
+        windows.
+        """
+        self.n_windows = n_windows
+        n_rollouts = max(1, -(-self.buffer_size // n_windows))
+        self.buffer_data_s = self.make_buffer('state', n_rollouts)
+        self.buffer_data_s_diff = self.make_buffer('state_diff', n_rollouts)
+        self.buffer_data_u_NN = self.make_buffer('u', n_rollouts)
+        self.buffer_data_u = self.make_buffer('gamma', n_rollouts)
+        self.open_store()
+
+    def add_traj(self, state_traj, state_traj_diff, u_traj, gamma_traj):
+        """
+        args:
+            state_traj (n_sample, T, y_state): output rollouts of the agent
+            state_traj_diff (n_sample, T, y_state): residual rollouts w.r.t. the no-fault twin
+            u_traj (n_sample, T, m_control): the applied control rollouts
+            gamma_traj (n_sample, T, m_control): gamma label of the window ending at each
+                step; the first traj_len - 1 steps are ignored
+        """
+        n_windows = gamma_traj.shape[1] - self.traj_len + 1
+        assert n_windows > 0
+
+        if self.n_windows == 0:
+            self.make_rollout_buffers(n_windows)
+        assert n_windows == self.n_windows
+
+        self.buffer_data_s.add(state_traj)
+        self.buffer_data_s_diff.add(state_traj_diff)
+        self.buffer_data_u_NN.add(u_traj)
+        self.buffer_data_u.add(gamma_traj[:, self.traj_len - 1:])
+        self.commit()
+
+        self.permute_pending = True
+
+    @property
+    def n_pts(self):
+        if len(self.buffer_data_s) == 0:
+            return len(self.buffer_data_s_diff) * self.n_windows
+        else:
+            return len(self.buffer_data_s) * self.n_windows
+
+    @property
+    def n_pts_gamma(self):
+        return len(self.buffer_data_u) * self.n_windows
+
+    def take(self, buffer, indices):
+        """
+        Gather the (batch, traj_len, dim) windows of one rollout buffer.
+        """
+        rows = buffer.index(torch.div(indices, self.n_windows, rounding_mode='floor'))
+        steps = torch.remainder(indices, self.n_windows).reshape(-1, 1) + torch.arange(self.traj_len, device=indices.device)
 
-            s_diff = self.buffer_data_s_diff[indices, :]
+        return buffer.gather(rows.reshape(-1, 1), steps)
 
-            gamma = self.buffer_data_u[indices]
+    def take_label(self, indices):
+        rows = self.buffer_data_u.index(torch.div(indices, self.n_windows, rounding_mode='floor'))
 
-            return s_diff, gamma
\ No newline at end of file
+        return self.buffer_data_u.gather(rows, torch.remainder(indices, self.n_windows))
@@ -1,8 +1,11 @@
+import random
 import torch
 from torch import nn
 import numpy as np
 from pytictoc import TicToc
 from .FxTS_GF import FxTS_Momentum
+from .datagen import BatchLoader
+from .utils import Utils
 
 # torch.autograd.set_detect_anomaly(True)
 
@@ -11,6 +14,14 @@ t = TicToc()
 
 class Trainer(object):
 
+    # Attributes saved by state_dict, when the trainer has them and they are not None
+    OPTIMIZERS = ("cbf_optimizer", "gamma_optimizer", "controller_optimizer", "alpha_optimizer")
+    LR_SCHEDULERS = ("cbf_lr_scheduler",)
+    GRAD_SCALERS = ("gamma_scaler",)
+
+    # Autocast dtypes of the amp modes
+    AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
     def __init__(self,
                  cbf,
                  controller,
@@ -30,7 +41,8 @@ class Trainer(object):
                  fault=0,
                  fault_control_index=-1,
                  model_factor=0, 
-                 device = 'cpu'):
+                 device = 'cpu',
+                 amp=None):
 
         self.params = params
         self.n_state = n_state
@@ -64,11 +76,23 @@ class Trainer(object):
 
         self.dt = dt
 
+        # differentiable CBF-QP used to filter the controller in train_cbf_and_controller
+        self.util = Utils(dyn=dyn, params=params, n_state=n_state, m_control=m_control, j_const=j_const, dt=dt,
+                          fault=fault, fault_control_index=fault_control_index)
+
         self.action_loss_weight = action_loss_weight
         # if gpu_id >=0, use gpu in training
         self.gpu_id = gpu_id
         self.device = device
 
+        # Mixed precision of the gamma training: None for fp32, else a key of AMP_DTYPES.
+        # The gamma forward pass runs under autocast, the loss and the accuracy metrics
+        # stay in fp32, and fp16 gradients go through a GradScaler
+        if amp is not None and amp not in self.AMP_DTYPES:
+            raise ValueError(f"Unknown amp mode: {amp}")
+        self.amp = amp
+        self.gamma_scaler = self.make_grad_scaler(device) if amp == "fp16" else None
+
         # the learning rate is decayed when self.train_cbf_and_controller is called
         # lr_decay_stepsize times
         self.lr_decay_stepsize = lr_decay_stepsize
@@ -76,8 +100,81 @@ class Trainer(object):
             self.cbf_lr_scheduler = torch.optim.lr_scheduler.StepLR(
                 self.cbf_optimizer, step_size=lr_decay_stepsize, gamma=0.5)
 
+    @staticmethod
+    def make_grad_scaler(device):
+        """
+        returns:
+            a GradScaler for device; torch.amp.GradScaler only exists from torch 2.3 on,
+            older versions only have the CUDA one
+        """
+        if hasattr(torch.amp, "GradScaler"):
+            return torch.amp.GradScaler(torch.device(device).type)
+        return torch.cuda.amp.GradScaler()
+
+    def gamma_step(self, loss):
+        """
+        Backward pass of loss and step of the gamma optimizer, through the grad scaler
+        in fp16. The gradients must have been zeroed.
+        """
+        if self.gamma_scaler is None:
+            loss.backward()
+            self.gamma_optimizer.step()
+        else:
+            self.gamma_scaler.scale(loss).backward()
+            self.gamma_scaler.step(self.gamma_optimizer)
+            self.gamma_scaler.update()
+
+    def autocast(self):
+        """
+        returns:
+            the autocast context of the amp mode, disabled when amp is None
+        """
+        return torch.autocast(torch.device(self.device).type, dtype=self.AMP_DTYPES.get(self.amp),
+                              enabled=self.amp is not None)
+
+    def state_dict(self):
+        """
+        The training state that the networks' own state dicts do not cover, so that a
+        run can be resumed where it stopped instead of restarting the optimizers
+        returns:
+            state: dict of the optimizer, LR scheduler and grad scaler states, the torch, numpy and
+                   python RNG states and the sampling state of the dataset
+        """
+        state = {}
+        for name in self.OPTIMIZERS + self.LR_SCHEDULERS + self.GRAD_SCALERS:
+            if getattr(self, name, None) is not None:
+                state[name] = getattr(self, name).state_dict()
+
+        state["rng"] = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+        if torch.cuda.is_available():
+            state["rng"]["cuda"] = torch.cuda.get_rng_state_all()
+
+        if self.dataset is not None:
+            state["dataset"] = self.dataset.state_dict()
+
+        return state
+
+    def load_state_dict(self, state):
+        """
+        Restore a state returned by state_dict. The networks are restored separately,
+        and must be loaded before the optimizers.
+        """
+        for name in self.OPTIMIZERS + self.LR_SCHEDULERS + self.GRAD_SCALERS:
+            if name in state and getattr(self, name, None) is not None:
+                getattr(self, name).load_state_dict(state[name])
+
+        rng = state["rng"]
+        torch.set_rng_state(rng["torch"])
+        np.random.set_state(rng["numpy"])
+        random.setstate(rng["python"])
+        if "cuda" in rng and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng["cuda"])
+
+        if "dataset" in state and self.dataset is not None:
+            self.dataset.load_state_dict(state["dataset"])
+
     # noinspection PyProtectedMember,PyUnboundLocalVariable
-    def train_cbf_and_controller(self, iter_NN=0, eps=0.1, eps_deriv=0.03, train_CF=0):
+    def train_cbf_and_controller(self, iter_NN=0, eps=0.1, eps_deriv=0.03, train_CF=0, qp_filter=0):
         batch_size = 4000 + int(iter_NN / 4) * 2000
         opt_iter = int(self.dataset.n_pts / batch_size)
         loss_np = 0.0
@@ -95,16 +192,10 @@ class Trainer(object):
         u_nominal = 0.1 * torch.ones(batch_size, self.m_control)
         dang_loss = 1
         if self.fault == 1:
-            um, ul = self.dyn.control_limits()
+            um, ul = self.dyn.cached_limits("control", self.gpu_device(), torch.float32)
             um = um.reshape(1, self.m_control).repeat(batch_size, 1)
             ul = ul.reshape(1, self.m_control).repeat(batch_size, 1)
 
-            um = um.type(torch.FloatTensor)
-            ul = ul.type(torch.FloatTensor)
-            if self.gpu_id >= 0:
-                um = um.cuda(self.gpu_id)
-                ul = ul.cuda(self.gpu_id)
-
         for j in range(10):
             # if j<5:
             #     deriv_factor = 0
@@ -128,6 +219,13 @@ class Trainer(object):
                 h, grad_h = self.cbf.V_with_jacobian(state)
                 alpha = self.alpha(state)
 
+                if qp_filter == 1:
+                    # Train through the CBF-QP that filters the controller at test time
+                    fx = self.dyn._f(state, self.params)
+                    gx = self.dyn._g(state, self.params)
+                    u = self.util.cbf_qp_layer(u, fx, gx, h, grad_h.reshape(batch_size, 1, self.n_state),
+                                               fault_start=self.fault)
+
                 dsdt = self.nominal_dynamics(state, u.reshape(batch_size, self.m_control, 1))
 
                 dsdt = torch.reshape(dsdt, (batch_size, self.n_state))
@@ -265,15 +363,9 @@ class Trainer(object):
         acc_np = np.zeros((5,), dtype=np.float32)
         # print("training only CBF")
         # t.tic()
-        um, ul = self.dyn.control_limits()
+        um, ul = self.dyn.cached_limits("control", self.gpu_device(), torch.float32)
         um = um.reshape(1, self.m_control).repeat(batch_size, 1)
         ul = ul.reshape(1, self.m_control).repeat(batch_size, 1)
-
-        um = um.type(torch.FloatTensor)
-        ul = ul.type(torch.FloatTensor)
-        if self.gpu_id >= 0:
-            um = um.cuda(self.gpu_id)
-            ul = ul.cuda(self.gpu_id)
         
         opt_count = 100
         for _ in range(opt_count):
@@ -377,15 +469,8 @@ class Trainer(object):
         if batch_size > self.dataset.n_pts:
             batch_size = self.dataset.n_pts
 
-        um, _ = self.dyn.control_limits()
+        um, _ = self.dyn.cached_limits("control", self.device if self.gpu_id >= 0 else None, torch.float32)
         um = um.reshape(1, self.m_control).repeat(batch_size, 1)
-        # ul = ul.reshape(1, self.m_control).repeat(batch_size, 1)
-
-        um = um.type(torch.FloatTensor)
-        # ul = ul.type(torch.FloatTensor)
-        if self.gpu_id >= 0:
-            um = um.to(self.device)
-            # ul = ul.cuda(self.gpu_id)
         
         opt_iter = int(self.dataset.n_pts / batch_size)
 
@@ -509,50 +594,29 @@ class Trainer(object):
         
         # acc = 0.0
         acc_np = torch.zeros(1, 2 * self.m_control).to(self.device)
-        acc_ind_temp = torch.zeros(1, 2 * self.m_control).to(self.device)
         
         self.gamma.to(self.device)
 
+        # state_diff is only fed to the model when model_factor is 1
+        loader = BatchLoader(self.dataset, batch_size, device=self.device, drop=(1,) if self.model_factor == 0 else ())
+
         for _ in range(opt_count):
             # self.gpu_id = np.mod(iter, 4)
     
-            for i in range(opt_iter):
-                loss = torch.tensor(0.0)
-                if self.model_factor == 0:
-                    state, _, u, gamma_actual = self.dataset.sample_data_all(batch_size, i)
-                else:
-                    state, state_diff, u, gamma_actual = self.dataset.sample_data_all(batch_size, i)
-                
-                # if self.gpu_id >= 0:
-                    # state_diff = state_diff.cuda(self.gpu_id)
-                state = state.to(self.device)
-                if self.model_factor == 1:
-                    state_diff = state_diff.to(self.device)
-                u = u.to(self.device)
-                gamma_actual = gamma_actual.to(self.device)
-                loss = loss.to(self.device)
-                if self.model_factor == 0:
-                    gamma_data = self.gamma_gen(state, u)
-                else:
-                    state_data = torch.cat((state, state_diff), dim=-1)
-                    gamma_data = self.gamma_gen(state_data, u)
+            for state, state_diff, u, gamma_actual in loader:
+                with self.autocast():
+                    if self.model_factor == 0:
+                        gamma_data = self.gamma_gen(state, u)
+                    else:
+                        state_data = torch.cat((state, state_diff), dim=-1)
+                        gamma_data = self.gamma_gen(state_data, u)
+                gamma_data = gamma_data.float()
 
                 index_fault = gamma_actual < 0.5
 
                 index_no_fault = gamma_actual >= 0.5
 
-                index_num = torch.sum(index_fault.float(), dim=0)
-                index_num_no_fault = torch.sum(index_no_fault.float(), dim=0)
-
-                acc_ind_temp[0, 0:self.m_control] = torch.sum((torch.abs(gamma_data - gamma_actual) < eps).float() * index_fault.float(), dim=0) / (torch.sum(index_fault.float(), dim=0) + 1e-5)
-                acc_ind_temp[0, self.m_control:2 * self.m_control] = torch.sum((torch.abs(gamma_data - gamma_actual) < eps).float() * index_no_fault.float(), dim=0) / (torch.sum(index_no_fault.float(), dim=0) + 1e-5)
-                
-                index_ones = torch.cat((index_num == 0, index_num_no_fault == 0), dim=0)
-
-                acc_ind_temp[0, index_ones] = torch.ones(torch.sum(index_ones).item()).to(self.device)
-
-                loss += 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_fault] - gamma_actual[index_fault]) - eps)) / (torch.sum(index_fault.float()) + 1e-5) / (torch.sum(acc_ind_temp[0, 0:self.m_control]).item() + 1e-5)
-                loss += 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_no_fault] - gamma_actual[index_no_fault]) - eps)) / (torch.sum(index_no_fault.float()) + 1e-5) / (torch.sum(acc_ind_temp[0, self.m_control:2 * self.m_control]).item() + 1e-5)
+                loss, acc_ind_temp = self.gamma_loss(gamma_data, gamma_actual, index_fault, index_no_fault, eps)
                 # loss += 10 * torch.sum(nn.BCEWithLogitsLoss(reduction='none')(gamma_data[index_fault], gamma_actual[index_fault])) / (torch.sum(index_fault.float()) + 1e-5)  / (torch.sum(acc_ind_temp[0, 0:self.m_control]).detach().item() + 1e-5)
                 # loss += 10 * torch.sum(nn.BCEWithLogitsLoss(reduction='none')(gamma_data[index_no_fault], gamma_actual[index_no_fault]) ) / (torch.sum(index_no_fault.float()) + 1e-5) / (torch.sum(acc_ind_temp[0, self.m_control:2 * self.m_control]).detach().item() + 1e-5)
                 # for j in range(self.m_control):
@@ -585,9 +649,7 @@ class Trainer(object):
 
                 self.gamma_optimizer.zero_grad(set_to_none=True)
 
-                loss.backward()
-
-                self.gamma_optimizer.step()
+                self.gamma_step(loss)
 
                 acc_np += acc_ind_temp.detach()
 
@@ -622,45 +684,29 @@ class Trainer(object):
         
         # acc = 0.0
         acc_np = torch.zeros(1, 2 * self.m_control).to(self.device)
-        acc_ind_temp = torch.zeros(1, 2 * self.m_control).to(self.device)
         
         self.gamma.to(self.device)
 
+        loader = BatchLoader(self.dataset, batch_size, sample_fn='sample_only_res', device=self.device)
+
         for _ in range(opt_count):
             # self.gpu_id = np.mod(iter, 4)
     
-            for i in range(opt_iter):
-                loss = torch.tensor(0.0)
+            for state_diff, gamma_actual in loader:
                 
-                state_diff, gamma_actual = self.dataset.sample_only_res(batch_size, i)
-
-                state_diff = state_diff.to(self.device)
-                gamma_actual = gamma_actual.to(self.device)
-                loss = loss.to(self.device)
-                gamma_data = self.gamma(state_diff)
+                with self.autocast():
+                    gamma_data = self.gamma(state_diff)
+                gamma_data = gamma_data.float()
                 
                 index_fault = gamma_actual < 0.5
 
                 index_no_fault = gamma_actual >= 0.5
 
-                index_num = torch.sum(index_fault.float(), dim=0)
-                index_num_no_fault = torch.sum(index_no_fault.float(), dim=0)
-
-                acc_ind_temp[0, 0:self.m_control] = torch.sum((torch.abs(gamma_data - gamma_actual) < eps).float() * index_fault.float(), dim=0) / (torch.sum(index_fault.float(), dim=0) + 1e-5)
-                acc_ind_temp[0, self.m_control:2 * self.m_control] = torch.sum((torch.abs(gamma_data - gamma_actual) < eps).float() * index_no_fault.float(), dim=0) / (torch.sum(index_no_fault.float(), dim=0) + 1e-5)
-                
-                index_ones = torch.cat((index_num == 0, index_num_no_fault == 0), dim=0)
-
-                acc_ind_temp[0, index_ones] = torch.ones(torch.sum(index_ones).item()).to(self.device)
-
-                loss += 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_fault] - gamma_actual[index_fault]) - eps)) / (torch.sum(index_fault.float()) + 1e-5) / (torch.sum(acc_ind_temp[0, 0:self.m_control]).item() + 1e-5)
-                loss += 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_no_fault] - gamma_actual[index_no_fault]) - eps)) / (torch.sum(index_no_fault.float()) + 1e-5) / (torch.sum(acc_ind_temp[0, self.m_control:2 * self.m_control]).item() + 1e-5)
+                loss, acc_ind_temp = self.gamma_loss(gamma_data, gamma_actual, index_fault, index_no_fault, eps)
                 
                 self.gamma_optimizer.zero_grad(set_to_none=True)
 
-                loss.backward()
-
-                self.gamma_optimizer.step()
+                self.gamma_step(loss)
 
                 acc_np += acc_ind_temp.detach()
 
@@ -696,64 +742,39 @@ class Trainer(object):
         
         # acc = 0.0
         acc_np = torch.zeros(1, 2 * self.m_control)
-        acc_ind_temp = torch.zeros(1, 2 * self.m_control)
         
         # if self.gpu_id >= 0:
         #     self.gamma.to(torch.device(self.gpu_id))
         #     acc_np = acc_np.cuda(self.gpu_id)
-        #     acc_ind_temp = acc_ind_temp.cuda(self.gpu_id)
         self.gamma.to(self.device)
         acc_np = acc_np.to(self.device)
-        acc_ind_temp = acc_ind_temp.to(self.device)
+
+        # state_diff is only fed to the model when model_factor is 1
+        loader = BatchLoader(self.dataset, batch_size, device=self.device, drop=(1,) if self.model_factor == 0 else ())
 
         for _ in range(opt_count):
     
-            for i in range(opt_iter):
-                loss = torch.tensor(0.0)
-                if self.model_factor == 0:
-                    state, _, u, gamma_actual = self.dataset.sample_data_all(batch_size, i)
-                else:
-                    state, state_diff, u, gamma_actual = self.dataset.sample_data_all(batch_size, i)
-                
-                if self.gpu_id >= 0:
-                    # state = state.cuda(self.gpu_id)
-                    state = state.to(self.device)
-                    if self.model_factor == 1:
-                        # state_diff = state_diff.cuda(self.gpu_id)
-                        state_diff = state_diff.to(self.device)
-                    # u = u.cuda(self.gpu_id)
-                    u = u.to(self.device)
-                    # gamma_actual = gamma_actual.cuda(self.gpu_id)
-                    gamma_actual = gamma_actual.to(self.device)
-                    # loss = loss.cuda(self.gpu_id)
-                    loss = loss.to(self.device)
-                if self.model_factor == 0:
-                    gamma_data = self.gamma_gen(state, u)
-                else:
-                    state_data = torch.cat((state, state_diff), dim=-1)
-                    gamma_data = self.gamma_gen(state_data, u)
+            for state, state_diff, u, gamma_actual in loader:
+                with self.autocast():
+                    if self.model_factor == 0:
+                        gamma_data = self.gamma_gen(state, u)
+                    else:
+                        state_data = torch.cat((state, state_diff), dim=-1)
+                        gamma_data = self.gamma_gen(state_data, u)
+                gamma_data = gamma_data.float()
 
                 index_fault = gamma_actual < 1.0
                 index_no_fault = gamma_actual > 0.95
-                
-                index_num = torch.sum(index_fault.float(), dim=0)
-                index_num_no_fault = torch.sum(index_no_fault.float(), dim=0)
-
-                acc_ind_temp[0, 0:self.m_control] = torch.sum((torch.abs(gamma_data - gamma_actual) < eps).float() * index_fault.float(), dim=0) / (torch.sum(index_fault.float(), dim=0) + 1e-5)
-                acc_ind_temp[0, self.m_control:2 * self.m_control] = torch.sum((torch.abs(gamma_data - gamma_actual) < eps).float() * index_no_fault.float(), dim=0) / (torch.sum(index_no_fault.float(), dim=0) + 1e-5)
-                
-                index_ones = torch.cat((index_num == 0, index_num_no_fault == 0), dim=0)
 
-                acc_ind_temp[0, index_ones] = torch.ones(torch.sum(index_ones).item()).to(self.device)
+                # Each actuator is normalized by its own sample count and accuracy
+                loss, acc_ind_temp = self.gamma_loss(gamma_data, gamma_actual, index_fault, index_no_fault, eps,
+                                                     per_actuator=True)
 
                 # loss += 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_fault] - gamma_actual[index_fault]) - eps)) / (torch.sum(index_fault.float()) + 1e-5) / (torch.sum(acc_ind_temp[0, 0:self.m_control].detach()) + 1e-5)
                 # loss += 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_no_fault] - gamma_actual[index_no_fault]) - eps)) / (torch.sum(index_no_fault.float()) + 1e-5) / (torch.sum(acc_ind_temp[0, self.m_control:2 * self.m_control].detach()) + 1e-5)
                 # loss = 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_fault] - gamma_actual[index_fault]) - eps) / (acc_ind_temp[0:self.m_control] + 1e-5)) / (torch.sum(index_fault.float()) + 1e-5)
                 # loss += 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_no_fault] - gamma_actual[index_no_fault]) - eps) / (acc_ind_temp[self.m_control:2 * self.m_control] + 1e-5)) / (torch.sum(index_no_fault.float()) + 1e-5)
-                for j in range(self.m_control):
-                    loss += 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_fault[:, j], j] - gamma_actual[index_fault[:, j], j]) - eps)) / (index_num[j] + 1e-5) / (acc_ind_temp[0, j].detach() + 1e-5)                
-                    loss += 10 * torch.sum(nn.ReLU()(torch.abs(gamma_data[index_no_fault[:, j], j] - gamma_actual[index_no_fault[:, j], j]) - eps)) / (index_num_no_fault[j] + 1e-5) / (acc_ind_temp[0, j + self.m_control].detach() + 1e-5)
-                
+
                 # for j in range(self.m_control):
                 #     index_fault = gamma_actual[:, j] < 1.0
                     
@@ -777,9 +798,7 @@ class Trainer(object):
 
                 self.gamma_optimizer.zero_grad(set_to_none=True)
 
-                loss.backward()
-
-                self.gamma_optimizer.step()
+                self.gamma_step(loss)
 
                 acc_np += acc_ind_temp.detach()
 
@@ -796,6 +815,41 @@ class Trainer(object):
 
         return loss_np, acc_np
 
+    def gamma_loss(self, gamma_data, gamma_actual, index_fault, index_no_fault, eps, per_actuator=False):
+        """
+        Loss and accuracy of the gamma networks. The masks weight the per-sample terms
+        instead of selecting them, so that nothing is read back to the host and all the
+        shapes are static.
+        args:
+            gamma_data (bs, m_control): the predicted gamma
+            gamma_actual (bs, m_control): the gamma labels
+            index_fault (bs, m_control): mask of the faulty labels
+            index_no_fault (bs, m_control): mask of the healthy labels
+            eps: errors below eps count as accurate and are not penalized
+            per_actuator: normalize the loss of each actuator by its own sample count and
+                          accuracy, instead of by the totals over the actuators
+        returns:
+            loss: the loss, each term weighted by the inverse of its (detached) accuracy
+            acc_ind_temp (1, 2 * m_control): the accuracy on the faulty then healthy
+                                             labels of each actuator, 1 if it has none
+        """
+        mask = torch.cat((index_fault, index_no_fault), dim=1).float()
+        error = torch.abs(gamma_data - gamma_actual).repeat(1, 2)
+
+        index_num = torch.sum(mask, dim=0)
+        acc_ind_temp = torch.sum((error < eps).float() * mask, dim=0) / (index_num + 1e-5)
+        acc_ind_temp = torch.where(index_num == 0, torch.ones_like(acc_ind_temp), acc_ind_temp)
+
+        error_sum = torch.sum(nn.ReLU()(error - eps) * mask, dim=0)
+        acc = acc_ind_temp.detach()
+        if not per_actuator:
+            error_sum = error_sum.reshape(2, self.m_control).sum(dim=1)
+            index_num = index_num.reshape(2, self.m_control).sum(dim=1)
+            acc = acc.reshape(2, self.m_control).sum(dim=1)
+        loss = 10 * torch.sum(error_sum / (index_num + 1e-5) / (acc + 1e-5))
+
+        return loss, acc_ind_temp.reshape(1, 2 * self.m_control)
+
     def doth_max(self, h, state, grad_h, um, ul):
         bs = grad_h.shape[0]
 
@@ -875,6 +929,15 @@ class Trainer(object):
 
         return doth.reshape(1, bs)
 
+    def gpu_device(self):
+        """
+        returns:
+            the cuda device selected by gpu_id, None (cpu) if gpu_id < 0
+        """
+        if self.gpu_id >= 0:
+            return torch.device("cuda", self.gpu_id)
+        return None
+
     def get_mask(self, state):
         """
         args:
@@ -28,6 +28,145 @@ A = scipy.sparse.csc.csc_matrix(A)
 
 m.setup(P=P, q=q, A=A, u=u, verbose=False)
 
+class QPWorkspace(object):
+    """
+    Persistent OSQP workspace for the single-sample CBF-QP in z = [u, a],
+        min_z 1/2 z^T diag(P) z + q^T z  s.t.  l <= [cbf_row; I] z <= u.
+    The sparsity pattern is the same at every control step, so OSQP is set up once
+    and later steps only update the data and warm start from the previous solution.
+    Use one workspace per simulated trajectory.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.qp = None
+        self.P = None
+
+    def solve(self, P, q, cbf_row, l, u):
+        """
+        args:
+            P (size,) diagonal of the cost
+            q (size,)
+            cbf_row (size,)
+            l, u (size + 1,) bounds of the CBF row and of z
+        returns:
+            z (size,), None if OSQP does not solve the QP
+        """
+        # Every column of A holds its CBF coefficient and then the 1 of its box row
+        A_data = np.ones(2 * self.size)
+        A_data[0::2] = cbf_row
+
+        if self.qp is None:
+            A = vstack((csc_matrix(np.ones((1, self.size))), identity(self.size)), format='csc')
+            A.data = A_data
+            self.qp = OSQP()
+            self.qp.setup(P=csc_matrix(np.diag(P)), q=q, A=A, l=l, u=u, verbose=False, warm_start=True, polish=True,
+                          eps_abs=1e-6, eps_rel=1e-6)
+        else:
+            if not np.array_equal(P, self.P):
+                self.qp.update(Px=P)
+            self.qp.update(q=q, l=l, u=u, Ax=A_data)
+        self.P = P.copy()
+
+        results = self.qp.solve()
+
+        if results.info.status_val not in (1, 2):
+            return None
+
+        return results.x
+
+
+class CBFQPFunction(torch.autograd.Function):
+    """
+    Batched Euclidean projection onto one half-space intersected with a box,
+        min_z ||z - z_nom||^2  s.t.  g^T z >= b,  z_min <= z <= z_max,
+    which is the CBF-QP with an isotropic cost. The KKT conditions give
+    z = clamp(z_nom + lam * g) for a multiplier lam >= 0, and g^T z is piecewise
+    linear and nondecreasing in lam, with a kink wherever a coordinate hits its
+    bound. Evaluating it at all 2 * dim kinks brackets lam exactly.
+
+    The backward pass differentiates the KKT conditions on the active set: clamped
+    coordinates are constant, and when the CBF row is active the free coordinates
+    satisfy z_F = z_nom_F + lam * g_F with g^T z = b. The bounds get no gradient.
+    """
+
+    @staticmethod
+    def forward(ctx, z_nom, g, b, z_max, z_min):
+        """
+        args:
+            z_nom (bs, dim)
+            g (bs, dim)
+            b (bs,)
+            z_max, z_min (dim,) or (bs, dim)
+        returns:
+            z (bs, dim) the minimizers
+            feasible (bs,) False where no point of the box meets the constraint
+        """
+        z, lam, feasible = CBFQPFunction.solve(z_nom, g, b, z_max, z_min)
+
+        ctx.mark_non_differentiable(feasible)
+        ctx.save_for_backward(z, g, lam, (z > z_min) & (z < z_max))
+
+        return z, feasible
+
+    @staticmethod
+    def backward(ctx, grad_z, grad_feasible):
+        z, g, lam, free = ctx.saved_tensors
+
+        v = grad_z * free
+        g_free = g * free
+
+        # Sensitivity of the multiplier, zero where the CBF row is inactive
+        active = lam > 0
+        g_norm = torch.sum(g_free ** 2, dim=1, keepdim=True)
+        w = torch.where(active & (g_norm > 0), torch.sum(v * g_free, dim=1, keepdim=True) / torch.where(g_norm > 0, g_norm, torch.ones_like(g_norm)), torch.zeros_like(g_norm))
+
+        grad_z_nom = v - w * g_free
+        grad_b = w.reshape(-1)
+        grad_g = lam * v - w * (z + lam * g_free)
+
+        return grad_z_nom, grad_g, grad_b, None, None
+
+    @staticmethod
+    def solve(z_nom, g, b, z_max, z_min):
+        """
+        returns:
+            z (bs, dim) the minimizers
+            lam (bs, 1) the multiplier of the CBF row
+            feasible (bs,)
+        """
+        bs, dim = z_nom.shape
+
+        # Multipliers at which each coordinate of z_nom + lam * g reaches a bound
+        g_safe = torch.where(g == 0, torch.ones_like(g), g)
+        lam_bound = torch.cat(((z_max - z_nom) / g_safe, (z_min - z_nom) / g_safe), dim=1)
+        lam_bound = torch.where(torch.cat((g, g), dim=1) == 0, torch.zeros_like(lam_bound), lam_bound)
+        lam = torch.cat((torch.zeros(bs, 1).type_as(z_nom), torch.clamp(lam_bound, min=0)), dim=1)
+        lam, _ = torch.sort(lam, dim=1)
+
+        # Constraint value g^T clamp(z_nom + lam * g) at every kink, (bs, 2 * dim + 1)
+        z_kink = torch.minimum(torch.maximum(z_nom.unsqueeze(1) + lam.unsqueeze(2) * g.unsqueeze(1), z_min.reshape(-1, 1, dim)), z_max.reshape(-1, 1, dim))
+        phi = torch.sum(z_kink * g.unsqueeze(1), dim=2)
+
+        b = b.reshape(bs, 1)
+        feasible = phi[:, -1] >= b[:, 0]
+
+        # First kink that satisfies the constraint, and linear interpolation on the
+        # segment before it
+        k = torch.argmax((phi >= b).int(), dim=1, keepdim=True)
+        k_prev = torch.clamp(k - 1, min=0)
+        lam_k = torch.gather(lam, 1, k)
+        lam_prev = torch.gather(lam, 1, k_prev)
+        phi_k = torch.gather(phi, 1, k)
+        phi_prev = torch.gather(phi, 1, k_prev)
+        slope = torch.where(phi_k > phi_prev, (lam_k - lam_prev) / (phi_k - phi_prev), torch.zeros_like(phi_k))
+        lam_opt = torch.where(k > 0, lam_prev + (b - phi_prev) * slope, torch.zeros_like(lam_k))
+
+        z = torch.minimum(torch.maximum(z_nom + lam_opt * g, z_min), z_max)
+
+        return z, lam_opt, feasible
+
+
 class Utils(object):
 
     def __init__(self,
@@ -48,6 +187,8 @@ class Utils(object):
         self.fault = fault
         self.fault_control_index = fault_control_index
         self.dt = dt
+        self.qp_batch = None
+        self.qp_step = QPWorkspace(m_control + 1)
 
     def is_safe(self, state):
 
@@ -226,212 +367,160 @@ class Utils(object):
 
         return u_nominal
 
-    def fault_controller(self, u_nominal, fx, gx, h, grad_h):
+    def fault_controller(self, u_nominal, fx, gx, h, grad_h, fault_start=0):
         """
+        Filter a batch of nominal controls through the CBF-QP
+            min_{u, a} 1/200 * ||u - u_nominal||^2 + 1/200 * a^2 - a
+            s.t.       Lf + Lg u + a h >= 0,  ul <= u <= um
+        solving all bs QPs at once in closed form (see cbf_qp_layer).
         args:
-            state (n_state,)
-            goal (n_state,)
+            u_nominal (bs, m_control)
+            fx (bs, n_state, 1)
+            gx (bs, n_state, m_control)
+            h (bs, 1)
+            grad_h (bs, 1, n_state)
+            fault_start 1 once the fault on fault_control_index is active
         returns:
-            u_nominal (m_control,)
+            u_neural (bs, m_control), u_nominal for samples whose QP is infeasible
         """
-        um, ul = self.dyn.control_limits()
-        
-        bs = u_nominal.shape[0]
-        
-        u_neural = u_nominal.clone()
-
-        m_control = self.m_control
-
-        size_Q = m_control + 1
-
-        num_constraints = (m_control + 1) * 2 + 1
-
-        Q = csc_matrix(identity(size_Q))
-
-        Q = Q / 100
-
-        A_all = torch.tensor([]).reshape(0, 0)
-        B_all = torch.tensor([]).reshape(0, 1)
-        F_all = torch.tensor([]).reshape(0, 1)
-
-        for i in range(bs):
-            u_nom = u_nominal[i, :].reshape(m_control)
-
-            F = - torch.hstack((u_nom, torch.tensor(1.0))).reshape(size_Q, 1)
-            
-            F = F / 100
-
-            F[-1] = -1
-
-            Lg = torch.matmul(grad_h[i, :, :], gx[i, :, :]).detach()
-            Lf = torch.matmul(grad_h[i, :, :], fx[i, :, :]).detach()
-
-            if h[i] == 0:
-                h[i] = 1e-4
-
-        # noinspection PyTypeChecker
-            A = torch.hstack((- Lg.reshape(1, m_control), -h[i].reshape(1, 1)))
-            B = Lf.detach().cpu()
-
-            lb = torch.vstack((ul.reshape(self.m_control, 1), torch.tensor(-100000000).reshape(1, 1)))
-            ub = torch.vstack((um.reshape(self.m_control, 1), torch.tensor(100000000).reshape(1, 1)))
-            A_in = torch.tensor(
-                [[1, 0, 0, 0, 0], [0, 1, 0, 0, 0], [0, 0, 1, 0, 0], [0, 0, 0, 1, 0], [0, 0, 0, 0, 1], [-1, 0, 0, 0, 0],
-                [0, -1, 0, 0, 0], [0, 0, -1, 0, 0], [0, 0, 0, -1, 0], [0, 0, 0, 0, -1]])
+        u_neural = self.cbf_qp_layer(u_nominal.detach(), fx.detach(), gx.detach(), h.detach(), grad_h.detach(),
+                                     fault_start)
 
-            A_mat = torch.vstack((A.clone().detach(), A_in))
+        return u_neural.detach()
 
-            B_in = torch.vstack((ub, -lb))
-
-            B_mat = torch.vstack((B, B_in.reshape(2 * self.m_control + 2, 1)))
-
-            num_constraints = A_mat.shape[0]
-
-            num_vars = A_mat.shape[1]
-
-            current_row = A_all.shape[0]
-
-            current_col = A_all.shape[1]
-
-            A_all = torch.hstack((A_all, torch.zeros(current_row, num_vars)))
+    def cbf_qp_layer(self, u_nominal, fx, gx, h, grad_h, fault_start=0):
+        """
+        Differentiable version of fault_controller: gradients flow to u_nominal, h and
+        grad_h (and fx, gx) through the KKT conditions of each QP, see CBFQPFunction.
+        When fault_start == 1 the faulty actuator is removed from the CBF constraint and
+        its worst case is added to Lf, as in neural_controller.
+        args:
+            u_nominal (bs, m_control)
+            fx (bs, n_state, 1)
+            gx (bs, n_state, m_control)
+            h (bs, 1)
+            grad_h (bs, 1, n_state)
+            fault_start 1 once the fault on fault_control_index is active
+        returns:
+            u_neural (bs, m_control), u_nominal for samples whose QP is infeasible
+        """
+        um, ul = self.dyn.control_limits()
 
-            A_mat = torch.hstack((torch.zeros(num_constraints, current_col), A_mat.clone()))
+        bs = u_nominal.shape[0]
 
-            A_all = torch.vstack((A_all, A_mat))
-            
-            B_all = torch.vstack((B_all, B_mat))
+        m_control = self.m_control
 
-            F_all = torch.vstack((F_all, F))
-            
-        A_mat = scipy.sparse.csc.csc_matrix(A_mat)
-        
-        B_mat = np.array(B_mat)
+        um = um.reshape(m_control).double().to(u_nominal.device)
+        ul = ul.reshape(m_control).double().to(u_nominal.device)
 
-        q_size = F_all.shape[0]
-                
-        Q_all = torch.eye(q_size)
+        Lg = torch.matmul(grad_h, gx).reshape(bs, m_control).double()
+        Lf = torch.matmul(grad_h, fx).reshape(bs).double()
 
-        Q_mat = csc_matrix(Q_all)
-        
-        F_mat = np.array(F_all)
+        if fault_start == 1:
+            Lf = Lf - torch.abs(Lg[:, self.fault_control_index]) * um[self.fault_control_index]
+            healthy = torch.ones(m_control).double().to(u_nominal.device)
+            healthy[self.fault_control_index] = 0.0
+            Lg = Lg * healthy
 
-        A_mat = scipy.sparse.csc.csc_matrix(A_mat)
+        h = h.reshape(bs).double()
+        h = torch.where(h == 0, 1e-4 * torch.ones_like(h), h)
 
-        B_mat = np.array(B_mat)
+        # The QP is solved for z = [u, a], whose unconstrained optimum is [u_nominal, 100]
+        z_nom = torch.hstack((u_nominal.reshape(bs, m_control).double(), 100 * torch.ones(bs, 1).double().to(u_nominal.device)))
+        cbf_row = torch.hstack((Lg, h.reshape(bs, 1)))
+        z_max = torch.hstack((um, torch.tensor([100000000]).double().to(u_nominal.device)))
+        z_min = torch.hstack((ul, torch.tensor([-100000000]).double().to(u_nominal.device)))
 
-        # m.update(q=F_mat, u=B_mat)
+        z, feasible = CBFQPFunction.apply(z_nom, cbf_row, -Lf, z_max, z_min)
 
-        # m.update(Ax=A_mat.data)
+        u_neural = torch.where(feasible.reshape(bs, 1), z[:, :m_control], z_nom[:, :m_control])
 
-        # res = m.solve()
-        # u = res.x
+        return u_neural.type_as(u_nominal).reshape(bs, m_control)
 
-        # if u is None:
-        #     u_neural = u_nominal.clone()
-        # else:
-        #     u = torch.tensor(u).reshape(bs, m_control + 1).type_as(u_nominal)
-        #     u_neural = u[:, :m_control]
-        try:
-            u = solve_qp(Q_mat, F_mat, A_mat, B_mat, solver="osqp")
-            u = torch.tensor(u).reshape(bs, m_control + 1).type_as(u_nominal)
-            u_neural = u[:, :m_control]
-        except:
-            u_neural = u_nominal.clone()
-            
-        return u_neural.reshape(bs, m_control)
-    
     def fault_controller_batch(self, u_nominal, fx, gx, h, grad_h):
         """
+        Same CBF-QP as fault_controller, solved by OSQP as one sparse QP over
+        z = [u_1, a_1, ..., u_bs, a_bs]. The constraint matrix is
+            [ blockdiag(Lg_i, h_i) ]    >= -Lf
+            [ identity             ]    in [z_min, z_max]
+        and is built directly in CSC form. Its sparsity pattern only depends on bs,
+        so the OSQP workspace is kept and later calls only update q, l, u and the
+        values of A.
         args:
-            state (n_state,)
-            goal (n_state,)
+            u_nominal (bs, m_control)
+            fx (bs, n_state, 1)
+            gx (bs, n_state, m_control)
+            h (bs, 1)
+            grad_h (bs, 1, n_state)
         returns:
-            u_nominal (m_control,)
+            u_neural (bs, m_control), u_nominal if OSQP does not solve the QP
         """
         um, ul = self.dyn.control_limits()
-        
-        bs = u_nominal.shape[0]
 
-        um = um.repeat(bs, 1)
-        ul = ul.repeat(bs, 1)
-        
-        u_neural = u_nominal.clone()
+        bs = u_nominal.shape[0]
 
         m_control = self.m_control
 
         size_Q = (m_control + 1) * bs
 
-        Q = csc_matrix(identity(size_Q))
+        Lg = torch.matmul(grad_h, gx).detach().reshape(bs, m_control)
+        h = h.detach().reshape(bs)
+        h = torch.where(h == 0, 1e-4 * torch.ones_like(h), h)
 
-        Q = Q / 100
-
-        # for i in range(bs):
-        u_nom = u_nominal.reshape(bs, m_control)
-        F = torch.hstack((u_nom, - torch.ones(bs, 1))).reshape(size_Q, 1)
-
-        F = - np.array(F)
-    # F[0] = F[0] / um[0]
-
-        F = F / 100
-
-        Lg = torch.matmul(grad_h, gx).detach()
-        Lf = torch.matmul(grad_h, fx).detach()
-        
-        # if h[i] == 0:
-        #     h[i] = 1e-4
-
-    # noinspection PyTypeChecker
-        A = torch.hstack((- Lg.reshape(bs, m_control), -h.reshape(bs, 1)))
-
-        B = Lf.detach().cpu()
-        
-        lb = torch.vstack((ul.reshape(self.m_control, bs), -10000*torch.ones(1, bs)))
-        ub = torch.vstack((um.reshape(self.m_control, bs), 1000*torch.ones(1, bs)))
-        
-        A_in = torch.tensor(
-            [[1, 0, 0, 0, 0], [0, 1, 0, 0, 0], [0, 0, 1, 0, 0], [0, 0, 0, 1, 0], [0, 0, 0, 0, 1], [-1, 0, 0, 0, 0],
-            [0, -1, 0, 0, 0], [0, 0, -1, 0, 0], [0, 0, 0, -1, 0], [0, 0, 0, 0, -1]])
-        
-        A_in = A_in.repeat(bs, 1)
-        
-        A = torch.vstack((A.clone().detach(), A_in))
-
-        B_in = torch.vstack((ub, -lb))
-        B = torch.vstack((B.reshape(B.shape[0], 1), B_in.reshape(2 * (self.m_control + 1) * bs, 1)))
-    
-        B = np.array(B)
-
-        print(A.shape)
-        
-        A = scipy.sparse.csc.csc_matrix(A)
-
-        try:
-            u = solve_qp(Q, F, A, B, solver="osqp")
-        except:
-            u = None
+        cbf_row = torch.hstack((Lg, h.reshape(bs, 1))).cpu().double().numpy()
+        Lf = torch.matmul(grad_h, fx).detach().cpu().double().numpy().reshape(bs)
 
-        if u is None:
+        # Unit-norm CBF rows keep OSQP well conditioned when Lg and h differ by orders of magnitude
+        row_norm = np.linalg.norm(cbf_row, axis=1)
+        cbf_row = (cbf_row / row_norm.reshape(bs, 1)).reshape(size_Q)
+        Lf = Lf / row_norm
+
+        u_nom = u_nominal.detach().cpu().double().numpy().reshape(bs, m_control)
+        F = - np.hstack((u_nom / 100, np.ones((bs, 1)))).reshape(size_Q)
+
+        z_max = np.hstack((um.detach().cpu().double().numpy().reshape(m_control), np.inf))
+        z_min = np.hstack((ul.detach().cpu().double().numpy().reshape(m_control), -np.inf))
+
+        lb = np.hstack((- Lf, np.tile(z_min, bs)))
+        ub = np.hstack((np.inf * np.ones(bs), np.tile(z_max, bs)))
+
+        # Every column of A holds its CBF coefficient and then the 1 of its box row
+        A_data = np.ones(2 * size_Q)
+        A_data[0::2] = cbf_row
+
+        if self.qp_batch is None or self.qp_batch[0] != bs:
+            Q = csc_matrix(identity(size_Q)) / 100
+            A = vstack((scipy.sparse.kron(identity(bs), np.ones((1, m_control + 1))), identity(size_Q)), format='csc')
+            A.data = A_data
+            qp = OSQP()
+            qp.setup(P=Q, q=F, A=A, l=lb, u=ub, verbose=False, warm_start=True, polish=True, eps_abs=1e-6, eps_rel=1e-6, max_iter=10000)
+            self.qp_batch = (bs, qp)
+        else:
+            qp = self.qp_batch[1]
+            qp.update(q=F, l=lb, u=ub, Ax=A_data)
+
+        results = qp.solve()
+
+        if results.info.status_val not in (1, 2):
             u_neural = u_nominal
         else:
-            # for j in range(m_control):
-            #     if u[j] < ul[j]:
-            #         u[j] = ul[j].clone()
-            #     if u[j] > um[j]:
-            #         u[j] = um[j].clone()
-            u = torch.tensor(u).reshape(m_control + 1, bs)
-            u = u[0:m_control, :]
-            u_neural = u.reshape(bs, m_control)
-            
-            # u_neural = u[0:self.m_control].reshape(1, m_control)
+            u = torch.tensor(results.x).reshape(bs, m_control + 1)
+            u_neural = u[:, 0:m_control].type_as(u_nominal)
+
         return u_neural.reshape(bs, m_control)
-    
-    def neural_controller(self, u_nominal, fx, gx, h, grad_h, fault_start):
+
+    def neural_controller(self, u_nominal, fx, gx, h, grad_h, fault_start, qp=None):
         """
         args:
-            state (n_state,)
-            goal (n_state,)
+            u_nominal (1, m_control)
+            fx (1, n_state, 1)
+            gx (1, n_state, m_control)
+            h (1, 1)
+            grad_h (1, 1, n_state)
+            fault_start 1 once the fault on fault_control_index is active
+            qp QPWorkspace of this trajectory, self.qp_step if None
         returns:
-            u_nominal (m_control,)
+            u_neural (1, m_control), u_nominal (m_control,) if the QP is not solved
         """
         um, ul = self.dyn.control_limits()
 
@@ -439,68 +528,52 @@ class Utils(object):
 
         size_Q = m_control + 1
 
-        Q = csc_matrix(identity(size_Q))
-        # Q[0,0] = 1 / um[0]
-        F = torch.hstack((torch.tensor(u_nominal).reshape(m_control), torch.tensor(1.0))).reshape(size_Q, 1)
-
-        F = - np.array(F)
-        # F[0] = F[0] / um[0]
-
-        Q = Q / 100
-        F = F / 100
-
-        F[-1] = -1
+        P = np.ones(size_Q) / 100
+        F = - np.hstack((torch.as_tensor(u_nominal).detach().double().cpu().numpy().reshape(m_control) / 100, 1.0))
 
-        Lg = torch.matmul(grad_h, gx).detach()
-        Lf = torch.matmul(grad_h, fx).detach()
+        Lg = torch.matmul(grad_h, gx).detach().reshape(m_control).clone()
+        Lf = torch.matmul(grad_h, fx).detach().reshape(1)
 
         if fault_start == 1:
-            # uin = um[self.fault_control_index] * (Lg[0, 0, self.fault_control_index] > 0) + \
-            #       ul[self.fault_control_index] * (Lg[0, 0, self.fault_control_index] <= 0)
-            # Lf = Lf - torch.abs(Lg[0, 0, self.fault_control_index]) * uin
-            Lf = Lf - torch.abs(Lg[0, 0, self.fault_control_index]) * um[self.fault_control_index]
-            Lg[0, 0, self.fault_control_index] = 0.0
+            # uin = um[self.fault_control_index] * (Lg[self.fault_control_index] > 0) + \
+            #       ul[self.fault_control_index] * (Lg[self.fault_control_index] <= 0)
+            # Lf = Lf - torch.abs(Lg[self.fault_control_index]) * uin
+            Lf = Lf - torch.abs(Lg[self.fault_control_index]) * um[self.fault_control_index]
+            Lg[self.fault_control_index] = 0.0
 
         if h == 0:
             h = 1e-4
 
-        # noinspection PyTypeChecker
-        A = torch.hstack((- Lg.reshape(1, m_control), -h))
-        B = Lf.detach().cpu()
-
-        lb = torch.vstack((ul.reshape(self.m_control, 1), torch.tensor(-1000000).reshape(1, 1)))
-        ub = torch.vstack((um.reshape(self.m_control, 1), torch.tensor(1000000).reshape(1, 1)))
-        A_in = torch.vstack((torch.eye(m_control+1), -torch.eye(m_control + 1)))
-        # A_in = torch.tensor(
-        #     [[1, 0, 0, 0, 0], [0, 1, 0, 0, 0], [0, 0, 1, 0, 0], [0, 0, 0, 1, 0], [0, 0, 0, 0, 1], [-1, 0, 0, 0, 0],
-        #      [0, -1, 0, 0, 0], [0, 0, -1, 0, 0], [0, 0, 0, -1, 0], [0, 0, 0, 0, -1]])
-
-        A = torch.vstack((A.clone().detach(), A_in))
+        cbf_row = np.hstack((Lg.double().cpu().numpy(), float(h)))
 
-        B_in = torch.vstack((ub, -lb))
-        B = torch.vstack((B, B_in.reshape(2 * self.m_control + 2, 1, 1)))
+        lb = np.hstack((- Lf.double().cpu().numpy(), ul.reshape(m_control).double().cpu().numpy(), -1000000))
+        ub = np.hstack((np.inf, um.reshape(m_control).double().cpu().numpy(), 1000000))
 
-        B = np.array(B)
+        if qp is None:
+            qp = self.qp_step
 
-        # print(A)
-        A = scipy.sparse.csc.csc_matrix(A)
-        u = solve_qp(Q, F, A, B, solver="osqp")
-        # , lb = lb.reshape(self.m_control + 1, 1, 1), ub = ub.reshape(self.m_control + 1, 1, 1),
+        u = qp.solve(P, F, cbf_row, lb, ub)
 
         if u is None:
             u_neural = u_nominal.reshape(m_control)
         else:
-            u_neural = torch.tensor([u[0:self.m_control]]).reshape(1, m_control)
+            u_neural = torch.tensor(u[0:self.m_control]).reshape(1, m_control)
 
         return u_neural
-    
-    def neural_controller_gamma(self, u_nominal, fx, gx, h, grad_h, fault_start, fault_index=-1):
+
+    def neural_controller_gamma(self, u_nominal, fx, gx, h, grad_h, fault_start, fault_index=-1, qp=None):
         """
         args:
-            state (n_state,)
-            goal (n_state,)
+            u_nominal (1, m_control)
+            fx (1, n_state, 1)
+            gx (1, n_state, m_control)
+            h (1, 1)
+            grad_h (1, 1, n_state)
+            fault_start 1 once the fault on fault_index is active
+            fault_index actuator predicted faulty by the Gamma network, -1 if none
+            qp QPWorkspace of this trajectory, self.qp_step if None
         returns:
-            u_nominal (m_control,)
+            u_neural (1, m_control), u_nominal (m_control,) if the QP is not solved
         """
         um, ul = self.dyn.control_limits()
 
@@ -508,59 +581,37 @@ class Utils(object):
 
         size_Q = m_control + 1
 
-        Q = csc_matrix(identity(size_Q))
-        # Q[0,0] = 1 / um[0]
-        F = torch.hstack((u_nominal.reshape(m_control), torch.tensor(1.0))).reshape(size_Q, 1)
-
-        F = - np.array(F)
-        # F[0] = F[0] / um[0]
-
-        Q = Q / 100
-        F = F / 100
+        P = np.ones(size_Q) / 100
+        F = - np.hstack((u_nominal.detach().double().cpu().numpy().reshape(m_control) / 100, 1.0))
 
-        F[-1] = -1
-
-        Lg = torch.matmul(grad_h, gx).detach()
-        Lf = torch.matmul(grad_h, fx).detach()
+        Lg = torch.matmul(grad_h, gx).detach().reshape(m_control).clone()
+        Lf = torch.matmul(grad_h, fx).detach().reshape(1)
 
         if fault_start == 1 and fault_index >= 0:
             F[fault_index] = 0
-            Q[fault_index, fault_index] = 100
-            # uin = um[fault_index] * (Lg[0, 0, fault_index] > 0) + \
-                #   ul[fault_index] * (Lg[0, 0, fault_index] <= 0)
-            # Lf = Lf - torch.abs(Lg[0, 0, fault_index]) * uin
-            Lf = Lf - torch.abs(Lg[0, 0, fault_index]) * um[fault_index]
-            Lg[0, 0, fault_index] = 0.0
+            P[fault_index] = 100
+            # uin = um[fault_index] * (Lg[fault_index] > 0) + \
+            #   ul[fault_index] * (Lg[fault_index] <= 0)
+            # Lf = Lf - torch.abs(Lg[fault_index]) * uin
+            Lf = Lf - torch.abs(Lg[fault_index]) * um[fault_index]
+            Lg[fault_index] = 0.0
 
         if h == 0:
             h = 1e-4
 
-        # noinspection PyTypeChecker
-        A = torch.hstack((- Lg.reshape(1, m_control), -h))
-        B = Lf.detach().cpu()
+        cbf_row = np.hstack((Lg.double().cpu().numpy(), float(h)))
 
-        
-        lb = torch.vstack((ul.reshape(self.m_control, 1), torch.tensor(-1000000).reshape(1, 1)))
-        ub = torch.vstack((um.reshape(self.m_control, 1), torch.tensor(1000000).reshape(1, 1)))
-        A_in = torch.tensor(
-            [[1, 0, 0, 0, 0], [0, 1, 0, 0, 0], [0, 0, 1, 0, 0], [0, 0, 0, 1, 0], [0, 0, 0, 0, 1], [-1, 0, 0, 0, 0],
-             [0, -1, 0, 0, 0], [0, 0, -1, 0, 0], [0, 0, 0, -1, 0], [0, 0, 0, 0, -1]])
+        lb = np.hstack((- Lf.double().cpu().numpy(), ul.reshape(m_control).double().cpu().numpy(), -1000000))
+        ub = np.hstack((np.inf, um.reshape(m_control).double().cpu().numpy(), 1000000))
 
-        A = torch.vstack((A.clone().detach(), A_in))
+        if fault_index >= 0:
+            lb[fault_index + 1] = 0
+            ub[fault_index + 1] = 0
 
-        B_in = torch.vstack((ub, -lb))
-        B = torch.vstack((B, B_in.reshape(2 * self.m_control + 2, 1, 1)))
+        if qp is None:
+            qp = self.qp_step
 
-        B = np.array(B)
-        
-        if fault_index >= 0:
-            B[fault_index + 1] = 0
-            B[fault_index + m_control + 2]  = 0
-    
-        # print(A)
-        A = scipy.sparse.csc.csc_matrix(A)
-        u = solve_qp(Q, F, A, B, solver="osqp")
-        # , lb = lb.reshape(self.m_control + 1, 1, 1), ub = ub.reshape(self.m_control + 1, 1, 1),
+        u = qp.solve(P, F, cbf_row, lb, ub)
 
         if u is None:
             u_neural = u_nominal.reshape(m_control)
@@ -569,6 +620,14 @@ class Utils(object):
 
         return u_neural
 
+    def reset_qp(self):
+        """
+        Start a new trajectory: drop the OSQP workspace of neural_controller and
+        neural_controller_gamma so that the next step does not warm start from
+        an unrelated solution.
+        """
+        self.qp_step = QPWorkspace(self.m_control + 1)
+
     def x_bndr(self, sm, sl, N):
         """
         args: